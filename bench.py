@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+
+#####################################################################
+#
+# Copyright 2015 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#####################################################################
+
+#
+# Benchmarks for the client/server protocol, run against local stand-in servers.
+# usage: bench.py [benchmark name ...]
+#
+
+try: # version-proof
+    import xmlrpc.server as xmlrpc_server
+    import xmlrpc.client as xmlrpc_lib
+    import socketserver
+except ImportError :
+    import SimpleXMLRPCServer as xmlrpc_server
+    import xmlrpclib as xmlrpc_lib
+    import SocketServer as socketserver
+
+import wsgiref.simple_server
+
+import wsgi_xmlrpc
+import dirb.server as server
+import dirb.server.runner as runner
+import dirb.auth as auth
+import dirb.ds as ds
+
+import base64
+import codecs
+import io
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# ==========================================
+
+class StandInHandler( xmlrpc_server.SimpleXMLRPCRequestHandler ):
+  protocol_version = 'HTTP/1.1' # keep-alive, like a production http server
+  def log_message( self, format, *args ):
+    pass
+
+class StandInServer( socketserver.ThreadingMixIn, xmlrpc_server.SimpleXMLRPCServer ):
+  daemon_threads = True
+
+class StandInApp( object ):
+  "answers like ServerApp, without checking credentials or touching the file system"
+  def __init__( self, latency=0.0 ):
+    self._latency = latency # seconds added to every call, to simulate a distant server
+  def get_nonce( self ):
+    time.sleep( self._latency )
+    return codecs.decode( base64.b64encode(auth.get_nonce()), "utf-8" )
+  def get_nonces( self, count ):
+    time.sleep( self._latency )
+    return [ codecs.decode( base64.b64encode(auth.get_nonce()), "utf-8" ) for x in range( count ) ]
+  def echo( self, value, user ):
+    time.sleep( self._latency )
+    return value
+  def echo_all( self, value, user ):
+    time.sleep( self._latency )
+    return value
+
+def start_standin( app ):
+  "returns the url of a threaded stand-in server for the app, and the server object"
+  srv = StandInServer( ('127.0.0.1', 0), requestHandler=StandInHandler, allow_none=True, logRequests=False )
+  srv.register_instance( app )
+  thread = threading.Thread( target=srv.serve_forever )
+  thread.daemon = True
+  thread.start()
+  return 'http://127.0.0.1:%d/' % srv.server_address[1], srv
+
+class WireCounter( object ):
+  "wsgi middleware, counting the bytes of request and response bodies"
+  def __init__( self, app ):
+    self._app = app
+    self.received = 0
+    self.sent = 0
+  def __call__( self, environ, start_response ):
+    self.received += int( environ.get( 'CONTENT_LENGTH' ) or 0 )
+    body = self._app( environ, start_response )
+    self.sent += sum( len( x ) for x in body )
+    return body
+
+class StandInWSGIHandler( wsgiref.simple_server.WSGIRequestHandler ):
+  def log_message( self, format, *args ):
+    pass
+
+class StandInWSGIServer( socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer ):
+  daemon_threads = True
+
+def start_wsgi_standin( app ):
+  "returns the url of a threaded stand-in wsgi server for the app, and the server object"
+  srv = wsgiref.simple_server.make_server( '127.0.0.1', 0, app, server_class=StandInWSGIServer, handler_class=StandInWSGIHandler )
+  thread = threading.Thread( target=srv.serve_forever )
+  thread.daemon = True
+  thread.start()
+  return 'http://127.0.0.1:%d/' % srv.server_address[1], srv
+
+class BenchClient( server.RemoteClient ):
+  pass
+
+@BenchClient._rpc_one()
+def echo( self, value, user ):
+  "returns the value"
+
+@BenchClient._rpc_all()
+def echo_all( self, value, user ):
+  "returns the value from every server"
+
+def make_conf( url, **kwargs ):
+  ret = { 'DIRB_SERVERS' : url, 'DIRB_AUTHPATH' : tempfile.mkdtemp() }
+  ret.update( kwargs )
+  return ret
+
+def timeit( fn, count ):
+  start = time.time()
+  for i in range( count ):
+    fn()
+  return ( time.time() - start ) / count
+
+def load( clients, seconds ):
+  "returns the calls per second made by the clients, each calling from its own thread"
+  counts = [ 0 ] * len( clients )
+  deadline = time.time() + seconds
+  def calls( i ):
+    while time.time() < deadline :
+      clients[i]()
+      counts[i] += 1
+  threads = [ threading.Thread( target=calls, args=( i, )) for i in range( len( clients )) ]
+  for thread in threads :
+    thread.start()
+  for thread in threads :
+    thread.join()
+  return sum( counts ) / float( seconds )
+
+def report( name, seconds ):
+  print( "%-48s %10.1f us/call" % ( name, seconds * 1e6 ) )
+
+# ==========================================
+
+def bench_connection_reuse( count=2000 ):
+  "authenticated calls with fresh connections versus pooled keep-alive connections"
+  url, srv = start_standin( StandInApp() )
+  try:
+    fresh = BenchClient( make_conf( url, DIRB_CONNECTION_IDLE_TIMEOUT=0 ), {}, '/' )
+    pooled = BenchClient( make_conf( url ), {}, '/' )
+    report( "echo, new connection per call", timeit( lambda : fresh.echo( 'x', None ), count ))
+    report( "echo, pooled keep-alive connections", timeit( lambda : pooled.echo( 'x', None ), count ))
+    pooled.close()
+  finally:
+    srv.shutdown()
+
+# ==========================================
+
+def bench_nonce_prefetch( count=500 ):
+  "authenticated calls to a server with 2ms latency, fetching one nonce per call versus prefetched batches"
+  url, srv = start_standin( StandInApp( 0.002 ) )
+  try:
+    single = BenchClient( make_conf( url, DIRB_NONCE_BATCH=1 ), {}, '/' )
+    batched = BenchClient( make_conf( url ), {}, '/' )
+    report( "echo, nonce fetched per call", timeit( lambda : single.echo( 'x', None ), count ))
+    report( "echo, nonces prefetched in batches", timeit( lambda : batched.echo( 'x', None ), count ))
+    single.close()
+    batched.close()
+  finally:
+    srv.shutdown()
+
+# ==========================================
+
+def bench_broadcast( count=20 ):
+  "calls to all of 8 servers with 50ms latency each"
+  standins = [ start_standin( StandInApp( 0.05 ) ) for x in range( 8 ) ]
+  try:
+    client = BenchClient( make_conf( ','.join( x[0] for x in standins ) ), {}, '/' )
+    report( "echo_all, 8 servers", timeit( lambda : client.echo_all( 'x', None ), count ))
+    client.close()
+  finally:
+    for url, srv in standins :
+      srv.shutdown()
+
+# ==========================================
+
+def bench_columnar( count=20 ):
+  "size and client decoding time of 5000 created path contexts, as XML-RPC structs versus columnar"
+  ptclist = [ ds.PathTraversalContext( ['shotroot'], {'areatype':'shots'}, {'show':'show','sequence':'sq%d' % (x % 50),'shot':'sh%d' % x}, 
+    '/projects/show/sequence/sq%d/sh%d' % (x % 50, x), {'sequence':None,'shot':None}, 'artist', 'vfx', 0o755 ) for x in range( 5000 ) ]
+  encodings = (
+    ( "structs", [ tuple(x) for x in ptclist ], lambda x : server.tuples_to_ptclist( x ) ),
+    ( "columnar", server.encode_ptclist( ptclist ), lambda x : list( server.columnar_to_ptclist( x )) ),
+    ( "columnar, compressed", server.encode_ptclist( ptclist, True ), lambda x : list( server.columnar_to_ptclist( x )) ))
+  for name, value, decode in encodings :
+    payload = xmlrpc_lib.dumps( ( value, ), methodresponse=True, allow_none=True )
+    print( "%-48s %10d bytes" % ( name, len( payload )))
+    report( "%s, unmarshal and decode" % name, timeit( lambda : decode( xmlrpc_lib.loads( payload )[0][0] ), count ))
+
+# ==========================================
+
+def bench_gzip( count=20 ):
+  "echo of a collection document (~860KB of XML) through the wsgi application, plain versus gzip encoded"
+  counter = WireCounter( wsgi_xmlrpc.WSGIXMLRPCApplication( StandInApp() ))
+  url, srv = start_wsgi_standin( counter )
+  value = { 'collections' : dict( ( 'coll%d' % x, [ 'value%05d' % y for y in range( 2000 ) ] ) for x in range( 10 )) }
+  try:
+    for name, threshold in ( ( "plain", 0 ), ( "gzip", 16 * 1024 ) ):
+      client = BenchClient( make_conf( url, DIRB_GZIP_THRESHOLD=threshold ), {}, '/' )
+      if threshold == 0 :
+        # the transport asks for gzip responses regardless, so for plain responses turn it off on the server:
+        counter._app.encode_threshold = None
+      else:
+        counter._app.encode_threshold = wsgi_xmlrpc.WSGIXMLRPCApplication.encode_threshold
+      counter.received = counter.sent = 0
+      report( "echo, %s" % name, timeit( lambda : client.echo( value, None ), count ))
+      print( "%-48s %10d bytes sent, %d bytes received per call" % ( name, counter.received // count, counter.sent // count ))
+      client.close()
+  finally:
+    srv.shutdown()
+
+def bench_request_memory( size=12 * 1024 * 1024 ):
+  "peak memory handling a 12MB echo request in the wsgi application, one-shot read versus chunks fed to the parser"
+  import tracemalloc # python 3 only
+  app = wsgi_xmlrpc.WSGIXMLRPCApplication( StandInApp() )
+  app.max_chunk_size = 1024 * 1024
+  body = xmlrpc_lib.dumps( ( 'x' * size, None ), 'echo', allow_none=True ).encode( 'utf-8' )
+  def one_shot( environ, start_response ):
+    # what handle_POST used to do:
+    data = environ['wsgi.input'].read( int( environ['CONTENT_LENGTH'] ))
+    return [ app.dispatcher._marshaled_dispatch( data ) ]
+  for name, handler in ( ( "one-shot read", one_shot ), ( "chunks fed to the parser", app ) ):
+    stream = io.BufferedReader( io.BytesIO( body )) # like a socket, reads make new objects
+    environ = { 'REQUEST_METHOD' : 'POST', 'CONTENT_LENGTH' : str( len( body )), 'wsgi.input' : stream, 'REMOTE_ADDR' : 'bench' }
+    tracemalloc.start()
+    handler( environ, lambda status, headers : None )
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print( "%-48s %10.1f MB peak, %.2f x the request" % ( name, peak / 1e6, float( peak ) / len( body )))
+
+def bench_call_overhead( count=20000 ):
+  "client-side cost of preparing the arguments of a call, without the credentials"
+  client = BenchClient( make_conf( 'http://127.0.0.1:1/' ), {}, '/' )
+  method = BenchClient.echo._rpc[1]
+  credentials = lambda username, confdict, nonce : ( username, nonce, '', '' )
+  real_credentials, server.auth.get_user_credentials = server.auth.get_user_credentials, credentials
+  try:
+    report( "resolve argument positions with inspect", timeit( lambda : server._get_rpc_args( method ), count ))
+    report( "fill in arguments, positions resolved once", timeit( lambda : client._build_args( method, ( 'x', None ), {}, 'nonce' ), count ))
+  finally:
+    server.auth.get_user_credentials = real_credentials
+
+# ==========================================
+
+class RoundRobinSelector( server._ServerSelector ):
+  "how servers used to be picked"
+  def pick( self, exclude=() ):
+    self._next = ( getattr( self, '_next', -1 ) + 1 ) % len( self._servers )
+    return self._servers[ self._next ]
+
+def bench_balancing( count=200 ):
+  "calls to a server with 1ms latency and a server with 20ms latency, round robin versus the server selector"
+  standins = [ start_standin( StandInApp( x ) ) for x in ( 0.001, 0.02 ) ]
+  try:
+    for name, selector in ( ( "round robin", RoundRobinSelector ), ( "selector", server._ServerSelector ) ):
+      client = BenchClient( make_conf( ','.join( x[0] for x in standins ) ), {}, '/' )
+      client._selector = selector( client._server_list, 5 )
+      report( "echo, %s" % name, timeit( lambda : client.echo( 'x', None ), count ))
+      calls = client.get_balancer_stats()[ standins[0][0] ]['calls']
+      print( "%-48s %10.1f %% of calls to the faster server" % ( name, 100.0 * calls / count ))
+      client.close()
+  finally:
+    for url, srv in standins :
+      srv.shutdown()
+
+# ==========================================
+
+def bench_runner( clients=16, seconds=3 ):
+  "authenticated calls per second from 16 client threads, to the runner with a pool of threads and with 4 pre-forked workers"
+  authdir = tempfile.mkdtemp()
+  config = { 'DIRB_AUTHPATH' : authdir }
+  with open( os.path.join( authdir, '_dirb_methods.json' ), 'w' ) as f :
+    f.write( '{ "shutdown_server" : { "users" : [] } }' ) # so that the server does not log a missing permissions file
+  def run( url ):
+    remotes = [ BenchClient( make_conf( url, DIRB_AUTHPATH=authdir ), {}, '/' ) for x in range( clients ) ]
+    rate = load( [ lambda remote=x : remote.get_server_stats( None ) for x in remotes ], seconds )
+    for remote in remotes :
+      remote.close()
+    return rate
+
+  httpd = runner.make_server( config, ( '127.0.0.1', 0 ))
+  httpd.set_app( runner.make_application( server.ServerApp( 'bench', config, logging.CRITICAL ), config ))
+  thread = threading.Thread( target=httpd.run )
+  thread.start()
+  try:
+    print( "%-48s %10.1f calls/s" % ( "threads", run( 'http://127.0.0.1:%d/' % httpd.server_address[1] )))
+  finally:
+    httpd.stop()
+    thread.join()
+
+  sock = socket.socket()
+  sock.bind( ( '127.0.0.1', 0 ))
+  port = sock.getsockname()[1]
+  sock.close()
+  devnull = open( os.devnull, 'w' )
+  process = subprocess.Popen( [ sys.executable, '-m', 'dirb.server.runner', '--host', '127.0.0.1', '--port', str( port ), '--workers', '4' ],
+    env=dict( os.environ, DIRB_AUTHPATH=authdir ), stderr=devnull )
+  try:
+    time.sleep( 1 )
+    print( "%-48s %10.1f calls/s" % ( "4 pre-forked workers", run( 'http://127.0.0.1:%d/' % port )))
+  finally:
+    process.terminate()
+    process.wait()
+    devnull.close()
+
+# ==========================================
+
+class GlobalLockNonceCache( object ):
+  "how nonces used to be kept: one dict and one lock, scanned whole to prune past 4096 nonces"
+  def __init__( self ):
+    self._nonces = {}
+    self._lock = threading.Lock()
+  def add( self, nonces ):
+    now = time.time()
+    with self._lock :
+      for nonce in nonces :
+        self._nonces[ nonce ] = now
+      if len( self._nonces ) > 4096 :
+        for nonce, timestamp in list( self._nonces.items() ):
+          if now - timestamp > server.NONCE_EXPIRY :
+            del self._nonces[ nonce ]
+  def consume( self, nonce ):
+    with self._lock :
+      timestamp = self._nonces.pop( nonce, None )
+    return timestamp is not None and time.time() - timestamp < server.NONCE_EXPIRY
+
+def bench_nonce_cache( threads=8, seconds=2, outstanding=20000 ):
+  "batches of 16 nonces issued and consumed by 8 threads, with 20000 nonces held by clients"
+  for name, cache in ( ( "one lock, pruned by scanning", GlobalLockNonceCache() ), ( "sharded, expired by bucket", server._NonceCache() ) ):
+    cache.add( [ 'held%d' % x for x in range( outstanding ) ] )
+    def issue_and_consume():
+      nonces = [ codecs.decode( base64.b64encode( auth.get_nonce() ), "utf-8" ) for x in range( 16 ) ]
+      cache.add( nonces )
+      for nonce in nonces :
+        assert cache.consume( nonce )
+    rate = load( [ issue_and_consume ] * threads, seconds ) * 16
+    print( "%-48s %10.1f nonces/s" % ( name, rate ))
+
+# ==========================================
+
+def bench_secret_cache( count=20000 ):
+  "server-side verification of credentials, reading the secret file every call versus the secret cache"
+  conf = { 'DIRB_AUTHPATH' : tempfile.mkdtemp() }
+  nonce = codecs.decode( base64.b64encode( auth.get_nonce() ), "utf-8" )
+  cred = auth.get_user_credentials( auth.get_username(), conf, nonce )
+  filename = auth._make_userpass_filename( cred.username, conf )
+  clientnonce = base64.b64decode( cred.clientnonce )
+  def read_every_call():
+    # what verify_user_credentials used to do:
+    with open( filename, 'rb' ) as f :
+      return auth.hashlib.sha256( base64.b64decode( nonce ) + clientnonce + f.read() ).hexdigest() == cred.pwhash
+  report( "verify, file read per call", timeit( read_every_call, count ))
+  conf['DIRB_AUTH_RECHECK'] = 0
+  report( "verify, cached and revalidated by stat per call", timeit( lambda : auth.verify_user_credentials( cred, conf ), count ))
+  conf['DIRB_AUTH_RECHECK'] = 10
+  report( "verify, cached and revalidated every 10s", timeit( lambda : auth.verify_user_credentials( cred, conf ), count ))
+
+# ==========================================
+
+def bench_group_index( count=200, groups=30000 ):
+  "the groups of a user, among 30000 groups of 20 members each, scanning every group versus the index"
+  username = auth.get_username()
+  allgroups = [ auth.grp.struct_group( ( 'group%d' % x, 'x', 100000 + x, [ 'user%d' % ( ( x * 7 + y ) % 5000 ) for y in range( 20 ) ] )) for x in range( groups ) ]
+  gidnames = dict( ( x.gr_gid, x.gr_name ) for x in allgroups )
+  def scan():
+    # what _getgroups used to do:
+    return set( gidnames[ x.gr_gid ] for x in allgroups if 'user42' in x.gr_mem )
+  report( "user's groups, scanning every group", timeit( scan, count ))
+  
+  perms = auth.MethodPermissions( dict( server.conf.get_default_server_config(), DIRB_AUTHPATH=tempfile.mkdtemp() ), logging.getLogger( 'bench' ))
+  real_getgrall, auth.grp.getgrall = auth.grp.getgrall, lambda : allgroups
+  try:
+    report( "build the index, once per expiry period", timeit( auth._build_group_index, 5 ))
+    perms._get_group_index()
+    report( "user's groups, from the index", timeit( lambda : perms._getgroups( username ), count * 100 ))
+  finally:
+    auth.grp.getgrall = real_getgrall
+
+# ==========================================
+
+def bench_permissions( threads=8, seconds=2 ):
+  "permission checks per second from 8 threads, locking the document on every check versus compiled snapshots"
+  config = dict( server.conf.get_default_server_config(), DIRB_AUTHPATH=tempfile.mkdtemp() )
+  doc = dict( ( 'method%d' % x, { 'users' : [ 'user%d' % y for y in range( 50 ) ], 'groups' : [ 'group%d' % y for y in range( 50 ) ] } ) for x in range( 40 ))
+  with open( os.path.join( config['DIRB_AUTHPATH'], '_dirb_methods.json' ), 'w' ) as f :
+    f.write( server.json.dumps( doc ))
+  lock = threading.Lock()
+  usergroups = set( [ 'group49' ] )
+  def locked():
+    # what verify used to do, once the user's groups were known:
+    with lock :
+      ret = any( x in doc['method7']['groups'] for x in usergroups ) or 'user49' in doc['method7']['users']
+    return ret
+  perms = auth.MethodPermissions( config, logging.getLogger( 'bench' ))
+  perms._getgroups = lambda username : usergroups
+  print( "%-48s %10.1f checks/s" % ( "lock and document", load( [ locked ] * threads, seconds )))
+  print( "%-48s %10.1f checks/s" % ( "compiled snapshot", load( [ lambda : perms.verify( 'user49', 'method7' ) ] * threads, seconds )))
+
+# ==========================================
+
+def bench_decisions( count=100000 ):
+  "repeated permission checks of one user for a method restricted to groups, deciding every time versus remembered decisions"
+  username = auth.get_username()
+  config = dict( server.conf.get_default_server_config(), DIRB_AUTHPATH=tempfile.mkdtemp() )
+  with open( os.path.join( config['DIRB_AUTHPATH'], '_dirb_methods.json' ), 'w' ) as f :
+    f.write( server.json.dumps( { 'method' : { 'groups' : [ 'group%d' % x for x in range( 50 ) ] + [ auth.grp.getgrgid( auth.pwd.getpwnam( username ).pw_gid ).gr_name ] } } ))
+  for name, expiry in ( ( "decided every call", 0 ), ( "remembered decisions", 60 ) ):
+    perms = auth.MethodPermissions( dict( config, DIRBSERVER_DECISION_EXPIRY=expiry ), logging.getLogger( 'bench' ))
+    report( "verify, %s" % name, timeit( lambda : perms.verify( username, 'method' ), count ))
+
+# ==========================================
+
+def bench_sessions( count=1000 ):
+  "server-side authentication, and authenticated calls to the runner, with a nonce handshake per call versus a session token"
+  authdir = tempfile.mkdtemp()
+  config = { 'DIRB_AUTHPATH' : authdir }
+  with open( os.path.join( authdir, '_dirb_methods.json' ), 'w' ) as f :
+    f.write( '{ "shutdown_server" : { "users" : [] } }' ) # so that the server does not log a missing permissions file
+  app = server.ServerApp( 'bench', config, logging.CRITICAL )
+  username = auth.get_username()
+  def with_nonce():
+    app._auth_user( auth.get_user_credentials( username, config, app.get_nonce() ))
+  token = auth.make_session_token( username, time.time() + 3600, app._session_secret )
+  report( "nonce handshake and authentication, in process", timeit( with_nonce, count * 10 ))
+  report( "session token authentication, in process", timeit( lambda : app._auth_user( auth.make_session_credentials( username, token )), count * 10 ))
+  
+  httpd = runner.make_server( config, ( '127.0.0.1', 0 ))
+  httpd.set_app( runner.make_application( app, config ))
+  thread = threading.Thread( target=httpd.run )
+  thread.start()
+  url = 'http://127.0.0.1:%d/' % httpd.server_address[1]
+  try:
+    for name, kwargs in ( ( "nonce fetched per call", { 'DIRB_NONCE_BATCH' : 1 } ), ( "nonces prefetched in batches", {} ), ( "session token", { 'DIRB_SESSIONS' : 1 } ) ):
+      client = BenchClient( make_conf( url, DIRB_AUTHPATH=authdir, **kwargs ), {}, '/' )
+      report( "get_server_stats, %s" % name, timeit( lambda : client.get_server_stats( None ), count ))
+      client.close()
+  finally:
+    httpd.stop()
+    thread.join()
+
+# ==========================================
+
+BENCHMARKS = [ x for x in sorted( globals() ) if x.startswith( 'bench_' ) ]
+
+if __name__ == '__main__':
+  names = [ 'bench_%s' % x for x in sys.argv[1:] ] if sys.argv[1:] else BENCHMARKS
+  for name in names:
+    print( "%s: %s" % ( name, globals()[name].__doc__ ))
+    globals()[name]()
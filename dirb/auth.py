@@ -18,14 +18,19 @@
 
 import os
 import hashlib
+import hmac
+import binascii
 import collections
 import threading
 import datetime
+import time
 import stat
 import base64
 import json
 import codecs
 
+from . import conf
+
 try:
     # Assume Linux, OSX:
     import pwd
@@ -71,13 +76,130 @@ def _make_userpass_filename ( username, confdict ):
 def _make_method_permission_filename( confdict ):
     return os.path.join( confdict['DIRB_AUTHPATH' ], '_dirb_methods.json' )
   
-def _make_hash( noncehex, clientnonce, filename ) :
-   return hashlib.sha256( base64.b64decode(noncehex) + clientnonce + open(filename,'rb').read() ).hexdigest()
+def _make_hash( noncehex, clientnonce, secret ) :
+   ret = hashlib.sha256( base64.b64decode(noncehex) )
+   ret.update( clientnonce )
+   ret.update( secret )
+   return ret.hexdigest()
 
 def read_method_permissions( confdict ):
     # TODO would be nice if permissions on the filename were proven to be restricted
     filename = _make_method_permission_filename( confdict )
-    return json.loads( open( filename, 'rt' ).read() )
+    with open( filename, 'rt' ) as f :
+        return json.loads( f.read() )
+
+def compile_method_permissions( doc ):
+    "returns a dictionary of method name to ( frozenset of user names, frozenset of group names ) from a method permissions document"
+    return dict( ( k, ( frozenset( v.get( 'users', () ) ), frozenset( v.get( 'groups', () ) ) ) ) for k, v in doc.items() )
+
+#
+# Session tokens stand in for the nonce handshake, when a client opens a session (see ServerApp.open_session).
+# A token names the user and when it expires, signed with a secret held by the server,
+# so it is verified by one HMAC, without looking anything up.  Like a password, 
+# a token is good for anyone who sees it until it expires.
+#
+SESSION_MARKER = 'DIRB_SESSION' # in place of the server nonce, for credentials carrying a session token
+
+def make_session_token( username, expires, secret ):
+    "returns a token naming the user until expires (seconds since the epoch), signed with the secret (bytes)"
+    payload = base64.urlsafe_b64encode( ( '%s:%d' % ( username, expires ) ).encode( 'utf-8' ))
+    return '%s.%s' % ( payload.decode( 'utf-8' ), hmac.new( secret, payload, hashlib.sha256 ).hexdigest() )
+
+def verify_session_token( token, username, secret ):
+    "returns True if the token was signed with the secret, names the user, and has not expired"
+    try:
+        payload, signature = token.split( '.', 1 )
+        payload = payload.encode( 'utf-8' )
+        if not hmac.compare_digest( signature, hmac.new( secret, payload, hashlib.sha256 ).hexdigest() ):
+            return False
+        name, expires = base64.urlsafe_b64decode( payload ).decode( 'utf-8' ).rsplit( ':', 1 )
+        return name == username and time.time() < int( expires )
+    except ( ValueError, TypeError, AttributeError, binascii.Error ):
+        return False
+
+def make_session_credentials( username, token ):
+    "returns UserCredentials presenting the session token"
+    return UserCredentials( username, SESSION_MARKER, '', token )
+
+
+class SecretCache ( object ):
+    """the contents of users' secret files, by path.  The auth directory is often on NFS,
+    so an entry is trusted for a while (DIRB_AUTH_RECHECK seconds), then revalidated 
+    with a stat, and only read again if the file has changed."""
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self._entries = {} # path : ( time checked, ( device, inode, mtime, size ), contents )
+        self._hits = 0
+        self._stats = 0
+        self._reads = 0
+        
+    def get( self, filename, recheck ):
+        "returns the contents of the file, raises like open() when it cannot be read"
+        now = time.time()
+        self._lock.acquire( True )
+        try:
+            entry = self._entries.get( filename, None )
+            if entry and now - entry[0] < recheck :
+                self._hits += 1
+                return entry[2]
+        finally:
+            self._lock.release()
+        
+        # stat and read outside of the lock, so that one slow file does not hold up the others:
+        try:
+            st = os.stat( filename )
+        except OSError :
+            self.discard( filename )
+            raise
+        key = ( st.st_dev, st.st_ino, st.st_mtime, st.st_size )
+        changed = not entry or entry[1] != key
+        if changed :
+            with open( filename, 'rb' ) as f :
+                contents = f.read()
+        else:
+            contents = entry[2]
+        
+        self._lock.acquire( True )
+        try:
+            self._stats += 1
+            self._reads += changed
+            self._entries[ filename ] = ( now, key, contents )
+        finally:
+            self._lock.release()
+        return contents
+      
+    def discard( self, filename ):
+        self._lock.acquire( True )
+        try:
+            self._entries.pop( filename, None )
+        finally:
+            self._lock.release()
+      
+    def clear( self ):
+        self._lock.acquire( True )
+        try:
+            self._entries = {}
+        finally:
+            self._lock.release()
+      
+    def stats( self ):
+        "returns a dictionary of the number of files held, and counts of hits, stats and reads"
+        self._lock.acquire( True )
+        try:
+            return { 'size' : len( self._entries ), 'hits' : self._hits, 'stats' : self._stats, 'reads' : self._reads }
+        finally:
+            self._lock.release()
+
+# shared by get_user_credentials and verify_user_credentials:
+_secrets = SecretCache()
+
+def get_secret_stats():
+    "returns the statistics of the secret file cache in this process"
+    return _secrets.stats()
+
+def _read_secret( filename, confdict ):
+    recheck = confdict['DIRB_AUTH_RECHECK'] if 'DIRB_AUTH_RECHECK' in confdict else conf.get_default_config()['DIRB_AUTH_RECHECK']
+    return _secrets.get( filename, recheck )
 
 def get_nonce():
     "returns a binary, frequently will want to use with base64.b64encode"
@@ -107,102 +229,246 @@ def get_user_credentials( username, confdict, noncehex ):
     # automatically create a missing authentication file
     # if the username requested is the one running the process
     # or if root owns the current process
-    if not os.path.isfile( filename ) :
+    try:
+        secret = _read_secret( filename, confdict )
+    except ( IOError, OSError ) :
         # getuid is more secure than getpass.getuser(), which can easily be forged
         # with environment variables
-        if get_username() in (username, 'root'):
-            make_user_credentials( username, confdict )
+        if os.path.isfile( filename ) or get_username() not in (username, 'root'):
+            raise
+        make_user_credentials( username, confdict )
+        secret = _read_secret( filename, confdict )
 
     clientnonce = get_nonce()
-    dochash = _make_hash( noncehex, clientnonce, filename )
+    dochash = _make_hash( noncehex, clientnonce, secret )
     return UserCredentials( username, noncehex, base64.b64encode(clientnonce).decode('utf-8'), dochash )
 
 
 def verify_user_credentials( cred, confdict ):
     "This does NOT include the check to verify that the server nonce is valid"
     filename = _make_userpass_filename( cred.username, confdict )
-    dochash = _make_hash( cred.servernonce, base64.b64decode(cred.clientnonce), filename)
+    dochash = _make_hash( cred.servernonce, base64.b64decode(cred.clientnonce), _read_secret( filename, confdict ))
     return dochash == cred.pwhash
 
 
+class IdentityCache ( object ):
+    "user and group records by name, for a limited time; name services (LDAP, SSSD) can be slow"
+    def __init__( self, expiry ):
+        self._deltatime = datetime.timedelta( seconds=expiry )
+        self._lock = threading.Lock()
+        self._entries = {} # ( kind, name ) : ( timestamp, record or None if unknown, seconds to look up )
+        self._hits = 0
+        self._misses = 0
+        self._saved = 0.0 # seconds of lookups avoided
+        
+    def getpwnam( self, username ):
+        "like pwd.getpwnam, raises KeyError for unknown users"
+        return self._get( 'pw', username, pwd.getpwnam )
+      
+    def getgrnam( self, groupname ):
+        "like grp.getgrnam, raises KeyError for unknown groups"
+        return self._get( 'gr', groupname, grp.getgrnam )
+      
+    def clear( self ):
+        self._lock.acquire( True )
+        try:
+            self._entries = {}
+        finally:
+            self._lock.release()
+      
+    def stats( self ):
+        "returns a dictionary of hit and miss counts, and the seconds of lookups saved"
+        self._lock.acquire( True )
+        try:
+            return { 'size' : len( self._entries ), 'hits' : self._hits, 'misses' : self._misses, 'saved' : self._saved }
+        finally:
+            self._lock.release()
+        
+    def _get( self, kind, name, lookup ):
+        key = ( kind, name )
+        now = datetime.datetime.now()
+        entry = None
+        self._lock.acquire( True )
+        try:
+            entry = self._entries.get( key, None )
+            if entry and now - entry[0] < self._deltatime :
+                self._hits += 1
+                self._saved += entry[2]
+            else:
+                entry = None
+                self._misses += 1
+        finally:
+            self._lock.release()
+        
+        if entry is None :
+            # lookup outside of the lock, so that one slow name does not hold up the others:
+            start = time.time()
+            try:
+                record = lookup( name )
+            except KeyError :
+                record = None # unknown names are remembered too
+            entry = ( now, record, time.time() - start )
+            self._lock.acquire( True )
+            try:
+                self._entries[ key ] = entry
+            finally:
+                self._lock.release()
+            
+        if entry[1] is None :
+            raise KeyError( name )
+        return entry[1]
+
+
+DECISION_CACHE_LIMIT = 16384 # decisions held before they are all dropped
+
+def _build_group_index():
+    "returns a dictionary of gid to group name, and of user name to the frozenset of names of the groups listing the user as a member"
+    gidnames = {}
+    members = collections.defaultdict( set )
+    for group in grp.getgrall() :
+        gidnames[ group.gr_gid ] = group.gr_name
+        for member in group.gr_mem :
+            members[ member ].add( group.gr_name )
+    return ( gidnames, dict( ( k, frozenset( v ) ) for k, v in members.items() ) )
+
+
 class MethodPermissions ( object ):
     def __init__( self, confdict, logger ) :
-        self._authdoc = None
-        self._authlock = threading.Lock()
-        self._authdate = datetime.datetime.now()
+        # compiled permissions, and the ( device, inode, mtime, size ) of the file they came from.
+        # Replaced whole, never modified, so that verify reads them without a lock:
+        self._permissions = None
+        self._permdate = datetime.datetime.now()
+        self._permlock = threading.Lock() # held while checking the file
         self._deltatime = datetime.timedelta( seconds=confdict['DIRBSERVER_PERMISSIONS_EXPIRY'] )
         
-        self._pwall = {}
-        self._grall = None
-        self._grname = None
+        # decisions, by ( user name, method name ) : ( generation, time expires, decision ).
+        # The generation counts new permissions and group indexes, so a change to either retires every decision:
+        self._decisions = {}
+        self._decisionexpiry = confdict['DIRBSERVER_DECISION_EXPIRY']
+        self._generation = 0
+        self._decisionhits = 0
+        self._decisionmisses = 0
+        
+        self._identities = IdentityCache( confdict['DIRBSERVER_IDENTITY_EXPIRY'] )
+        self._grindex = None # ( gid : group name, user name : frozenset of group names ), replaced whole
         self._grdate = datetime.datetime.now()
+        self._grlock = threading.Lock() # held while building the index
         
         self._conf = confdict
         self._logger = logger
 
     def verify( self, username, methodname ):
-        ret = True
-        self._refresh_permdoc()
-        try:
-            self._authlock.acquire( True )
-            usergroups = self._getgroups( username )
-            if methodname in self._authdoc :
-                ret = False
-                if 'groups' in self._authdoc[ methodname ]:
-                    ret = any( x in self._authdoc[ methodname ]['groups'] for x in usergroups )
-                if not ret and 'users' in self._authdoc[ methodname ]:
-                    ret = username in self._authdoc[ methodname ][ 'users' ]
-                if not ret:
-                    self._logger.error( "Permissions denied to %s, for %s" % (username, methodname))
-        finally:
-            self._authlock.release()
-
+        permissions = self._get_permissions()[0]
+        key = ( username, methodname )
+        now = time.time()
+        entry = self._decisions.get( key, None )
+        if entry and entry[0] == self._generation and now < entry[1] :
+            self._decisionhits += 1
+            ret = entry[2]
+        else:
+            self._decisionmisses += 1
+            generation = self._generation # before the decision, so one made with a retired index is not kept
+            ret = self._decide( permissions, username, methodname )
+            if self._decisionexpiry > 0 :
+                if len( self._decisions ) >= DECISION_CACHE_LIMIT :
+                    self._decisions = {}
+                self._decisions[ key ] = ( generation, now + self._decisionexpiry, ret )
+        if not ret:
+            self._logger.error( "Permissions denied to %s, for %s" % (username, methodname))
         return ret
 
-    
-    def _refresh_permdoc( self ):
-        # read document if time has expired, or if there is no document to start
+    def _decide( self, permissions, username, methodname ):
+        permissions = permissions.get( methodname, None )
+        if permissions is None :
+            return True # free for anyone to run
+        users, groups = permissions
+        return username in users or ( bool( groups ) and not self._getgroups( username ).isdisjoint( groups ) )
+
+    def get_decision_stats( self ):
+        "returns a dictionary of the decisions held, hit and miss counts (approximate, they are not locked) and the generation"
+        return { 'size' : len( self._decisions ), 'hits' : self._decisionhits, 'misses' : self._decisionmisses, 'generation' : self._generation }
+
+    def _get_permissions( self ):
+        # the permissions file is checked once per expiry period, by one thread, and only read if it has changed.
+        # The others carry on with the previous permissions until the new ones are swapped in.
         # ideally the document has restrictive permissions or the whole thing is moot.
         now = datetime.datetime.now()
-        elapsed = now - self._deltatime
-        if ( not self._authdoc ) or ( now - self._authdate > self._deltatime ):
-            self._authlock.acquire( True )
-            self._authdoc = {}
-            try:
-                self._authdoc = read_method_permissions( self._conf )
-            except:
-                self._logger.error( "Fail to read method permissions file (%s)" % _make_method_permission_filename( self._conf ))
-            finally:
-                self._authlock.release()
-            self._authdate = now
+        snapshot = self._permissions
+        if snapshot is not None and now - self._permdate <= self._deltatime :
+            return snapshot
+        if not self._permlock.acquire( snapshot is None ): # without permissions, wait for them
+            return snapshot
+        try:
+            if self._permissions is not snapshot : # read while we waited
+                return self._permissions
+            self._permissions = self._read_permissions( snapshot )
+            self._permdate = now
+            if self._permissions is not snapshot :
+                self._generation += 1
+            return self._permissions
+        finally:
+            self._permlock.release()
+
+    def _read_permissions( self, snapshot ):
+        filename = _make_method_permission_filename( self._conf )
+        try:
+            st = os.stat( filename )
+        except OSError :
+            self._logger.error( "Fail to read method permissions file (%s)" % filename )
+            return ( {}, None ) # no file, so every method is free to run
+        key = ( st.st_dev, st.st_ino, st.st_mtime, st.st_size )
+        if snapshot is not None and snapshot[1] == key :
+            return snapshot # unchanged
+        try:
+            return ( compile_method_permissions( read_method_permissions( self._conf ) ), key )
+        except:
+            self._logger.error( "Fail to read method permissions file (%s)" % filename )
+            if snapshot is not None and snapshot[1] is not None :
+                return snapshot # keep the last good permissions, perhaps the file is half written
+            return ( {}, None )
 
-        
     def _getgroups( self, username ):
         # get all the groups this person of which this person is a member
-        # primary group for user:
+        gidnames, members = self._get_group_index()
+        usergroups = members.get( username, frozenset() )
         
-        # performance is dependent upon caching group associations.  Sad face.
+        # primary group for user:
+        primary = gidnames.get( self._identities.getpwnam( username ).pw_gid, None )
+        if primary is not None and primary not in usergroups :
+            usergroups = usergroups | frozenset( [ primary ] )
+        return usergroups
+
+    def _get_group_index( self ):
+        # the group database is read once per expiry period, by one thread;
+        # the others carry on with the previous index until the new one is swapped in.
         now = datetime.datetime.now()
-        if any( not x for x in (self._grname,self._grall,self._pwall)) or ( now - self._grdate > self._deltatime ):
-            self._pwall = {} # each key-value loaded on demand
-            self._grall = grp.getgrall()
-            self._grname = dict(( x.gr_gid, x.gr_name ) for x in self._grall)
+        index = self._grindex
+        if index is not None and now - self._grdate <= self._deltatime :
+            return index
+        if not self._grlock.acquire( index is None ): # without an index, wait for it
+            return index
+        try:
+            if self._grindex is not index : # built while we waited
+                return self._grindex
+            self._grindex = _build_group_index()
             self._grdate = now
-        
-        if username not in self._pwall :
-            self._pwall[ username ] = pwd.getpwnam( username )
-        usergroups = [ self._pwall[ username ].pw_gid ]
-            
-        # secondary groups for user:
-        other_groups = [group.gr_gid for group in self._grall if username in group.gr_mem]
-        usergroups.extend(other_groups)
-            
-        # convert from gid to group names
-        return set(self._grname[x] for x in usergroups)
-
+            self._generation += 1
+            return self._grindex
+        finally:
+            self._grlock.release()
 
     def get_ids( self, username ):
         "returns uid and gid for the given user"
-        if username not in self._pwall :
-            self._pwall[ username ] = pwd.getpwnam( username )
-        return( self._pwall[ username ].pw_uid, self._pwall[ username ].pw_gid )
\ No newline at end of file
+        record = self._identities.getpwnam( username )
+        return( record.pw_uid, record.pw_gid )
+
+    def get_uid( self, username ):
+        "returns the uid for the given user name, raises KeyError for unknown users"
+        return self._identities.getpwnam( username ).pw_uid
+
+    def get_gid( self, groupname ):
+        "returns the gid for the given group name, raises KeyError for unknown groups"
+        return self._identities.getgrnam( groupname ).gr_gid
+
+    def get_identity_stats( self ):
+        return self._identities.stats()
\ No newline at end of file
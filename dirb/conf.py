@@ -28,6 +28,13 @@ import os
 __default = {}
 __default['DIRB_AUTHPATH'] = os.environ.get( 'DIRB_AUTHPATH', None )
 __default['DIRB_SERVERS'] = [s.strip() for s in os.environ.get( 'DIRB_SERVERS', "" ).split(',')]
+__default['DIRB_CONNECTION_IDLE_TIMEOUT'] = float(os.environ.get( 'DIRB_CONNECTION_IDLE_TIMEOUT', 30 )) # seconds an idle connection is kept for reuse
+__default['DIRB_NONCE_BATCH'] = int(os.environ.get( 'DIRB_NONCE_BATCH', 16 )) # server nonces prefetched per request, 1 disables prefetching
+__default['DIRB_RPC_TIMEOUT'] = float(os.environ.get( 'DIRB_RPC_TIMEOUT', 300 )) # seconds each server may block on its socket, in a call to all servers; 0 for no limit
+__default['DIRB_GZIP_THRESHOLD'] = int(os.environ.get( 'DIRB_GZIP_THRESHOLD', 0 )) # bytes, larger requests are gzip encoded, 0 disables; servers older than gzip support cannot decode them
+__default['DIRB_SERVER_BACKOFF'] = float(os.environ.get( 'DIRB_SERVER_BACKOFF', 5 )) # seconds before a failed server is probed again, doubling while it keeps failing
+__default['DIRB_AUTH_RECHECK'] = float(os.environ.get( 'DIRB_AUTH_RECHECK', 10 )) # seconds a user's secret file is trusted before checking it has not changed
+__default['DIRB_SESSIONS'] = int(os.environ.get( 'DIRB_SESSIONS', 0 )) # 1 authenticates with a session token per server, rather than a nonce handshake per call
 
 
 #######################################
@@ -39,6 +46,18 @@ __default['DIRB_SERVERS'] = [s.strip() for s in os.environ.get( 'DIRB_SERVERS',
 
 __default_server = __default.copy()
 __default_server[ 'DIRBSERVER_PERMISSIONS_EXPIRY' ] = int(os.environ.get( 'DIRBSERVER_PERMISSIONS_EXPIRY', 60 * 15 )) # 15 minutes
+__default_server[ 'DIRBSERVER_IDENTITY_EXPIRY' ] = int(os.environ.get( 'DIRBSERVER_IDENTITY_EXPIRY', 60 * 5 )) # 5 minutes, user and group lookups
+__default_server[ 'DIRBSERVER_DECISION_EXPIRY' ] = int(os.environ.get( 'DIRBSERVER_DECISION_EXPIRY', 60 )) # seconds a user's permission for a method is remembered, 0 disables
+__default_server[ 'DIRBSERVER_SESSION_EXPIRY' ] = int(os.environ.get( 'DIRBSERVER_SESSION_EXPIRY', 60 * 5 )) # seconds a session token lasts, 0 disables sessions
+__default_server[ 'DIRBSERVER_SESSION_SECRET' ] = os.environ.get( 'DIRBSERVER_SESSION_SECRET', '' ) # signs session tokens, random at startup if empty
+__default_server[ 'DIRBSERVER_SCHEMA_CACHE_SIZE' ] = int(os.environ.get( 'DIRBSERVER_SCHEMA_CACHE_SIZE', 16 )) # compiled documents remembered by digest
+__default_server[ 'DIRBSERVER_CLIENT_CACHE_SIZE' ] = int(os.environ.get( 'DIRBSERVER_CLIENT_CACHE_SIZE', 64 )) # local clients remembered by digest and root
+__default_server[ 'DIRBSERVER_CREATE_WORKERS' ] = int(os.environ.get( 'DIRBSERVER_CREATE_WORKERS', 8 )) # threads creating directories of the same depth
+__default_server[ 'DIRBSERVER_MAX_CREATE_PATHS' ] = int(os.environ.get( 'DIRBSERVER_MAX_CREATE_PATHS', 100000 )) # estimated paths per creation call, 0 for no limit
+__default_server[ 'DIRBSERVER_THREADS' ] = int(os.environ.get( 'DIRBSERVER_THREADS', 16 )) # threads serving connections, in each worker process
+__default_server[ 'DIRBSERVER_WORKERS' ] = int(os.environ.get( 'DIRBSERVER_WORKERS', 0 )) # pre-forked worker processes, 0 serves from the runner's own process
+__default_server[ 'DIRBSERVER_KEEPALIVE_TIMEOUT' ] = float(os.environ.get( 'DIRBSERVER_KEEPALIVE_TIMEOUT', 15 )) # seconds an idle client connection is held open
+__default_server[ 'DIRBSERVER_MAX_REQUEST_SIZE' ] = int(os.environ.get( 'DIRBSERVER_MAX_REQUEST_SIZE', 64 * 1024 * 1024 )) # bytes, before or after decoding, 0 for no limit
 
 #######################################
 #
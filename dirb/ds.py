@@ -28,6 +28,10 @@ import collections
 import itertools
 import os
 import glob
+import re
+import string
+import json
+import hashlib
 
 
 
@@ -151,6 +155,10 @@ class BaseLevel(object):
   def get_directories( self, levelctx, levelfields, searcher, ctxlist, client ):
     return []
   
+  def count_directories( self, levelctx, levelfields, searcher, count, client ): # used during estimates
+    "returns the number of directories get_directories() would give for count contexts, and the number of contexts visited in branched rules"
+    return 0, 0
+  
   def get_bookmarks( self, levelfields, doc ): # used during compile
     return set(levelfields['bookmarks'] if 'bookmarks' in levelfields else [])
   
@@ -162,9 +170,25 @@ class BaseLevel(object):
   def get_parameters( self, levelfields, doc ): # used during compile
     return []
   
+  def get_collections( self, levelfields, doc ): # used during compile
+    "returns a dictionary relating each parameter of this level to its collection name (or None)"
+    return {}
+  
+  def get_branches( self, levelfields, doc ): # used during compile
+    "returns the names of the rules this level redirects to, or None when the level is not a branch"
+    return None
+  
+  def get_pattern( self, levelfields, doc ): # used during compile
+    "returns a regular expression (without capturing groups) matching the directory names of this level"
+    return None
+  
   def parse_level( self, levelfields, basename, client ) : # used during traversal
     "returns a dictionary of key,values for the parameters, and a dictionary giving the parameter-collection relations"
     return {}, {}
+  
+  def format_level( self, levelfields, parameters, client ) : # used during bookmark resolution
+    "returns the directory name for this level given a dictionary of parameter values, or None if parameters are missing"
+    return None
 
 
 @register_level
@@ -178,8 +202,17 @@ class FixedLevel(BaseLevel) :
       candidates = [(x, y) for x, y in candidates if os.path.isdir(y)]
     return candidates
     
+  def count_directories( self, levelctx, levelfields, searcher, count, client ):
+    return count, 0
+    
   def get_parameters( self, levelfields, doc ): # used during compile
     return set()
+  
+  def format_level( self, levelfields, parameters, client ) : # used during bookmark resolution
+    return levelfields['name']
+  
+  def get_pattern( self, levelfields, doc ): # used during compile
+    return re.escape( levelfields['name'] )
 
 
 @register_level
@@ -194,6 +227,9 @@ class BranchLevel(BaseLevel) :
       _traverse( searcher, rule, ctx, client ) # indirect recursion
     return None
   
+  def count_directories( self, levelctx, levelfields, searcher, count, client ):
+    return 0, sum( _estimate( searcher, client.get_rule( x ), count, client ) for x in levelfields['rules'] )
+  
   def get_bookmarks( self, levelfields, doc ):
     bookmarks = set()
     rulenames = levelfields['rules']
@@ -217,6 +253,9 @@ class BranchLevel(BaseLevel) :
       rule = doc['rules'][ rulename ]
       parameters |= get_rule_parameters(rule,doc)
     return parameters
+  
+  def get_branches( self, levelfields, doc ):
+    return list( levelfields['rules'] )
 
 
 
@@ -260,12 +299,27 @@ class ParameterizedLevel(BaseLevel) :
           
     return dirlist 
   
+  def count_directories( self, levelctx, levelfields, searcher, count, client ):
+    search_param = searcher.get_parameters( levelfields['key'], levelctx, [] ) if 'key' in levelfields else None
+    return count * len( set( x for x in search_param if x )) if search_param else 0, 0
+  
   def get_parameters( self, levelfields, doc ): # used during compile
     ret = []
     if 'key' in levelfields:
       ret = set([levelfields['key']])
     return ret
   
+  def get_collections( self, levelfields, doc ): # used during compile
+    ret = {}
+    if 'key' in levelfields:
+      ret[ levelfields['key'] ] = levelfields.get( 'collection', None )
+    return ret
+  
+  def get_pattern( self, levelfields, doc ): # used during compile
+    if 'collection' in levelfields:
+      return _get_collection_pattern( doc['collections'][ levelfields['collection'] ] )
+    return '[^/]+'
+  
   def parse_level( self, levelfields, basename, client ) : # used during traversal
     params = {}
     coll = {}
@@ -274,6 +328,15 @@ class ParameterizedLevel(BaseLevel) :
       if 'collection' in levelfields:
         coll[ levelfields['key'] ]  = levelfields['collection']
     return params, coll
+  
+  def format_level( self, levelfields, parameters, client ) : # used during bookmark resolution
+    if 'key' not in levelfields or not parameters.get( levelfields['key'] ):
+      return None
+    value = parameters[ levelfields['key'] ]
+    if 'collection' in levelfields:
+      if value not in client.get_collection( levelfields['collection'] ):
+        raise KeyError( "Collection '%s' does not contain '%s'" % (levelfields['collection'], value))
+    return value
 
 
 @register_level
@@ -360,17 +423,50 @@ class FormattedLevel(BaseLevel) :
           
     return dirlist 
   
+  def count_directories( self, levelctx, levelfields, searcher, count, client ):
+    for k in levelfields.get( 'keys', [] ):
+      search_param = searcher.get_parameters( k, levelctx, [] )
+      count *= len( set( x for x in search_param if x )) if search_param else 0
+    return count, 0
+  
   def get_parameters( self, levelfields, doc ): # used during compile
     ret = []
     if 'keys' in levelfields:
       ret = set(levelfields['keys'])
     return ret
   
+  def get_collections( self, levelfields, doc ): # used during compile
+    collections = levelfields.get( 'collections', {} )
+    return dict( (k, collections.get( k, None )) for k in levelfields.get( 'keys', [] ) )
+  
+  def get_pattern( self, levelfields, doc ): # used during compile
+    # format specifications (such as {:d}) are not enforced by the pattern, any characters will match.
+    levelkeys = levelfields.get( 'keys', [] )
+    collections = levelfields.get( 'collections', {} )
+    ret = []
+    position = 0
+    for literal, field, spec, conversion in string.Formatter().parse( levelfields.get( 'format', '{}' ) ):
+      ret.append( re.escape( literal ) )
+      if field is None:
+        continue
+      if field == '' :
+        key = levelkeys[position] if position < len(levelkeys) else None
+        position += 1
+      else:
+        key = field
+      if key in collections:
+        ret.append( _get_collection_pattern( doc['collections'][ collections[key] ] ))
+      else:
+        ret.append( '[^/]+?' )
+    return ''.join( ret )
+  
   def parse_level( self, levelfields, basename, client ) : # used during traversal
     params = {}
     coll = {}
     if 'keys' in levelfields and 'format' in levelfields:
       match = parse.parse( levelfields['format'], basename )
+      if match is None:
+        return params, coll
       params = self._parse_parameters( match.fixed, match.named, levelfields.get('keys',[]), levelfields.get('collections',{}), client, False )
       if 'collections' in levelfields:
         for key in params:
@@ -378,6 +474,16 @@ class FormattedLevel(BaseLevel) :
             coll[ key ] = levelfields['collections'][key]
     return params, coll    
   
+  def format_level( self, levelfields, parameters, client ) : # used during bookmark resolution
+    levelkeys = levelfields.get( 'keys', [] )
+    if not all( parameters.get( k ) for k in levelkeys ):
+      return None
+    collections = levelfields.get( 'collections', {} )
+    for k in levelkeys:
+      if k in collections and parameters[k] not in client.get_collection( collections[k] ):
+        raise KeyError( "Collection '%s' does not contain %s in formatted level" % (collections[k], parameters[k]))
+    return levelfields.get( 'format', '{}' ).format( *[parameters[k] for k in levelkeys] )
+  
 # -----------
 
 def get_rule_bookmarks( levellist, doc ) : # used during compile
@@ -404,6 +510,72 @@ def get_rule_parameters( levellist, doc ): # used during compile
     ret |= FnLevel[leveltype].get_parameters( levelfields, doc)
   return ret  
 
+def _get_collection_pattern( coll ):
+  return '(?:%s)' % '|'.join( re.escape( x ) for x in coll )
+
+def get_rule_chains( rulename, doc, chain=() ): # used during compile
+  """returns every chain of levels reachable from the given rule, in traversal order.
+  Each chain is a tuple of (rulename, levelindex) pairs, starting from the given rule."""
+  ret = []
+  for index, level in enumerate( doc['rules'][rulename] ):
+    leveltype = level[0]
+    levelfields = level[1]
+    branches = FnLevel[leveltype].get_branches( levelfields, doc )
+    if branches is not None :
+      for branchname in branches :
+        ret.extend( get_rule_chains( branchname, doc, chain ) ) # indirect recursion
+      break # traversal does not continue past a branch
+    chain = chain + ((rulename, index),)
+    ret.append( chain )
+  return ret
+
+def get_bookmark_table( chains, doc ): # used during compile
+  """returns a dictionary where the key is a bookmark and the value is the list 
+  of alternative parameter dictionaries, as returned by LocalClient.get_bookmark_parameters()"""
+  ret = {}
+  for chain in chains:
+    rulename, index = chain[-1]
+    leveltype, levelfields = doc['rules'][rulename][index]
+    bookmarks = FnLevel[leveltype].get_bookmarks( levelfields, doc )
+    if bookmarks :
+      parameters = {}
+      for rulename, index in chain:
+        leveltype, levelfields = doc['rules'][rulename][index]
+        parameters.update( FnLevel[leveltype].get_collections( levelfields, doc ) )
+      for bookmark in bookmarks:
+        if bookmark not in ret:
+          ret[bookmark] = []
+        ret[bookmark].append( dict( parameters ) )
+  return ret
+
+def get_bookmark_chains( chains, doc ): # used during compile
+  """returns a dictionary where the key is a bookmark and the value is the list 
+  of chains leading to it, in the same order as get_bookmark_table()"""
+  ret = {}
+  for chain in chains:
+    rulename, index = chain[-1]
+    leveltype, levelfields = doc['rules'][rulename][index]
+    for bookmark in FnLevel[leveltype].get_bookmarks( levelfields, doc ):
+      if bookmark not in ret:
+        ret[bookmark] = []
+      ret[bookmark].append( [ list(x) for x in chain ] )
+  return ret
+
+def get_path_index( chains, doc ): # used during compile
+  """returns a dictionary with a regular expression, matching relative paths (separated by '/'),
+  which combines every chain as an alternative group named 'a<index>', and the list of chains.
+  Deeper chains are listed first, so that the deepest match wins; any path may continue past its chain."""
+  chains = sorted( chains, key=lambda x : -len(x) ) # stable sort keeps the search order
+  alternatives = []
+  for index, chain in enumerate( chains ):
+    patterns = []
+    for rulename, levelindex in chain:
+      leveltype, levelfields = doc['rules'][rulename][levelindex]
+      patterns.append( FnLevel[leveltype].get_pattern( levelfields, doc ) )
+    alternatives.append( '(?P<a%d>%s)' % ( index, '/'.join( patterns ) ) )
+  pattern = '(?:%s)(?:/.*)?\\Z' % '|'.join( alternatives ) if alternatives else '(?!)'
+  return { 'pattern' : pattern, 'chains' : [ [ list(x) for x in chain ] for chain in chains ] }
+
 
 
 
@@ -413,6 +585,61 @@ LevelTraversalContext = collections.namedtuple( "LevelTraversalContext", ( "book
 
 
 
+def _make_level_context( levelfields ):
+  "creates the context for the elements of the current level only"
+  levelbookmarks = levelfields['bookmarks'] if 'bookmarks' in levelfields else []
+  leveltreeattr = levelfields['treeattributes'] if 'treeattributes' in levelfields else {}
+  levellocalattr = levelfields['localattributes'] if 'localattributes' in levelfields else {}
+  levelparameters = (levelfields['key'],) if 'key' in levelfields else None
+  levelparameters = levelfields['keys'] if 'keys' in levelfields else levelparameters
+  levelcollections = {levelfields.get('key', '' ) : levelfields['collection']} if 'collection' in levelfields else None
+  levelcollections = levelfields['collections'] if 'collections' in levelfields else levelcollections
+  leveluser = levelfields['user'] if 'user' in levelfields else None
+  levelgroup = levelfields['group'] if 'group' in levelfields else None
+  levelpermissions = levelfields['permissions'] if 'permissions' in levelfields else None
+  
+  return LevelTraversalContext( levelbookmarks, leveltreeattr, levellocalattr, levelparameters, levelcollections, leveluser, levelgroup, levelpermissions )
+
+
+def _make_path_contexts( fn, levelfields, levelctx, ictx, dirname, client ):
+  "returns the context for dirname as seen at its own level, and the context that its children see & modify"
+  treeattr = ictx.attributes.copy() # shallow
+  if 'treeattributes' in levelfields:
+    treeattr.update( levelctx.treeattributes )
+    
+  localattr = treeattr.copy() # shallow
+  if 'localattributes' in levelfields:
+    localattr.update( levelctx.localattributes )
+    
+  parameters = ictx.parameters.copy() # shallow
+  collections = ictx.collections.copy() # shallow
+  if levelctx.parameters :
+    basename = os.path.basename( dirname )
+    
+    newparams, newcollections = fn.parse_level( levelfields, basename, client )
+    parameters.update( newparams )
+    collections.update( newcollections )
+    
+  user = attrexpr.eval_attribute_expr( levelctx.user, localattr, parameters ) if levelctx.user else ictx.user
+  group = attrexpr.eval_attribute_expr( levelctx.group, localattr, parameters ) if levelctx.group else ictx.group
+  permissions = ugoexpr.eval_ugo_expr( levelctx.permissions ) if levelctx.permissions else ictx.permissions
+  
+  localctx = PathTraversalContext( levelctx.bookmarks, localattr, parameters, dirname, collections, user, group, permissions )
+  childctx = PathTraversalContext( levelctx.bookmarks, treeattr, parameters, dirname, collections, user, group, permissions )
+  return localctx, childctx
+
+
+def _follow_chain( levels, basenames, ctx, client ):
+  "returns the path context at the end of a chain of levels, given the directory name at each level"
+  localctx = ctx
+  for level, basename in zip( levels, basenames ):
+    leveltype = level[0]
+    levelfields = level[1]
+    levelctx = _make_level_context( levelfields )
+    localctx, ctx = _make_path_contexts( FnLevel[leveltype], levelfields, levelctx, ctx, os.path.join( ctx.path, basename ), client )
+  return localctx
+
+
 def _traverse( searcher, rule, ctx, client ):
   if searcher.does_intersect_rule( RuleTraversalContext( rule['bookmarks'], rule['attributes'], rule['parameters'] ) ):
     
@@ -420,18 +647,7 @@ def _traverse( searcher, rule, ctx, client ):
     for leveltype, levelfields in rule[ 'levels' ]:
       
       # create new level context:
-      levelbookmarks = levelfields['bookmarks'] if 'bookmarks' in levelfields else []
-      leveltreeattr = levelfields['treeattributes'] if 'treeattributes' in levelfields else {}
-      levellocalattr = levelfields['localattributes'] if 'localattributes' in levelfields else {}
-      levelparameters = (levelfields['key'],) if 'key' in levelfields else None
-      levelparameters = levelfields['keys'] if 'keys' in levelfields else levelparameters
-      levelcollections = {levelfields.get('key', '' ) : levelfields['collection']} if 'collection' in levelfields else None
-      levelcollections = levelfields['collections'] if 'collections' in levelfields else levelcollections
-      leveluser = levelfields['user'] if 'user' in levelfields else None
-      levelgroup = levelfields['group'] if 'group' in levelfields else None
-      levelpermissions = levelfields['permissions'] if 'permissions' in levelfields else None
-      
-      levelctx = LevelTraversalContext( levelbookmarks, leveltreeattr, levellocalattr, levelparameters, levelcollections, leveluser, levelgroup, levelpermissions )
+      levelctx = _make_level_context( levelfields )
       
       # get directories for this level
       fn = FnLevel[ leveltype ]
@@ -442,34 +658,11 @@ def _traverse( searcher, rule, ctx, client ):
       
       passedlist = []
       for ictx, dirname in ruletuples: # breadth-first search with pruning
-
-        treeattr = ictx.attributes.copy() # shallow
-        if 'treeattributes' in levelfields:
-          treeattr.update( leveltreeattr )
-          
-        localattr = treeattr.copy() # shallow
-        if 'localattributes' in levelfields:
-          localattr.update( levellocalattr )
-          
-        parameters = ictx.parameters.copy() # shallow
-        collections = ictx.collections.copy() # shallow
-        if levelparameters :
-          basename = os.path.basename( dirname )
-          
-          newparams, newcollections = fn.parse_level( levelfields, basename, client )
-          parameters.update( newparams )
-          collections.update( newcollections )
-          
-        user = attrexpr.eval_attribute_expr( leveluser, localattr, parameters ) if leveluser else ictx.user
-        group = attrexpr.eval_attribute_expr( levelgroup, localattr, parameters ) if levelgroup else ictx.group
-        permissions = ugoexpr.eval_ugo_expr( levelpermissions ) if levelpermissions else ictx.permissions
-        
-        newctx = PathTraversalContext( levelbookmarks, localattr, parameters, dirname, collections, user, group, permissions )
+        newctx, childctx = _make_path_contexts( fn, levelfields, levelctx, ictx, dirname, client )
         test = searcher.does_intersect_path( newctx )
         if test:
           searcher.test( newctx, levelctx )
-          newctx = PathTraversalContext( levelbookmarks, treeattr, parameters, dirname, collections, user, group, permissions ) # context that the children see & modify
-          passedlist.append( newctx )
+          passedlist.append( childctx )
           
       pathlist = passedlist
 
@@ -493,9 +686,23 @@ Directory level types:
      if there is an collection attribute, then the values are restricted.
      """
 
+def _estimate( searcher, rule, count, client ):
+  """returns the number of path contexts a traversal of the rule would visit from count contexts,
+  without touching the file system.  This is an upper bound: searchers may prune some of them."""
+  total = 0
+  if searcher.does_intersect_rule( RuleTraversalContext( rule['bookmarks'], rule['attributes'], rule['parameters'] ) ):
+    for leveltype, levelfields in rule[ 'levels' ]:
+      levelctx = _make_level_context( levelfields )
+      count, branched = FnLevel[ leveltype ].count_directories( levelctx, levelfields, searcher, count, client )
+      total += count + branched
+      if not count:
+        break # end for
+  return total
+
+  
 def compile_dir_structure( doc ):
     "returns a compiled version of the input document"
-    ret ={ 'globals': {}, 'collections':{}, 'rules':{} }
+    ret ={ 'globals': {}, 'collections':{}, 'rules':{}, 'bookmarks':{}, 'bookmarkchains':{}, 'pathindex': get_path_index( [], doc ) }
     # copy globals:
     if 'globals' in doc:
       ret['globals'] = copy.deepcopy( doc['globals'] )
@@ -515,6 +722,18 @@ def compile_dir_structure( doc ):
           'parameters' : tuple(get_rule_parameters(levellist, doc)),
           'attributes' : tuple(get_rule_attributes(levellist, doc))
           }
+      # precompute bookmark parameterizations, so that introspection does not need a traversal:
+      if 'ROOT' in doc['rules']:
+        chains = get_rule_chains( 'ROOT', doc )
+        ret['bookmarks'] = get_bookmark_table( chains, doc )
+        ret['bookmarkchains'] = get_bookmark_chains( chains, doc )
+        ret['pathindex'] = get_path_index( chains, doc )
     return ret
 
+def get_compiled_digest( compileddoc ):
+    """returns a hex digest identifying the content of a compiled document.
+    The digest survives marshaling (e.g. tuples becoming lists over XML-RPC)."""
+    text = json.dumps( compileddoc, sort_keys=True, separators=(',',':') )
+    return hashlib.sha256( text.encode( 'utf-8' ) ).hexdigest()
+
 # -----------
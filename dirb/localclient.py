@@ -19,6 +19,10 @@
 from . import pathexpr
 from . import ds
 from . import fs
+from . import sexpr
+
+import os
+import re
 
 # a compiledrule is a dictionary with fields:
 #    "bookmarks": set of bookmarks (under it)
@@ -27,6 +31,19 @@ from . import fs
 #    "levels" : tuples of tuples, (( "leveltype", {<levelfields>}),( "leveltype", {<levelfields>}),etc)
 #    as traversal occurs, the bookmarks, parameter, attributes move from rules to the contexts as they resolve.
 #
+# a compiled document also has a "bookmarks" dictionary:
+#    the key is the bookmark name, the value is the list of alternative parameter dictionaries
+#    (parameter name to collection name, or None), precomputed so that introspection needs no traversal.
+#    Documents compiled before this table existed fall back to a synthetic traversal.
+# and a "bookmarkchains" dictionary:
+#    the key is the bookmark name, the value is the list of level chains leading to the bookmark,
+#    in the same order as the "bookmarks" table.  Each chain is a list of [rulename, levelindex] pairs,
+#    which act as path templates for resolve_bookmark().
+# and a "pathindex" dictionary:
+#    "pattern" is a regular expression combining every chain of levels as a named alternative,
+#    "chains" is the list of chains, where alternative 'a<index>' matches chains[index].
+#    match_path() uses it to parse paths with a single match.
+#
 
 #
 # A searcher has :
@@ -43,6 +60,7 @@ class LocalClient( object ) :
   def __init__(self, compileddoc, startingpath ):
     self._doc = compileddoc
     self._root = startingpath
+    self._pathregex = None # compiled on demand from the path index
 
   def get_rule_names( self ):
     "Returns all the names of rules in the schema document"
@@ -75,12 +93,20 @@ class LocalClient( object ) :
   
   def get_bookmark_names( self ) :
     "Returns all the names of bookmarks in the schema document"
+    if 'bookmarks' in self._doc :
+      return tuple( self._doc['bookmarks'].keys() )
     return self._doc['rules']['ROOT']['bookmarks']
   
   def get_bookmark_parameters( self, bookmark ):
     """Returns the parameters required to find the bookmark, a list of dictionaries.  
     Each dictionary is an alternative set of parameters required to find the bookmark.
     The key is the parameter name and the value determines which, if any, collection the parameter is associated with."""
+    if 'bookmarks' in self._doc :
+      return [ dict(x) for x in self._doc['bookmarks'].get( bookmark, [] ) ]
+    return self._get_bookmark_parameters_traversal( bookmark )
+
+  def _get_bookmark_parameters_traversal( self, bookmark ):
+    # for documents compiled without a bookmark table:
     class SearcherBookmarks( object ):
       def __init__( self, dirstructure ) :
         self._store = []
@@ -107,6 +133,31 @@ class LocalClient( object ) :
     ds._traverse( searcher, rule, ctx, self )  
     return searcher._store
   
+  def resolve_bookmark( self, bookmark, parameters, existing=False ):
+    """Returns a list of PathTraversalContext objects for the given bookmark, 
+    one for each alternative location whose parameters are all given in the parameters dictionary.
+    Extra parameters are ignored.  The path is formatted directly from the schema, without a traversal.
+    If existing is true, only paths that exist on the file system are returned.
+    See also get_bookmark_parameters()"""
+    if 'bookmarkchains' not in self._doc :
+      return self._resolve_bookmark_traversal( bookmark, parameters, existing )
+    ret = []
+    for chain in self._doc['bookmarkchains'].get( bookmark, [] ):
+      levels = [ self._doc['rules'][rulename]['levels'][index] for rulename, index in chain ]
+      basenames = [ ds.FnLevel[ level[0] ].format_level( level[1], parameters, self ) for level in levels ]
+      if all( basenames ):
+        ctx = ds.PathTraversalContext( [], {}, {}, self._root, {}, None, None, None )
+        pathctx = ds._follow_chain( levels, basenames, ctx, self )
+        if ( not existing ) or os.path.isdir( pathctx.path ):
+          ret.append( pathctx )
+    return ret
+
+  def _resolve_bookmark_traversal( self, bookmark, parameters, existing ):
+    # for documents compiled without bookmark chains:
+    expr = sexpr.dumps( ['and', ['bookmark', bookmark], ['parameters'] + [ [k, parameters[k]] for k in parameters ]] )
+    found = self.search_paths( expr ) if existing else self.depict_paths( expr )
+    return [ x for x in found if bookmark in x.bookmarks and all( parameters.get(k) == v for k, v in x.parameters.items() ) ]
+
   def search_paths( self, searchexpr ):
     """Primary interface for searching directory structures.
     Returns a list of PathTraveralContext objects that match
@@ -131,6 +182,26 @@ class LocalClient( object ) :
     ds._traverse( searcher, rule, ctx, self )  
     return searcher._store
   
+  def depict_paths_batch( self, createexprs ):
+    """Returns a list of lists of PathTraversalContext objects, 
+    one list for each of the given creation expressions, in order.
+    The expressions are depicted together in a single traversal.
+    See also depict_paths()"""
+    searcher = pathexpr.SearcherNotExistsMulti( self, createexprs )
+    ctx = ds.PathTraversalContext( [], {}, {}, self._root, {}, None, None, None )
+    rule = self._doc[ 'rules' ][ 'ROOT' ]
+    ds._traverse( searcher, rule, ctx, self )  
+    return searcher._store
+  
+  def estimate_depict_paths( self, createexpr ):
+    """Returns the number of path contexts that depict_paths() would visit 
+    for the given creation expression, without producing them.
+    This is an upper bound on the length of the list that depict_paths() returns,
+    and the values of parameters are not checked against their collections."""
+    searcher = pathexpr.SearcherNotExists( self, createexpr )
+    rule = self._doc[ 'rules' ][ 'ROOT' ]
+    return ds._estimate( searcher, rule, 1, self )
+  
   def get_path_context( self, targetpath ):
     """Returns the path traversal context for the given path. 
     Path may be real or depicted.  Will reject invalid paths. 
@@ -185,6 +256,33 @@ class LocalClient( object ) :
         ret = searcher._store[key][0]
     return ret
 
+  def match_path( self, targetpath ):
+    """Returns the path traversal context for the given path, like get_path_context(),
+    but finds the matching chain of levels with a single regular expression match 
+    on the compiled path index, rather than a traversal.
+    Will accept paths deeper than what the structure knows about, giving the deepest context it can.
+    Parameter values outside of their collection do not match, giving a shallower context."""
+    if 'pathindex' not in self._doc :
+      return self.get_path_context( targetpath )
+    if self._pathregex is None :
+      self._pathregex = re.compile( self._doc['pathindex']['pattern'] )
+    
+    ctx = ds.PathTraversalContext( [], {}, {}, self._root, {}, None, None, None )
+    rootparts = [ x for x in fs.split_path( self._root ) if x ]
+    targetparts = [ x for x in fs.split_path( targetpath ) if x ]
+    if targetparts[:len(rootparts)] != rootparts :
+      return None
+    relparts = targetparts[len(rootparts):]
+    if not relparts :
+      return ctx
+    
+    match = self._pathregex.match( '/'.join( relparts ) )
+    if match is None :
+      return None
+    chain = self._doc['pathindex']['chains'][ int( match.lastgroup[1:] ) ]
+    levels = [ self._doc['rules'][rulename]['levels'][index] for rulename, index in chain ]
+    return ds._follow_chain( levels, relparts[:len(levels)], ctx, self )
+
   def get_frontier_contexts( self, targetpath ):
     """Given an existing path, returns the 'next' parameter to be defined, 
     as well as the paths to which that parameter leads.
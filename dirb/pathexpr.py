@@ -347,3 +347,35 @@ class SearcherNotExists( object ):
     return False
   def get_parameters( self, key, levelctx, pathctxlist ):
     return self._parameters[key] if key in self._parameters else None
+
+
+class SearcherNotExistsMulti( object ):
+  "depicts several creation expressions in one traversal, keeping the matches of each expression apart"
+  def __init__( self, ds, exprs ) :
+    self._ds = ds
+    self._searchers = [ SearcherNotExists( ds, x ) for x in exprs ]
+    self._store = [ x._store for x in self._searchers ]
+    self._active = self._searchers
+  def _accepts( self, searcher, pathctx ):
+    # parameter values offered by the other expressions are not part of this one:
+    params = searcher._parameters
+    if any( key not in params or value not in params[key] for key, value in pathctx.parameters.items() ):
+      return False
+    return searcher.does_intersect_path( pathctx )
+  def does_intersect_rule( self, rulectx ):
+    # a branch is always the last level of a rule, so the rule last entered
+    # is the rule being traversed until the next one is entered:
+    self._active = [ x for x in self._searchers if x.does_intersect_rule( rulectx ) ]
+    return bool( self._active )
+  def does_intersect_path( self, pathctx ):
+    return any( self._accepts( x, pathctx ) for x in self._active )
+  def test( self, pathctx, levelctx ):
+    for searcher in self._active :
+      if self._accepts( searcher, pathctx ):
+        searcher.test( pathctx, levelctx )
+  def do_existing_paths( self ) :
+    return False
+  def get_parameters( self, key, levelctx, pathctxlist ):
+    values = [ x.get_parameters( key, levelctx, pathctxlist ) for x in self._active ]
+    values = [ x for x in values if x is not None ]
+    return sorted( set( itertools.chain( *values ))) if values else None
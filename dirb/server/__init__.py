@@ -20,6 +20,11 @@ try: # version-proof
     import xmlrpclib as xmlrpc_lib
 except ImportError :
     import xmlrpc.client as xmlrpc_lib
+
+try: # version-proof
+    from collections.abc import Sequence
+except ImportError :
+    from collections import Sequence
     
 # -------------------------------------------------------------------    
 
@@ -32,8 +37,7 @@ from .. import ds
 # -------------------------------------------------------------------    
 
 import stat
-import grp
-import pwd
+import errno
 import os
 import logging
 import inspect
@@ -43,14 +47,26 @@ import threading
 import random
 import socket
 import base64
-import datetime
 import codecs
+import time
+import contextlib
+import collections
+import itertools
+import multiprocessing.pool
+import json
+import zlib
 
 # -------------------------------------------------------------------    
 # things that we probably don't want to expose to configuration:
 
 NONCE_EXPIRY = 60 # seconds
-NONCE_CACHE_LIMIT = 4096
+NONCE_SHARDS = 16 # independently locked parts of the server's nonce cache
+NONCE_BUCKET = 10 # seconds, nonces are expired a bucket at a time
+NONCE_BATCH_LIMIT = 64 # most nonces issued by a single get_nonces call
+NONCE_MARGIN = 10 # seconds, clients do not use prefetched nonces this close to expiry
+SESSION_MARGIN = 10 # seconds, clients open a new session this close to the expiry of the last
+
+UNKNOWN_SCHEMA = 'DIRB_UNKNOWN_SCHEMA' # fault marker, when a server does not know a schema digest
 
 DEFAULT_UID = 0
 DEFAULT_GID = 0
@@ -58,10 +74,430 @@ DEFAULT_PERMISSIONS = stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP
 
 # -------------------------------------------------------------------
 
+# positions of the arguments that clients fill in, counted after self (None when absent):
+RpcArgs = collections.namedtuple( "RpcArgs", ( "user", "compileddoc", "startingpath", "server" ))
+
+def _get_rpc_args( fn ):
+    "returns the RpcArgs for the server method, resolved once when the method is registered"
+    try:
+        argnames = inspect.getfullargspec( fn ).args
+    except AttributeError :
+        argnames = inspect.getargspec( fn ).args # python 2
+    return RpcArgs( *[ argnames.index( x ) - 1 if x in argnames else None for x in RpcArgs._fields ] )
+
+# -------------------------------------------------------------------    
+
 def tuples_to_ptclist( tlist ):
     "transcoder to receive list of tuples and convert them to list of PathTraversalContexts"
     return [ ds.PathTraversalContext( *l ) for l in tlist ]
 
+def lists_to_ptclists( llist ):
+    "transcoder to receive a list of lists of tuples and convert them to lists of PathTraversalContexts"
+    return [ tuples_to_ptclist( l ) for l in llist ]
+
+# -------------------------------------------------------------------    
+
+#
+# Columnar encoding of PathTraversalContext lists, much smaller and quicker to decode than
+# XML-RPC structs.  Every string (paths, keys, values, users, groups, bookmarks) goes once into 
+# a shared table, and each field is a column of indices into that table, one entry per context.
+# Values that are not hashable, such as lists from the structure document, are shared by
+# their JSON text, and each decoded context gets its own copy.
+#    'bookmarks' : list of indices per context
+#    'attributes', 'parameters', 'collections' : list of alternating key, value indices per context
+#    'path', 'user', 'group' : one index per context, -1 for None
+#    'permissions' : one integer per context, -1 for None
+# The table and columns are sent as JSON text, optionally zlib compressed.
+#
+
+def encode_ptclist( ptclist, compress=False ):
+    "returns the columnar encoding of a list of PathTraversalContexts (or their tuples)"
+    strings = []
+    index = {}
+    def ref( value ):
+        if value is None :
+            return -1
+        key = ( type( value ), value )
+        try:
+            hash( key )
+        except TypeError :
+            key = ( None, json.dumps( value, sort_keys=True ))
+        if key not in index :
+            index[ key ] = len( strings )
+            strings.append( value )
+        return index[ key ]
+    def refdict( d ):
+        return [ ref( x ) for x in itertools.chain( *sorted( d.items() )) ]
+    
+    columns = dict( ( x, [] ) for x in ds.PathTraversalContext._fields )
+    for ctx in ptclist :
+        ctx = ds.PathTraversalContext( *ctx )
+        columns['bookmarks'].append( [ ref( x ) for x in ctx.bookmarks ] )
+        columns['attributes'].append( refdict( ctx.attributes ) )
+        columns['parameters'].append( refdict( ctx.parameters ) )
+        columns['collections'].append( refdict( ctx.collections ) )
+        columns['path'].append( ref( ctx.path ) )
+        columns['user'].append( ref( ctx.user ) )
+        columns['group'].append( ref( ctx.group ) )
+        columns['permissions'].append( -1 if ctx.permissions is None else ctx.permissions )
+    
+    text = json.dumps( { 'strings' : strings, 'columns' : columns }, separators=(',',':') )
+    if compress :
+        return { 'encoding' : 'zlib', 'data' : xmlrpc_lib.Binary( zlib.compress( text.encode( 'utf-8' ) ) ) }
+    return { 'encoding' : 'json', 'data' : text }
+
+
+class ColumnarPtcList( Sequence ):
+    "list of PathTraversalContexts, decoded from the columnar encoding one at a time, as they are used"
+    def __init__( self, encoded ):
+        data = encoded['data']
+        if encoded['encoding'] == 'zlib' :
+            data = zlib.decompress( data.data if isinstance( data, xmlrpc_lib.Binary ) else data ).decode( 'utf-8' )
+        doc = json.loads( data )
+        self._strings = doc['strings']
+        self._columns = doc['columns']
+        
+    def __len__( self ):
+        return len( self._columns['path'] )
+      
+    def __getitem__( self, i ):
+        if isinstance( i, slice ):
+            return [ self[x] for x in range( *i.indices( len( self ))) ]
+        strings = self._strings
+        columns = self._columns
+        def deref( x ):
+            if x < 0 :
+                return None
+            value = strings[x]
+            return copy.deepcopy( value ) if isinstance( value, ( list, dict )) else value
+        def derefdict( l ):
+            return dict( ( strings[l[x]], deref( l[x+1] ) ) for x in range( 0, len( l ), 2 ))
+        permissions = columns['permissions'][i]
+        return ds.PathTraversalContext(
+            [ strings[x] for x in columns['bookmarks'][i] ],
+            derefdict( columns['attributes'][i] ),
+            derefdict( columns['parameters'][i] ),
+            deref( columns['path'][i] ),
+            derefdict( columns['collections'][i] ),
+            deref( columns['user'][i] ),
+            deref( columns['group'][i] ),
+            None if permissions < 0 else permissions )
+        
+
+def columnar_to_ptclist( encoded ):
+    "transcoder to receive the columnar encoding and convert it to a (lazy) list of PathTraversalContexts"
+    return ColumnarPtcList( encoded )
+
+# -------------------------------------------------------------------    
+
+# transports that apply a socket timeout (None for none) to their connections,
+# and gzip encode requests larger than encode_threshold bytes.
+# The timeout can be changed between calls, and applies to a kept-alive connection too:
+
+def _set_timeout( conn, timeout ):
+    conn.timeout = timeout
+    if conn.sock is not None :
+        conn.sock.settimeout( timeout )
+    return conn
+
+class _Transport( xmlrpc_lib.Transport ) :
+    def __init__( self, timeout, encode_threshold=None, **kwargs ):
+        xmlrpc_lib.Transport.__init__( self, **kwargs )
+        self.timeout = timeout
+        self.encode_threshold = encode_threshold
+    def make_connection( self, host ):
+        return _set_timeout( xmlrpc_lib.Transport.make_connection( self, host ), self.timeout )
+
+class _SafeTransport( xmlrpc_lib.SafeTransport ) :
+    def __init__( self, timeout, encode_threshold=None, **kwargs ):
+        xmlrpc_lib.SafeTransport.__init__( self, **kwargs )
+        self.timeout = timeout
+        self.encode_threshold = encode_threshold
+    def make_connection( self, host ):
+        return _set_timeout( xmlrpc_lib.SafeTransport.make_connection( self, host ), self.timeout )
+
+def _make_proxy( server, timeout=None, encode_threshold=None ):
+    transport = _SafeTransport if server.lower().startswith( 'https' ) else _Transport
+    try: 
+        return xmlrpc_lib.ServerProxy(server, transport=transport( timeout, encode_threshold, use_builtin_types=True ), allow_none=True )
+    except TypeError :
+        return xmlrpc_lib.ServerProxy(server, transport=transport( timeout, encode_threshold ), allow_none=True )
+
+# -------------------------------------------------------------------    
+#
+# Keeps idle ServerProxy objects, per server, so that their transports
+# can reuse persistent (keep-alive) HTTP connections across calls.
+# A proxy is only ever used by one thread at a time: it is taken out of
+# the pool for the duration of a call and returned afterwards.
+#
+class _ProxyPool( object ) :
+
+    def __init__( self, idle_timeout, encode_threshold=None ):
+        self._idle = {} # server -> list of (timestamp, proxy), most recently used last
+        self._lock = threading.Lock()
+        self._idle_timeout = idle_timeout
+        self._encode_threshold = encode_threshold # requests larger than this are gzip encoded
+
+    def acquire( self, server, timeout=None ):
+        "returns a proxy for the server, whose calls time out after timeout seconds (None for never), reusing an idle one when it has not timed out"
+        now = time.time()
+        ret = None
+        expired = []
+        self._lock.acquire( True )
+        try:
+            idle = self._idle.get( server, [] )
+            while idle and ret is None:
+                timestamp, proxy = idle.pop()
+                if now - timestamp < self._idle_timeout :
+                    ret = proxy
+                else:
+                    expired.append( proxy )
+        finally:
+            self._lock.release()
+        for proxy in expired :
+            self.discard( proxy )
+        if ret is None :
+            return _make_proxy( server, timeout, self._encode_threshold )
+        ret( 'transport' ).timeout = timeout
+        return ret
+
+    def release( self, server, proxy ):
+        "returns a healthy proxy to the pool"
+        now = time.time()
+        expired = []
+        self._lock.acquire( True )
+        try:
+            idle = self._idle.setdefault( server, [] )
+            while idle and now - idle[0][0] >= self._idle_timeout :
+                expired.append( idle.pop(0)[1] )
+            idle.append( ( now, proxy ) )
+        finally:
+            self._lock.release()
+        for proxy in expired :
+            self.discard( proxy )
+
+    def discard( self, proxy ):
+        "closes the connection of a proxy that will not be reused"
+        try:
+            proxy( 'close' )()
+        except Exception :
+            pass
+
+    def close( self ):
+        "closes every idle connection"
+        self._lock.acquire( True )
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for server in idle :
+            for timestamp, proxy in idle[ server ] :
+                self.discard( proxy )
+
+    @contextlib.contextmanager
+    def connection( self, server, timeout=None ):
+        "context manager giving a proxy, which goes back to the pool unless the call failed"
+        proxy = self.acquire( server, timeout )
+        try:
+            yield proxy
+        except xmlrpc_lib.Fault :
+            self.release( server, proxy ) # a fault is a complete response, the connection is still good
+            raise
+        except :
+            self.discard( proxy )
+            raise
+        self.release( server, proxy )
+
+# -------------------------------------------------------------------    
+#
+# Keeps server nonces, per server, fetched in batches with get_nonces.
+# When a server's supply runs low, it is refilled by a background thread,
+# so that authenticated calls do not wait on an extra round trip.
+# Nonces are only handed out while they are younger than NONCE_EXPIRY, less NONCE_MARGIN.
+#
+class _NoncePool( object ) :
+
+    def __init__( self, proxies, batchsize ):
+        self._proxies = proxies
+        self._batchsize = batchsize
+        self._nonces = {} # server -> deque of (timestamp, nonce), oldest first
+        self._refilling = set() # servers with a background refill in flight
+        self._unbatched = set() # servers that do not support get_nonces
+        self._lock = threading.Lock()
+
+    def get( self, server, proxy, fresh=False ):
+        "returns a nonce for the server, fetching with the given proxy when none are available or when fresh is true"
+        nonce = None
+        refill = False
+        now = time.time()
+        self._lock.acquire( True )
+        try:
+            nonces = self._nonces.setdefault( server, collections.deque() )
+            if fresh :
+                nonces.clear()
+            while nonces and nonce is None :
+                timestamp, candidate = nonces.popleft()
+                if now - timestamp < NONCE_EXPIRY - NONCE_MARGIN :
+                    nonce = candidate
+            if nonce is not None and len( nonces ) < self._batchsize // 2 and server not in self._refilling :
+                self._refilling.add( server )
+                refill = True
+        finally:
+            self._lock.release()
+            
+        if nonce is None :
+            nonce = self._fetch( server, proxy )
+        elif refill :
+            thread = threading.Thread( target=self._refill, args=(server,) )
+            thread.daemon = True
+            thread.start()
+        return nonce
+
+    def _fetch( self, server, proxy ):
+        # returns one nonce, keeping the rest of the batch for later calls
+        if self._batchsize < 2 or server in self._unbatched :
+            return proxy.get_nonce()
+        try:
+            batch = proxy.get_nonces( self._batchsize )
+        except xmlrpc_lib.Fault :
+            # older servers can only issue one nonce at a time
+            self._unbatched.add( server )
+            return proxy.get_nonce()
+        self._store( server, batch[1:] )
+        return batch[0]
+
+    def _store( self, server, batch ):
+        now = time.time()
+        self._lock.acquire( True )
+        try:
+            self._nonces.setdefault( server, collections.deque() ).extend( (now, x) for x in batch )
+        finally:
+            self._lock.release()
+
+    def _refill( self, server ):
+        try:
+            try:
+                with self._proxies.connection( server ) as proxy :
+                    self._store( server, proxy.get_nonces( self._batchsize ) )
+            except xmlrpc_lib.Fault :
+                self._unbatched.add( server )
+            except Exception :
+                pass # the next call will fetch synchronously
+        finally:
+            self._lock.acquire( True )
+            self._refilling.discard( server )
+            self._lock.release()
+
+# -------------------------------------------------------------------
+#
+# Chooses the server for each call: of two random healthy servers, the one with
+# the lower moving average of latency, weighted by its moving average of errors.
+# A server that fails is taken out of rotation, and after a backoff one call is sent
+# to it as a probe; a success re-admits it, a failure doubles the backoff.
+#
+SELECTOR_DECAY = 0.2 # weight of the newest sample in the moving averages
+SELECTOR_MAX_BACKOFF = 300 # seconds
+
+class _ServerSelector( object ) :
+
+    def __init__( self, servers, backoff ):
+        self._servers = list( servers )
+        self._backoff = backoff
+        self._stats = dict( ( x, { 'latency' : None, 'errors' : 0.0, 'calls' : 0, 'failures' : 0, 'down' : False, 'retry' : 0.0, 'backoff' : backoff } ) for x in self._servers )
+        self._lock = threading.Lock()
+
+    def _score( self, server ):
+        # servers that have not been measured yet score best, so that they are measured
+        stats = self._stats[ server ]
+        return ( stats['latency'] or 0.0 ) * ( 1.0 + 10.0 * stats['errors'] )
+
+    def _probe( self, server, now ):
+        # holds off other probes of the server until this one has had its chance
+        stats = self._stats[ server ]
+        stats['retry'] = now + stats['backoff']
+
+    def pick( self, exclude=() ):
+        "returns the server for the next call, or None when every server is excluded"
+        now = time.time()
+        self._lock.acquire( True )
+        try:
+            candidates = [ x for x in self._servers if x not in exclude ]
+            if not candidates :
+                return None
+            for server in candidates :
+                if self._stats[server]['down'] and self._stats[server]['retry'] <= now :
+                    self._probe( server, now )
+                    return server
+            healthy = [ x for x in candidates if not self._stats[x]['down'] ]
+            if not healthy :
+                # everything is down, so try the server due back soonest:
+                server = min( candidates, key=lambda x : self._stats[x]['retry'] )
+                self._probe( server, now )
+                return server
+            if len( healthy ) == 1 :
+                return healthy[0]
+            a, b = random.sample( healthy, 2 )
+            return a if self._score( a ) <= self._score( b ) else b
+        finally:
+            self._lock.release()
+
+    def available( self ):
+        "returns the healthy servers, and the failed servers due a probe; every server when all are down"
+        now = time.time()
+        self._lock.acquire( True )
+        try:
+            ret = [ x for x in self._servers if not self._stats[x]['down'] or self._stats[x]['retry'] <= now ]
+            ret = ret or list( self._servers )
+            for server in ret :
+                if self._stats[server]['down'] :
+                    self._probe( server, now )
+            return ret
+        finally:
+            self._lock.release()
+
+    def success( self, server, seconds ):
+        "records a call answered by the server in the given time"
+        self._lock.acquire( True )
+        try:
+            stats = self._stats.get( server )
+            if stats is None :
+                return # not one of DIRB_SERVERS, see _rpc_specific
+            stats['latency'] = seconds if stats['latency'] is None else stats['latency'] + SELECTOR_DECAY * ( seconds - stats['latency'] )
+            stats['errors'] -= SELECTOR_DECAY * stats['errors']
+            stats['calls'] += 1
+            stats['down'] = False
+            stats['backoff'] = self._backoff
+        finally:
+            self._lock.release()
+
+    def failure( self, server ):
+        "records a failed call, returns True if the server has just been taken out of rotation"
+        now = time.time()
+        self._lock.acquire( True )
+        try:
+            stats = self._stats.get( server )
+            if stats is None :
+                return False
+            stats['errors'] += SELECTOR_DECAY * ( 1.0 - stats['errors'] )
+            stats['calls'] += 1
+            stats['failures'] += 1
+            if stats['down'] :
+                stats['backoff'] = min( stats['backoff'] * 2, SELECTOR_MAX_BACKOFF )
+            stats['retry'] = now + stats['backoff']
+            ret = not stats['down']
+            stats['down'] = True
+            return ret
+        finally:
+            self._lock.release()
+
+    def stats( self ):
+        "returns a copy of the figures for each server"
+        self._lock.acquire( True )
+        try:
+            return dict( ( x, dict( self._stats[x] ) ) for x in self._servers )
+        finally:
+            self._lock.release()
+
 # -------------------------------------------------------------------    
 #    
 # Implements a XML-RPC client class 
@@ -77,20 +513,68 @@ class RemoteClient( localclient.LocalClient ) :
         server_list = [x.strip() for x in confdict['DIRB_SERVERS'].split(',')]
         assert len(server_list) > 0
         self._server_list = server_list
-        self._server_bound = len(server_list)
-        assert( self._server_bound )
-        self._server_num = random.randint( 0, self._server_bound-1) 
         self._notifier = notifier
         self._conf = confdict
+        defaults = conf.get_default_config()
+        self._selector = _ServerSelector( server_list, confdict.get( 'DIRB_SERVER_BACKOFF', defaults['DIRB_SERVER_BACKOFF'] ))
+        encode_threshold = confdict.get( 'DIRB_GZIP_THRESHOLD', defaults['DIRB_GZIP_THRESHOLD'] )
+        self._proxies = _ProxyPool( confdict.get( 'DIRB_CONNECTION_IDLE_TIMEOUT', defaults['DIRB_CONNECTION_IDLE_TIMEOUT'] ), encode_threshold if encode_threshold > 0 else None )
+        self._broadcast_timeout = confdict.get( 'DIRB_RPC_TIMEOUT', defaults['DIRB_RPC_TIMEOUT'] ) or None
+        self._nonces = _NoncePool( self._proxies, confdict.get( 'DIRB_NONCE_BATCH', defaults['DIRB_NONCE_BATCH'] ))
+        self._fanout = None # thread pool for calls to all servers, created on demand
+        self._fanoutlock = threading.Lock()
+        self._digest = None # digest of the compiled document, sent in place of the whole document
+        self._use_sessions = bool( confdict.get( 'DIRB_SESSIONS', defaults['DIRB_SESSIONS'] ))
+        self._sessions = {} # ( server, user name ) : ( token, time to renew )
+        self._unsessioned = set() # servers that do not open sessions
         super(RemoteClient, self).__init__( compileddoc, startingpath )
 
+    def close( self ):
+        "Closes any idle connections to the servers"
+        self._close_fanout()
+        self._proxies.close()
+
+    def __del__( self ):
+        # the threads of the pool would outlive the client
+        if getattr( self, '_fanoutlock', None ) is not None :
+            self._close_fanout()
+
+    def _get_fanout( self ):
+        self._fanoutlock.acquire( True )
+        try:
+            if self._fanout is None :
+                self._fanout = multiprocessing.pool.ThreadPool( len( self._server_list ))
+            return self._fanout
+        finally:
+            self._fanoutlock.release()
+
+    def _close_fanout( self ):
+        self._fanoutlock.acquire( True )
+        try:
+            fanout, self._fanout = self._fanout, None
+        finally:
+            self._fanoutlock.release()
+        if fanout is not None :
+            fanout.close()
+
     # ===========================================
           
-    def _pick_one( self ):
-        # round robin across the servers
-        ret = self._server_list[ self._server_num ]
-        self._server_num += 1
-        self._server_num = 0 if self._server_num == self._server_bound else self._server_num
+    def _pick_one( self, exclude=() ):
+        # the fastest healthy server, see _ServerSelector
+        return self._selector.pick( exclude )
+
+    def _succeeded( self, server, start ):
+        self._selector.success( server, time.time() - start )
+
+    def _failed( self, server ):
+        if self._selector.failure( server ) and self._notifier :
+            self._notifier( server ) # flash the red lights
+
+    def get_balancer_stats( self ):
+        "Returns, for each server, the moving averages of latency (seconds) and error rate, call and failure counts, and whether it is out of rotation"
+        ret = self._selector.stats()
+        for stats in ret.values() :
+            del stats['retry']
         return ret
     
     # ===========================================
@@ -164,23 +648,43 @@ class RemoteClient( localclient.LocalClient ) :
       
     # ===========================================
     
-    def _replace_args( self, server, method, args, kwargs ):
+    def _get_digest( self ):
+        if self._digest is None :
+            self._digest = ds.get_compiled_digest( self._doc )
+        return self._digest
+    
+    # ===========================================
+    
+    def _replace_args( self, server, proxy, method, args, kwargs, fresh=False, fulldoc=False ):
         "as a convenience, we can automagically fill in some args that the server method requires"
-        argspec = inspect.getargspec(method)
-        user_index = argspec.args.index( 'user' ) - 1 
-        doc_index = argspec.args.index( 'compileddoc' ) - 1 if 'compileddoc' in argspec.args else None
-        path_index = argspec.args.index( 'startingpath' ) - 1 if 'startingpath' in argspec.args else None
+        if self._use_sessions and server not in self._unsessioned :
+            username = self._get_user( method._rpc_args.user, args, kwargs )
+            token = self._get_session( server, proxy, username, fresh )
+            if token is not None :
+                return self._build_args( method, args, kwargs, None, fulldoc, token )
+        servernonce = self._nonces.get( server, proxy, fresh )
+        return self._build_args( method, args, kwargs, servernonce, fulldoc )
+    
+    def _build_args( self, method, args, kwargs, servernonce, fulldoc=False, token=None ):
+        # fills in the arguments, given a nonce from the server that will receive them, or a session token
+        rpcargs = method._rpc_args
+        user_index = rpcargs.user
+        doc_index = rpcargs.compileddoc
+        path_index = rpcargs.startingpath
         
         # security protocol replaces username with a full user-credential object:
-        servernonce = server.get_nonce()
         username = self._get_user( user_index, args, kwargs )
-        user = tuple( auth.get_user_credentials( username, self._conf, servernonce ))
+        if token is not None :
+            user = tuple( auth.make_session_credentials( username, token ))
+        else:
+            user = tuple( auth.get_user_credentials( username, self._conf, servernonce ))
         newargs, newkw = self._set_user( user_index, user, args, kwargs )
         
         # attach the compile document to the call, when appropriate:
+        # (by reference, unless the server has said it does not know the document)
         # attach the starting path to the call, will very frequently pair with the compiled document
         if doc_index is not None:
-            newargs, newkw = self._set_compileddoc( doc_index, self._doc, newargs, newkw )
+            newargs, newkw = self._set_compileddoc( doc_index, self._doc if fulldoc else self._get_digest(), newargs, newkw )
         if path_index is not None:
             newargs, newkw = self._set_startingpath( path_index, self._root, newargs, newkw )
             
@@ -188,68 +692,112 @@ class RemoteClient( localclient.LocalClient ) :
     
     # ===========================================
     
-    # if a server fails, then send email and remove it from the list!
-    def _call_one( self, method, *args, **kwargs ):
-        server = self._pick_one()
-        ret = None
+    def _get_session( self, server, proxy, username, fresh=False ):
+        # returns a session token for the user on the server, or None if the server does not open sessions
+        token = None if fresh else self._cached_session( server, username )
+        if token is None :
+            user = tuple( auth.get_user_credentials( username, self._conf, self._nonces.get( server, proxy, fresh )))
+            try:
+                token = self._store_session( server, username, proxy.open_session( user ))
+            except xmlrpc_lib.Fault as e :
+                if 'Permission Denied' in e.faultString :
+                    raise # perhaps a stale nonce, see _invoke
+                self._unsessioned.add( server ) # an older server, or sessions are disabled
+        return token
+    
+    def _cached_session( self, server, username ):
+        entry = self._sessions.get( ( server, username ), None )
+        if entry and time.time() < entry[1] :
+            return entry[0]
+        return None
+    
+    def _store_session( self, server, username, session ):
+        self._sessions[ ( server, username ) ] = ( session['token'], time.time() + session['expiry'] - SESSION_MARGIN )
+        return session['token']
+    
+    # ===========================================
+    
+    def _invoke( self, server, proxy, method, args, kwargs ):
+        "calls the server method through the proxy, after replacing arguments"
+        name = method.__name__
+        fresh = False
+        fulldoc = False
+        while True :
+            newargs, newkw = self._replace_args( server, proxy, method, args, kwargs, fresh, fulldoc )
+            try:
+                # Be careful here, if you mess this call up, you'll be calling the
+                # local definition of the server method, not the method on the remote server!
+                return proxy.__getattr__(name)(*newargs, **newkw) # do the function call
+            except xmlrpc_lib.Fault as e :
+                if UNKNOWN_SCHEMA in e.faultString and not fulldoc :
+                    # first use of the schema on this server, send the whole document:
+                    fulldoc = True
+                elif 'Permission Denied' in e.faultString and not fresh :
+                    # prefetched nonces and sessions are lost when a server restarts, so try once more with a fresh one:
+                    fresh = True
+                else:
+                    raise
+    
+    # ===========================================
+    
+    def _timed_invoke( self, server, method, args, kwargs, timeout=None ):
+        # a fault is an answer from a working server, only socket errors count against it
+        start = time.time()
         try:
-            try: 
-                p = xmlrpc_lib.ServerProxy(server, allow_none=True, use_builtin_types=True )
-            except TypeError :
-                p = xmlrpc_lib.ServerProxy(server, allow_none=True )
-
-            name = method.__name__
-            
-            # replace any arguments that we should:
-            newargs, newkw = self._replace_args( p, method, args, kwargs )
-            
-            # Be careful here, if you mess this call up, you'll be calling the
-            # local definition of the server method, not the method on the remote server!
-            ret = p.__getattr__(name)(*newargs, **newkw) # do the function call
-            
+            with self._proxies.connection( server, timeout ) as p :
+                ret = self._invoke( server, p, method, args, kwargs )
         except socket.error :
-            if self._notifier :
-                self._notifier( server ) # flash the red lights
-            self._server_list.remove( server )
-            self._server_bound = len( self._server_list )
-            self._server_num = 0
-            if not self._server_list:
-                raise # pass the socket.error on up
-            return self._call_one( method, *args, **kwargs )
+            self._failed( server )
+            raise
+        except xmlrpc_lib.Fault :
+            self._succeeded( server, start )
+            raise
+        self._succeeded( server, start )
         return ret
 
     # ===========================================
-        
-    def _call_all( self, method, *args, **kwargs ):
-        ret = {}
-        
-        # would be lovely to execute in parallel:
-        for server in self._server_list :
-            try:
-                try: 
-                    p = xmlrpc_lib.ServerProxy(server, allow_none=True, use_builtin_types=True )
-                except TypeError :
-                    p = xmlrpc_lib.ServerProxy(server, allow_none=True )
-                name = method.__name__
-                
-                # replace any arguments that we should:
-                newargs, newkw = self._replace_args( p, method, args, kwargs )
-                
-                # Be careful here, if you mess this call up, you'll be calling the
-                # local definition of the server method, not the method on the remote server!
-                ret[ server ] = p.__getattr__(name)( *newargs, **newkw) # do the function call
 
+    # if a server fails, then notify and try the others; it is probed again after a backoff.
+    # The call is not bounded by a timeout: a slow answer, such as a large creation, is not a failure,
+    # and must not be sent again to another server.
+    def _call_one( self, method, *args, **kwargs ):
+        tried = []
+        while True :
+            server = self._pick_one( tried )
+            try:
+                return self._timed_invoke( server, method, args, kwargs )
             except socket.error :
-                if self._notifier :
-                    self._notifier( server ) # flash the red lights
-                self._server_list.remove( server )
-                self._server_bound = len( self._server_list )
-                self._server_num = 0
-                raise # pass the socket.error on up
+                tried.append( server )
+                if len( tried ) == len( self._server_list ):
+                    raise # pass the socket.error on up
 
+    # ===========================================
+        
+    def _call_all( self, method, *args, **kwargs ):
+        # calls every available server concurrently, each call is bounded by the socket timeout (DIRB_RPC_TIMEOUT),
+        # so that one hung server does not hold up the broadcast.
+        # A server that fails gives its exception as its result, rather than aborting the broadcast.
+        def call( server ):
+            try:
+                return self._timed_invoke( server, method, args, kwargs, self._broadcast_timeout )
+            except Exception as e :
+                return e
+        
+        servers = self._selector.available()
+        ret = dict( zip( servers, self._get_fanout().map( call, servers )))
+        
+        failed = [ x for x in servers if isinstance( ret[x], socket.error ) ]
+        if failed and len( failed ) == len( servers ) :
+            raise ret[ failed[0] ] # pass the socket.error on up
+        
         return ret
 
     # ===========================================
+    #
+    # Each generated method records how it was generated, as api._rpc = ( kind, fn, transcoder ),
+    # so that other clients (see asyncclient) can generate the same methods.
+    # The positions of the arguments to fill in are resolved once, as fn._rpc_args (also api._rpc_args).
+    #
       
     @classmethod
     def _rpc_one( cls, transcoder=None ):
@@ -259,6 +807,8 @@ class RemoteClient( localclient.LocalClient ) :
                 return transcoder( ret ) if transcoder else ret
             
             api.__doc__ = fn.__doc__
+            api._rpc = ( 'one', fn, transcoder )
+            api._rpc_args = fn._rpc_args = _get_rpc_args( fn )
             setattr( cls, fn.__name__, api )  
             return fn
         return fn_d
@@ -273,6 +823,8 @@ class RemoteClient( localclient.LocalClient ) :
                 return transcoder( ret ) if transcoder else ret
                 
             api.__doc__ = fn.__doc__
+            api._rpc = ( 'all', fn, transcoder )
+            api._rpc_args = fn._rpc_args = _get_rpc_args( fn )
             setattr( cls, fn.__name__, api )  
             return fn
         return fn_d
@@ -282,28 +834,18 @@ class RemoteClient( localclient.LocalClient ) :
     @classmethod
     def _rpc_specific( cls, transcoder=None ):
         def fn_d( fn ):
-            argspec = inspect.getargspec(fn)
-            server_index = argspec.args.index( 'server' ) - 1
+            fn._rpc_args = _get_rpc_args( fn )
+            server_index = fn._rpc_args.server
             
             def api( client, *args, **kwargs ):
                 server = args[server_index]
 
-                try: 
-                    p = xmlrpc_lib.ServerProxy(server, allow_none=True, use_builtin_types=True )
-                except TypeError :
-                    p = xmlrpc_lib.ServerProxy(server, allow_none=True )
-
-                method = p.__getattr__(fn.__name__)
-                
-                # replace any arguments that we should:
-                newargs, newkw = client._replace_args( p, method, args, kwargs )
-
-                # Be careful here, if you mess this call up, you'll be calling the
-                # local definition of the server method, not the method on the remote server!
-                ret = method(*newargs, **newkw) # do the function call
+                ret = client._timed_invoke( server, fn, args, kwargs )
                 return transcoder( ret ) if transcoder else ret
               
             api.__doc__ = fn.__doc__
+            api._rpc = ( 'specific', fn, transcoder )
+            api._rpc_args = fn._rpc_args
             setattr( cls, fn.__name__, api )
             return fn
         return fn_d 
@@ -318,8 +860,7 @@ class RemoteClient( localclient.LocalClient ) :
 # requires that the method has a parameter 'user' which is a UserCredentials object
 #
 def _authorized(fn):
-    argspec = inspect.getargspec(fn)
-    user_index = argspec.args.index( 'user' ) - 1
+    user_index = _get_rpc_args( fn ).user
 
     def wrapper(server, *args, **kwargs):
       user = args[user_index]      
@@ -332,13 +873,86 @@ def _authorized(fn):
 
 # -------------------------------------------------------------------
 
+#
+# The nonces issued by a server, each accepted once while younger than NONCE_EXPIRY.
+# Pre-forked workers share one, held by a manager process (see runner).
+#
+# Nonces are spread over NONCE_SHARDS shards, each with its own lock, so concurrent
+# requests rarely wait on each other.  Within a shard, nonces are filed in buckets by
+# the time they were issued (NONCE_BUCKET seconds each, newest last), and expire
+# by dropping whole buckets, rather than by examining every nonce.
+#
+class _NonceShard( object ) :
+
+    def __init__( self ):
+        self._buckets = collections.deque() # ( bucket number, { nonce : time issued } ), oldest first
+        self._lock = threading.Lock()
+
+    def add( self, nonces, now ):
+        number = int( now // NONCE_BUCKET )
+        oldest = int( ( now - NONCE_EXPIRY ) // NONCE_BUCKET ) # buckets before this hold only expired nonces
+        self._lock.acquire( True )
+        try:
+            while self._buckets and self._buckets[0][0] < oldest :
+                self._buckets.popleft()
+            if not self._buckets or self._buckets[-1][0] != number :
+                self._buckets.append( ( number, {} ) )
+            bucket = self._buckets[-1][1]
+            for nonce in nonces :
+                bucket[ nonce ] = now
+        finally:
+            self._lock.release()
+
+    def consume( self, nonce, now ):
+        self._lock.acquire( True )
+        try:
+            # most nonces are used soon after they are issued, so look in the newest buckets first:
+            for number, bucket in reversed( self._buckets ):
+                timestamp = bucket.pop( nonce, None )
+                if timestamp is not None :
+                    return now - timestamp < NONCE_EXPIRY
+            return False # unknown after a restart, for example
+        finally:
+            self._lock.release()
+
+    def __len__( self ):
+        return sum( len( x[1] ) for x in self._buckets )
+
+class _NonceCache( object ) :
+
+    def __init__( self, shards=NONCE_SHARDS ):
+        self._shards = [ _NonceShard() for x in range( shards ) ]
+
+    def _shard( self, nonce ):
+        return self._shards[ hash( nonce ) % len( self._shards ) ]
+
+    def add( self, nonces, now=None ):
+        "files the nonces, issued at now (seconds, the current time by default)"
+        now = time.time() if now is None else now
+        byshard = collections.defaultdict( list )
+        for nonce in nonces :
+            byshard[ self._shard( nonce ) ].append( nonce )
+        for shard, shardnonces in byshard.items() :
+            shard.add( shardnonces, now )
+
+    def consume( self, nonce, now=None ):
+        "returns True if the nonce was issued, has not expired and has not been used before"
+        return self._shard( nonce ).consume( nonce, time.time() if now is None else now )
+
+    def size( self ):
+        "returns the number of nonces held, including expired nonces not yet dropped"
+        return sum( len( x ) for x in self._shards )
+
+# -------------------------------------------------------------------
+
 #
 # XMLRPC App
 #
 class ServerApp : 
   
-    def __init__(self, url, config, logginglevel = logging.DEBUG):
-        "config is the parameter dictionary; contains server configuration vars"
+    def __init__(self, url, config, logginglevel = logging.DEBUG, nonces = None):
+        """config is the parameter dictionary; contains server configuration vars.
+        nonces is the nonce cache, for worker processes sharing one (see runner)."""
       
         # get a logger:
         self._logger = logging.getLogger('dirbserver')
@@ -369,10 +983,32 @@ class ServerApp :
         # ---------------------------------------
         
         self._mutex =  threading.Lock() # TODO: should this be a multi-lock?
+        self._stopping = False # set by shutdown_server, refuses further calls
 
         # ---------------------------------------
         
-        self._noncecache = {}
+        self._nonces = nonces if nonces is not None else _NonceCache()
+        
+        # signs session tokens; worker processes forked from this app share it:
+        secret = self._config['DIRBSERVER_SESSION_SECRET']
+        self._session_secret = secret.encode( 'utf-8' ) if secret else os.urandom( 32 )
+        
+        # ---------------------------------------
+        
+        # compiled documents, by digest, most recently used last:
+        self._schemas = collections.OrderedDict()
+        self._schemalock = threading.Lock()
+        
+        # local clients, by ( digest, starting path ), most recently used last:
+        self._clients = collections.OrderedDict()
+        self._clientlock = threading.Lock()
+        self._clienthits = 0
+        self._clientmisses = 0
+        
+        # ---------------------------------------
+        
+        self._createpool = None # threads for directory creation, created on demand
+        self._createlock = threading.Lock() # not _mutex, which shutdown_server keeps
         
         
         # ---------------------------------------
@@ -394,38 +1030,38 @@ class ServerApp :
     # ===========================================
         
     def get_nonce( self ):
-        nonce = codecs.decode( base64.b64encode(auth.get_nonce()), "utf-8" )
-        now = datetime.datetime.now()
-        
-        self._lock()
-        self._noncecache[ nonce ] = now
-        self._unlock()
-        return nonce
+        return self.get_nonces( 1 )[0]
+      
+    def get_nonces( self, count ):
+        "issues a batch of nonces (at most NONCE_BATCH_LIMIT), to save round trips"
+        count = max( 1, min( int(count), NONCE_BATCH_LIMIT ))
+        nonces = [ codecs.decode( base64.b64encode(auth.get_nonce()), "utf-8" ) for x in range( count ) ]
+        self._nonces.add( nonces )
+        return nonces
+      
+    @_authorized
+    def open_session( self, user ):
+        "Returns a session token, and the seconds it lasts, for calls to present in place of credentials from a nonce"
+        cred = auth.UserCredentials( *user )
+        if cred.servernonce == auth.SESSION_MARKER :
+            # only opened with a nonce, or a session could be renewed forever
+            raise SystemError( "Permission Denied" )
+        expiry = self._config['DIRBSERVER_SESSION_EXPIRY']
+        if expiry <= 0 :
+            raise SystemError( "Sessions are disabled" )
+        return { 'token' : auth.make_session_token( cred.username, int( time.time() ) + expiry, self._session_secret ), 'expiry' : expiry }
       
     # -------------------------------------------
     
     def _auth_user( self, cred ):
-        # prune if past a limit:
-        if len( self._noncecache ) > NONCE_CACHE_LIMIT :
-            try:
-                self._lock()
-                keys = self._noncecache.keys() 
-                for k in keys:
-                    if now - self._noncecache[k] > datetime.timedelta( seconds=NONCE_EXPIRY ) :
-                      del self._noncecache[k]
-            finally:
-                self._unlock()
-        
-        # need to verify the server nonce before we call auth module to verify the credentials:
-        ret = False
-        try:
-            self._lock()
-            timestamp = self._noncecache[ cred.servernonce ]
-            if datetime.datetime.now() - timestamp < datetime.timedelta( seconds=NONCE_EXPIRY ):
-                del self._noncecache[ cred.servernonce ]
-                ret = auth.verify_user_credentials( cred, self._config )
-        finally:
-            self._unlock()
+        if self._stopping :
+            raise SystemError( "Server shutting down" )
+        
+        if cred.servernonce == auth.SESSION_MARKER :
+            ret = auth.verify_session_token( cred.pwhash, cred.username, self._session_secret )
+        else:
+            # need to verify the server nonce before we call auth module to verify the credentials:
+            ret = self._nonces.consume( cred.servernonce ) and auth.verify_user_credentials( cred, self._config )
         if not ret:
             raise SystemError( "Permission Denied" )
 
@@ -444,6 +1080,93 @@ class ServerApp :
         raise SystemError( "Permission Denied" )
         return False
       
+    # -------------------------------------------
+    
+    def _get_schema( self, compileddoc ):
+        # accepts a compiled document, or the digest of a document seen before.
+        # Raises a fault carrying UNKNOWN_SCHEMA for unknown digests, so the client resends the document.
+        if isinstance( compileddoc, dict ):
+            digest = ds.get_compiled_digest( compileddoc ) # never trust a digest from the client
+        else:
+            digest = compileddoc
+        self._schemalock.acquire( True )
+        try:
+            if isinstance( compileddoc, dict ):
+                self._schemas[ digest ] = compileddoc
+            elif digest in self._schemas :
+                compileddoc = self._schemas.pop( digest )
+                self._schemas[ digest ] = compileddoc # most recently used
+            else:
+                compileddoc = None
+            while len( self._schemas ) > self._config['DIRBSERVER_SCHEMA_CACHE_SIZE'] :
+                self._schemas.popitem( last=False )
+        finally:
+            self._schemalock.release()
+        if compileddoc is None :
+            raise LookupError( "%s %s" % ( UNKNOWN_SCHEMA, digest ))
+        return digest, compileddoc
+      
+    # -------------------------------------------
+    
+    def _get_client( self, compileddoc, startingpath ):
+        # local clients are reused between calls for the same schema and root,
+        # so that anything they compile or cache stays warm.
+        digest, compileddoc = self._get_schema( compileddoc )
+        key = ( digest, startingpath )
+        self._clientlock.acquire( True )
+        try:
+            cl = self._clients.pop( key, None )
+            if cl is None :
+                self._clientmisses += 1
+            else:
+                self._clienthits += 1
+                self._clients[ key ] = cl # most recently used
+        finally:
+            self._clientlock.release()
+        if cl is not None :
+            return cl
+        
+        cl = localclient.LocalClient( compileddoc, startingpath ) # outside the lock, other requests need not wait
+        self._clientlock.acquire( True )
+        try:
+            cl = self._clients.setdefault( key, cl ) # another request may have beaten us to it
+            while len( self._clients ) > self._config['DIRBSERVER_CLIENT_CACHE_SIZE'] :
+                self._clients.popitem( last=False )
+        finally:
+            self._clientlock.release()
+        return cl
+      
+    # -------------------------------------------
+    
+    def _get_create_pool( self ):
+        self._createlock.acquire( True )
+        try:
+            if self._createpool is None :
+                self._createpool = multiprocessing.pool.ThreadPool( self._config['DIRBSERVER_CREATE_WORKERS'] )
+        finally:
+            self._createlock.release()
+        return self._createpool
+      
+    def _create_directory( self, target ):
+        # returns True if the directory was created,
+        # will not overwrite permissions on existing dirs!
+        uid = self._auth.get_uid( target.user ) if target.user else DEFAULT_UID
+        gid = self._auth.get_gid( target.group ) if target.group else DEFAULT_GID
+        permissions = target.permissions if target.permissions else DEFAULT_PERMISSIONS
+        
+        try:
+            os.mkdir( target.path, permissions )
+        except OSError as e :
+            if e.errno == errno.EEXIST and os.path.isdir( target.path ):
+                return False
+            raise
+        
+        # mkdir applies the umask, and cannot apply special bits, so chmod after it.
+        # (the umask could only be read by setting it, for the whole process)
+        os.chown( target.path, uid, gid )
+        os.chmod( target.path, permissions )
+        return True
+      
     #############################################
     # ===========================================
     
@@ -461,46 +1184,115 @@ class ServerApp :
         "friendly shutdown of the cluster"
         cred = auth.UserCredentials( *user )
         self._logger.warning( "Shutdown call received from %s" % cred.username )
+        self._stopping = True
         self._lock() # will not release !
         
         return self._shutdown_callable() # execute the callable
 
 
+    # ===========================================
+
+    @_authorized
+    @RemoteClient._rpc_all()
+    def get_server_stats(self, user):
+        "Returns a dictionary of cache sizes and hit counts, from each server"
+        self._clientlock.acquire( True )
+        try:
+            ret = {
+                'clientcache_size' : len( self._clients ),
+                'clientcache_hits' : self._clienthits,
+                'clientcache_misses' : self._clientmisses
+            }
+        finally:
+            self._clientlock.release()
+        ret['schemacache_size'] = len( self._schemas )
+        for k, v in self._auth.get_identity_stats().items():
+            ret[ 'identitycache_%s' % k ] = v
+        for k, v in self._auth.get_decision_stats().items():
+            ret[ 'decisioncache_%s' % k ] = v
+        for k, v in auth.get_secret_stats().items():
+            ret[ 'secretcache_%s' % k ] = v
+        return ret
+
+
     # ===========================================
 
     @_authorized
     @RemoteClient._rpc_one( transcoder=tuples_to_ptclist )
     def create_paths(self, createexpr, user, compileddoc, startingpath ):
         "Returns a list of PathTraversalContexts that were created from the given creation expression."
-        cl = localclient.LocalClient( compileddoc, startingpath ) 
+        cl = self._get_client( compileddoc, startingpath )
         cred = auth.UserCredentials( *user )
-        created = []
         
         # get target paths to create
+        self._check_create_estimate( cl, [ createexpr ] )
         target_paths = cl.depict_paths( createexpr )
         
-        # sort target paths soas to create shallow directories first
-        target_paths = ( (fs.split_path(x.path), x) for x in target_paths )
-        target_paths = [ (len(x[0]), x[-1].path, x[-1]) for x in target_paths ]
-        target_paths = [ x[-1] for x in sorted( target_paths ) ]
-        
-        for target in target_paths:
-            # acquire permissions, uid, gid
-            # TODO: would be nice to cache these credentials to reduce overhead:
-            uid = pwd.getpwnam( target.user ).pw_uid if target.user else DEFAULT_UID
-            gid = grp.getgrnam( target.group ).gr_gid if target.group else DEFAULT_GID
-            permissions = target.permissions if target.permissions else DEFAULT_PERMISSIONS
-            
-            # create directory
-            if not os.path.isdir( target.path ) :
-                os.mkdir(target.path)
-            
-                # set permissions on this directory 
-                # will not overwrite existing permissions on existing dirs!
-                os.chown(target.path, uid, gid)
-                os.chmod(target.path, permissions )
-                
-                self._logger.debug( "%s created %s" % (cred.username, target.path))
-                created.append( tuple(target) ) # use transcoder on client side to get back namedtuple objects.
+        return self._create_targets( target_paths, cred )
+
+
+    # ===========================================
+
+    @_authorized
+    @RemoteClient._rpc_one( transcoder=lists_to_ptclists )
+    def create_paths_batch(self, createexprs, user, compileddoc, startingpath ):
+        "Returns a list, for each of the given creation expressions, of the PathTraversalContexts that were created for it."
+        cl = self._get_client( compileddoc, startingpath )
+        cred = auth.UserCredentials( *user )
+        
+        # get target paths to create, for all expressions in one traversal
+        self._check_create_estimate( cl, createexprs )
+        target_lists = cl.depict_paths_batch( createexprs )
+        
+        created = self._create_targets( itertools.chain( *target_lists ), cred )
+        order = dict( ( ds.PathTraversalContext( *x ).path, i ) for i, x in enumerate( created ))
+        return [ [ tuple(x) for x in sorted( targets, key=lambda y : order.get( y.path, -1 )) if x.path in order ] for targets in target_lists ]
+      
+    # ===========================================
+
+    @_authorized
+    @RemoteClient._rpc_one( transcoder=columnar_to_ptclist )
+    def create_paths_columnar(self, createexpr, user, compileddoc, startingpath, compress=False ):
+        "Same as create_paths(), but the list comes back in a compact columnar encoding, compressed if requested."
+        cl = self._get_client( compileddoc, startingpath )
+        cred = auth.UserCredentials( *user )
+        
+        # get target paths to create
+        self._check_create_estimate( cl, [ createexpr ] )
+        target_paths = cl.depict_paths( createexpr )
+        
+        return encode_ptclist( self._create_targets( target_paths, cred ), compress )
+      
+    # -------------------------------------------
+    
+    def _check_create_estimate( self, cl, createexprs ):
+        # refuse expressions that would explode combinatorially, before doing the work:
+        limit = self._config['DIRBSERVER_MAX_CREATE_PATHS']
+        estimate = sum( cl.estimate_depict_paths( x ) for x in createexprs )
+        if limit and estimate > limit :
+            raise ValueError( "Creation would visit up to %d paths, the limit is %d" % ( estimate, limit ))
+        return estimate
+    
+    def _create_targets( self, target_paths, cred ):
+        # creates the directories of the given PathTraversalContexts, returning tuples for those created.
+        created = []
+        
+        # group target paths by depth, so as to create shallow directories first
+        # (each path only once, expressions may overlap)
+        depths = {}
+        for target in dict( ( x.path, x ) for x in target_paths ).values() :
+            depths.setdefault( len( fs.split_path( target.path )), [] ).append( target )
+        
+        # directories at the same depth are independent, create them in parallel:
+        for depth in sorted( depths ):
+            targets = sorted( depths[depth], key=lambda x : x.path )
+            if len( targets ) > 1 :
+                results = self._get_create_pool().map( self._create_directory, targets )
+            else:
+                results = [ self._create_directory( x ) for x in targets ]
+            for target, result in zip( targets, results ):
+                if result :
+                    self._logger.debug( "%s created %s" % (cred.username, target.path))
+                    created.append( tuple(target) ) # use transcoder on client side to get back namedtuple objects.
         
         return created
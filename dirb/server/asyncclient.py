@@ -0,0 +1,395 @@
+#####################################################################
+#
+# Copyright 2015 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#####################################################################
+
+#
+# An asyncio version of RemoteClient (python 3 only).
+#
+# Every method that RemoteClient generates from the server definition
+# (with _rpc_one, _rpc_all and _rpc_specific) is generated here as a coroutine,
+# with the same arguments and results:
+#
+#    client = AsyncRemoteClient( confdict, compileddoc, startingpath )
+#    created = await client.create_paths( createexpr, None, None, None )
+#    await client.close()
+#
+# Calls are made over HTTP/1.1 with asyncio streams, so any number can be in flight
+# at once without a thread each.  Idle connections are kept for reuse, and a cancelled
+# call closes its connection rather than returning it to the pool.  A call on a reused
+# connection that the server closed before answering is retried once on a new connection.
+#
+
+import asyncio
+import collections
+import socket
+import ssl
+import time
+
+import xmlrpc.client as xmlrpc_lib
+import urllib.parse
+
+from . import RemoteClient, UNKNOWN_SCHEMA, NONCE_EXPIRY, NONCE_MARGIN
+from .. import conf
+from .. import auth
+
+# -------------------------------------------------------------------
+
+class _Connection( object ) :
+    def __init__( self, reader, writer ):
+        self.reader = reader
+        self.writer = writer
+        self.timestamp = time.time()
+
+    def close( self ):
+        self.writer.close()
+
+# -------------------------------------------------------------------
+#
+# XML-RPC over asyncio streams, keeping idle keep-alive connections per server.
+# A connection is only ever used by one call at a time.
+#
+class _AsyncTransport( object ) :
+
+    def __init__( self, idle_timeout, encode_threshold=None ):
+        self._idle = {} # server -> list of _Connection, most recently used last
+        self._idle_timeout = idle_timeout
+        self._encode_threshold = encode_threshold # requests larger than this are gzip encoded
+
+    async def request( self, server, methodname, params ):
+        "calls the method on the server, returning its result or raising its xmlrpc_lib.Fault"
+        url = urllib.parse.urlsplit( server )
+        body = xmlrpc_lib.dumps( tuple( params ), methodname, allow_none=True ).encode( 'utf-8' )
+        headers = [
+            ( 'Host', url.netloc ),
+            ( 'User-Agent', xmlrpc_lib.Transport.user_agent ),
+            ( 'Content-Type', 'text/xml' ),
+            ( 'Accept-Encoding', 'gzip' ) ]
+        if self._encode_threshold is not None and len( body ) > self._encode_threshold :
+            body = xmlrpc_lib.gzip_encode( body )
+            headers.append( ( 'Content-Encoding', 'gzip' ) )
+        headers.append( ( 'Content-Length', str( len( body )) ) )
+        request = '\r\n'.join( [ 'POST %s HTTP/1.1' % ( url.path or '/' ) ] + [ '%s: %s' % x for x in headers ] + [ '', '' ] )
+
+        data = request.encode( 'latin-1' ) + body
+        conn = self._acquire( server )
+        reused = conn is not None
+        while True :
+            if conn is None :
+                conn = await self._connect( url )
+            statusline = None
+            try:
+                statusline = await self._send( conn, data )
+                status, reason, respheaders, respbody, keepalive = await self._read_response( conn.reader, statusline )
+                break
+            except ConnectionError :
+                conn.close()
+                if not reused or statusline is not None :
+                    raise
+                # like xmlrpc_lib.Transport, retry once on a new connection:
+                # the server may have closed the idle connection before the request reached it
+                reused = False
+                conn = None
+            except BaseException :
+                conn.close() # includes cancellation: the connection is in an unknown state
+                raise
+        if keepalive :
+            self._release( server, conn )
+        else:
+            conn.close()
+
+        if status != 200 :
+            raise xmlrpc_lib.ProtocolError( server, status, reason, respheaders )
+        if respheaders.get( 'content-encoding', '' ).lower() == 'gzip' :
+            respbody = xmlrpc_lib.gzip_decode( respbody, max_decode=-1 )
+        return xmlrpc_lib.loads( respbody, use_builtin_types=True )[0][0]
+
+    async def _connect( self, url ):
+        port = url.port or ( 443 if url.scheme == 'https' else 80 )
+        context = ssl.create_default_context() if url.scheme == 'https' else None
+        reader, writer = await asyncio.open_connection( url.hostname, port, ssl=context )
+        return _Connection( reader, writer )
+
+    async def _send( self, conn, data ):
+        # returns the status line of the response
+        conn.writer.write( data )
+        await conn.writer.drain()
+        statusline = await conn.reader.readline()
+        if not statusline :
+            raise ConnectionResetError( 'connection closed by server' )
+        return statusline
+
+    async def _read_response( self, reader, statusline ):
+        # returns status, reason, headers (lower case names), body, and whether the connection can be reused
+        version, status, reason = ( statusline.decode( 'latin-1' ).rstrip( '\r\n' ).split( ' ', 2 ) + [ '' ] )[:3]
+        headers = {}
+        while True :
+            line = await reader.readline()
+            if line in ( b'\r\n', b'\n', b'' ):
+                break
+            name, value = line.decode( 'latin-1' ).split( ':', 1 )
+            headers[ name.strip().lower() ] = value.strip()
+
+        keepalive = version == 'HTTP/1.1' and headers.get( 'connection', '' ).lower() != 'close'
+        if 'content-length' in headers :
+            body = await reader.readexactly( int( headers['content-length'] ))
+        elif headers.get( 'transfer-encoding', '' ).lower() == 'chunked' :
+            chunks = []
+            while True :
+                size = int( ( await reader.readline() ).split( b';' )[0], 16 )
+                if not size :
+                    while ( await reader.readline() ) not in ( b'\r\n', b'\n', b'' ):
+                        pass # trailers
+                    break
+                chunks.append( await reader.readexactly( size ))
+                await reader.readline()
+            body = b''.join( chunks )
+        else:
+            body = await reader.read() # until the server closes the connection
+            keepalive = False
+        return int( status ), reason, headers, body, keepalive
+
+    def _acquire( self, server ):
+        now = time.time()
+        idle = self._idle.get( server, [] )
+        while idle :
+            conn = idle.pop()
+            if now - conn.timestamp < self._idle_timeout and not conn.reader.at_eof() :
+                return conn
+            conn.close()
+        return None
+
+    def _release( self, server, conn ):
+        conn.timestamp = time.time()
+        self._idle.setdefault( server, [] ).append( conn )
+
+    def close( self ):
+        "closes every idle connection"
+        idle, self._idle = self._idle, {}
+        for conns in idle.values() :
+            for conn in conns :
+                conn.close()
+
+# -------------------------------------------------------------------
+#
+# Keeps server nonces, per server, fetched in batches with get_nonces,
+# like _NoncePool, but refilled by a task rather than a thread.
+#
+class _AsyncNoncePool( object ) :
+
+    def __init__( self, transport, batchsize ):
+        self._transport = transport
+        self._batchsize = batchsize
+        self._nonces = {} # server -> deque of (timestamp, nonce), oldest first
+        self._refilling = set() # servers with a refill in flight
+        self._unbatched = set() # servers that do not support get_nonces
+        self._tasks = set() # refills in flight, referenced so they are not collected before they finish
+
+    async def get( self, server, fresh=False ):
+        "returns a nonce for the server, fetching one when none are available or when fresh is true"
+        now = time.time()
+        nonces = self._nonces.setdefault( server, collections.deque() )
+        if fresh :
+            nonces.clear()
+        while nonces :
+            timestamp, nonce = nonces.popleft()
+            if now - timestamp < NONCE_EXPIRY - NONCE_MARGIN :
+                if len( nonces ) < self._batchsize // 2 and server not in self._refilling :
+                    self._refilling.add( server )
+                    task = asyncio.ensure_future( self._refill( server ))
+                    self._tasks.add( task )
+                    task.add_done_callback( self._tasks.discard )
+                return nonce
+        return await self._fetch( server )
+
+    async def _fetch( self, server ):
+        # returns one nonce, keeping the rest of the batch for later calls
+        if self._batchsize < 2 or server in self._unbatched :
+            return await self._transport.request( server, 'get_nonce', [] )
+        try:
+            batch = await self._transport.request( server, 'get_nonces', [ self._batchsize ] )
+        except xmlrpc_lib.Fault :
+            # older servers can only issue one nonce at a time
+            self._unbatched.add( server )
+            return await self._transport.request( server, 'get_nonce', [] )
+        self._store( server, batch[1:] )
+        return batch[0]
+
+    def _store( self, server, batch ):
+        now = time.time()
+        self._nonces.setdefault( server, collections.deque() ).extend( (now, x) for x in batch )
+
+    def close( self ):
+        "cancels the refills in flight"
+        for task in list( self._tasks ):
+            task.cancel()
+
+    async def _refill( self, server ):
+        try:
+            self._store( server, await self._transport.request( server, 'get_nonces', [ self._batchsize ] ))
+        except xmlrpc_lib.Fault :
+            self._unbatched.add( server )
+        except Exception :
+            pass # the next call will fetch for itself
+        finally:
+            self._refilling.discard( server )
+
+# -------------------------------------------------------------------
+
+class AsyncRemoteClient( RemoteClient ) :
+    "RemoteClient whose server methods are coroutines"
+
+    def __init__( self, confdict, compileddoc, startingpath, notifier=None ):
+        super( AsyncRemoteClient, self ).__init__( confdict, compileddoc, startingpath, notifier )
+        defaults = conf.get_default_config()
+        encode_threshold = confdict.get( 'DIRB_GZIP_THRESHOLD', defaults['DIRB_GZIP_THRESHOLD'] )
+        self._transport = _AsyncTransport( confdict.get( 'DIRB_CONNECTION_IDLE_TIMEOUT', defaults['DIRB_CONNECTION_IDLE_TIMEOUT'] ), encode_threshold if encode_threshold > 0 else None )
+        self._asyncnonces = _AsyncNoncePool( self._transport, confdict.get( 'DIRB_NONCE_BATCH', defaults['DIRB_NONCE_BATCH'] ))
+
+    async def close( self ):
+        "Closes any idle connections to the servers"
+        super( AsyncRemoteClient, self ).close()
+        self._asyncnonces.close()
+        self._transport.close()
+
+    # ===========================================
+
+    async def _replace_async_args( self, server, method, args, kwargs, fresh, fulldoc ):
+        # as RemoteClient._replace_args
+        if self._use_sessions and server not in self._unsessioned :
+            username = self._get_user( method._rpc_args.user, args, kwargs )
+            token = await self._get_async_session( server, username, fresh )
+            if token is not None :
+                return self._build_args( method, args, kwargs, None, fulldoc, token )
+        servernonce = await self._asyncnonces.get( server, fresh )
+        return self._build_args( method, args, kwargs, servernonce, fulldoc )
+
+    async def _get_async_session( self, server, username, fresh ):
+        # as RemoteClient._get_session
+        token = None if fresh else self._cached_session( server, username )
+        if token is None :
+            user = tuple( auth.get_user_credentials( username, self._conf, await self._asyncnonces.get( server, fresh )))
+            try:
+                token = self._store_session( server, username, await self._transport.request( server, 'open_session', [ user ] ))
+            except xmlrpc_lib.Fault as e :
+                if 'Permission Denied' in e.faultString :
+                    raise
+                self._unsessioned.add( server )
+        return token
+
+    # ===========================================
+
+    async def _invoke( self, server, method, args, kwargs ):
+        "calls the server method, after replacing arguments"
+        fresh = False
+        fulldoc = False
+        while True :
+            newargs, newkw = await self._replace_async_args( server, method, args, kwargs, fresh, fulldoc )
+            try:
+                return await self._transport.request( server, method.__name__, newargs )
+            except xmlrpc_lib.Fault as e :
+                if UNKNOWN_SCHEMA in e.faultString and not fulldoc :
+                    # first use of the schema on this server, send the whole document:
+                    fulldoc = True
+                elif 'Permission Denied' in e.faultString and not fresh :
+                    # prefetched nonces are lost when a server restarts, so try once more with a fresh one:
+                    fresh = True
+                else:
+                    raise
+
+    # ===========================================
+
+    async def _timed_invoke( self, server, method, args, kwargs, timeout=None ):
+        # records the outcome with the server selector, as RemoteClient does
+        start = time.time()
+        try:
+            ret = await asyncio.wait_for( self._invoke( server, method, args, kwargs ), timeout )
+        except asyncio.TimeoutError : # not a socket.error before python 3.11
+            self._failed( server )
+            raise socket.timeout( 'timed out' )
+        except socket.error :
+            self._failed( server )
+            raise
+        except xmlrpc_lib.Fault :
+            self._succeeded( server, start )
+            raise
+        self._succeeded( server, start )
+        return ret
+
+    # ===========================================
+
+    # if a server fails, then notify and try the others, as RemoteClient does, without a timeout
+    async def _call_one( self, method, *args, **kwargs ):
+        tried = []
+        while True :
+            server = self._pick_one( tried )
+            try:
+                return await self._timed_invoke( server, method, args, kwargs )
+            except socket.error :
+                tried.append( server )
+                if len( tried ) == len( self._server_list ):
+                    raise # pass the socket.error on up
+
+    # ===========================================
+
+    async def _call_all( self, method, *args, **kwargs ):
+        # calls every available server concurrently, each bounded by DIRB_RPC_TIMEOUT,
+        # a server that fails gives its exception as its result
+        async def call( server ):
+            try:
+                return await self._timed_invoke( server, method, args, kwargs, self._broadcast_timeout )
+            except Exception as e :
+                return e
+
+        servers = self._selector.available()
+        ret = dict( zip( servers, await asyncio.gather( *[ call( x ) for x in servers ] )))
+
+        failed = [ x for x in servers if isinstance( ret[x], socket.error ) ]
+        if failed and len( failed ) == len( servers ) :
+            raise ret[ failed[0] ] # pass the socket.error on up
+
+        return ret
+
+# -------------------------------------------------------------------
+
+def _make_async_api( kind, fn, transcoder ):
+    if kind == 'one' :
+        async def api( client, *args, **kwargs ):
+            ret = await client._call_one( fn, *args, **kwargs )
+            return transcoder( ret ) if transcoder else ret
+    elif kind == 'all' :
+        async def api( client, *args, **kwargs ):
+            ret = await client._call_all( fn, *args, **kwargs )
+            return transcoder( ret ) if transcoder else ret
+    else:
+        server_index = fn._rpc_args.server
+        async def api( client, *args, **kwargs ):
+            ret = await client._timed_invoke( args[server_index], fn, args, kwargs )
+            return transcoder( ret ) if transcoder else ret
+    api.__doc__ = fn.__doc__
+    api.__name__ = fn.__name__
+    api._rpc = ( kind, fn, transcoder )
+    return api
+
+def mirror_rpc_methods( asynccls, cls ):
+    "gives asynccls a coroutine for each server method generated on cls (and its bases)"
+    for klass in reversed( cls.__mro__ ):
+        for name, value in list( vars( klass ).items() ):
+            rpc = getattr( value, '_rpc', None )
+            if rpc is not None :
+                setattr( asynccls, name, _make_async_api( *rpc ))
+
+mirror_rpc_methods( AsyncRemoteClient, RemoteClient )
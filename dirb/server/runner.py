@@ -0,0 +1,352 @@
+#####################################################################
+#
+# Copyright 2015 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#####################################################################
+
+#
+# A standalone server for ServerApp:
+#
+#    python -m dirb.server.runner --port 8000 --threads 16 --workers 4
+#
+# Connections are served by a fixed pool of threads (DIRBSERVER_THREADS),
+# and kept open between requests (DIRBSERVER_KEEPALIVE_TIMEOUT) so clients can reuse them.
+# A thread waiting on an idle connection is taken back when new connections wait for a thread.
+# With DIRBSERVER_WORKERS, the listening socket is shared by that many pre-forked
+# worker processes, each with its own pool of threads.  A nonce may be issued by one
+# worker and presented to another, so the workers share one nonce cache,
+# held by a manager process.
+#
+# SIGTERM or SIGINT, or a shutdown_server call, stops the server gracefully:
+# it stops accepting connections, and finishes the requests in progress.
+#
+
+try: # version-proof
+    import queue
+except ImportError :
+    import Queue as queue
+
+from . import ServerApp, _NonceCache
+from .. import conf
+
+import wsgi_xmlrpc
+
+import wsgiref.simple_server
+import multiprocessing
+import multiprocessing.managers
+import argparse
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+# -------------------------------------------------------------------
+
+class _ServerHandler( wsgiref.simple_server.ServerHandler ):
+    http_version = '1.1' # so that clients keep the connection open
+
+    def cleanup_headers( self ):
+        # decides here, while the status is known: run() resets it on close
+        wsgiref.simple_server.ServerHandler.cleanup_headers( self )
+        request_handler = self.request_handler
+        if not self.status.startswith( '200' ) or 'Content-Length' not in self.headers or request_handler.server.is_busy() :
+            # the request body may not have been read, see WSGIXMLRPCApplication.handle_POST
+            request_handler.close_connection = True
+        if request_handler.close_connection or request_handler.server.stopping :
+            request_handler.close_connection = True
+            self.headers['Connection'] = 'close'
+
+    def handle_error( self ):
+        # the response may be incomplete
+        self.request_handler.close_connection = True
+        wsgiref.simple_server.ServerHandler.handle_error( self )
+
+class _KeepAliveHandler( wsgiref.simple_server.WSGIRequestHandler ):
+    "serves requests on a connection until the client closes it, goes quiet, or the server stops"
+    protocol_version = 'HTTP/1.1'
+
+    def setup( self ):
+        self.timeout = self.server.keepalive
+        wsgiref.simple_server.WSGIRequestHandler.setup( self )
+
+    def handle( self ):
+        self.close_connection = True
+        self._handle_one()
+        while not self.close_connection and not self.server.stopping :
+            self._handle_one()
+
+    def _handle_one( self ):
+        # follows WSGIRequestHandler.handle, which serves one request per connection
+        if not self.server.set_idle( self.connection, True ):
+            self.close_connection = True # its thread is wanted by a waiting connection
+            return
+        try:
+            self.raw_requestline = self.rfile.readline( 65537 )
+        except socket.error : # timed out, or closed by stop()
+            self.raw_requestline = ''
+        finally:
+            self.server.set_idle( self.connection, False )
+        if not self.raw_requestline :
+            self.close_connection = True
+            return
+        if len( self.raw_requestline ) > 65536 :
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error( 414 )
+            self.close_connection = True
+            return
+        if not self.parse_request() :
+            return
+
+        handler = _ServerHandler( self.rfile, self.wfile, self.get_stderr(), self.get_environ(), multithread=True, multiprocess=self.server.multiprocess )
+        handler.request_handler = self
+        handler.run( self.server.get_app() ) # sets close_connection, see _ServerHandler
+
+    def log_message( self, format, *args ):
+        logging.getLogger( 'dirbserver' ).debug( "%s %s" % ( self.address_string(), format % args ))
+
+# -------------------------------------------------------------------
+
+class PooledWSGIServer( wsgiref.simple_server.WSGIServer ):
+    "serves each connection on one of a fixed number of threads"
+
+    request_queue_size = 128
+    allow_reuse_address = True
+
+    def __init__( self, address, threads, keepalive ):
+        wsgiref.simple_server.WSGIServer.__init__( self, address, _KeepAliveHandler )
+        self.keepalive = keepalive
+        self.stopping = False
+        self.multiprocess = False
+        self._threadcount = threads
+        self._threads = []
+        self._requests = queue.Queue()
+        self._idle = set() # connections waiting for their next request
+        self._idlelock = threading.Lock()
+        self._free = 0 # threads waiting for a connection
+
+    def process_request( self, request, client_address ):
+        self._requests.put( ( request, client_address ) )
+        self._reclaim_idle()
+
+    def is_busy( self ):
+        "true when connections are waiting for a thread"
+        return self._requests.qsize() > self._free
+
+    def _reclaim_idle( self ):
+        # a thread waiting on an idle connection is wanted by a connection waiting for a thread:
+        # close the idle connection, so that its client reconnects when it needs to
+        self._idlelock.acquire( True )
+        try:
+            waiting = self._requests.qsize() - self._free
+            while waiting > 0 and self._idle :
+                connection = self._idle.pop()
+                try:
+                    connection.shutdown( socket.SHUT_RDWR )
+                except socket.error :
+                    pass
+                waiting -= 1
+        finally:
+            self._idlelock.release()
+
+    def _serve_requests( self ):
+        while True :
+            self._count_free( 1 )
+            try:
+                item = self._requests.get()
+            finally:
+                self._count_free( -1 )
+            if item is None :
+                return
+            request, client_address = item
+            try:
+                self.finish_request( request, client_address )
+            except Exception :
+                self.handle_error( request, client_address )
+            finally:
+                self.shutdown_request( request )
+
+    def handle_error( self, request, client_address ):
+        logging.getLogger( 'dirbserver' ).exception( "Error serving %s" % ( client_address, ))
+
+    def _count_free( self, delta ):
+        self._idlelock.acquire( True )
+        try:
+            self._free += delta
+        finally:
+            self._idlelock.release()
+
+    def set_idle( self, connection, idle ):
+        "returns false when the connection may not go idle, because connections are waiting for a thread"
+        self._idlelock.acquire( True )
+        try:
+            if not idle :
+                self._idle.discard( connection )
+            elif self._requests.qsize() > self._free :
+                return False
+            else:
+                self._idle.add( connection )
+            return True
+        finally:
+            self._idlelock.release()
+
+    def run( self, poll_interval=0.5 ):
+        "serves until stop(), then waits for the requests in progress"
+        self._threads = [ threading.Thread( target=self._serve_requests ) for x in range( self._threadcount ) ]
+        for thread in self._threads :
+            thread.daemon = True
+            thread.start()
+        try:
+            self.serve_forever( poll_interval )
+        finally:
+            self.stopping = True
+            self._idlelock.acquire( True )
+            try:
+                for connection in self._idle :
+                    try:
+                        connection.shutdown( socket.SHUT_RDWR )
+                    except socket.error :
+                        pass
+            finally:
+                self._idlelock.release()
+            for thread in self._threads :
+                self._requests.put( None )
+            for thread in self._threads :
+                thread.join()
+            self.server_close()
+
+    def stop( self ):
+        "asks run() to finish, safe to call from any thread and from signal handlers"
+        self.stopping = True
+        thread = threading.Thread( target=self.shutdown ) # shutdown() waits for the serving thread
+        thread.daemon = True
+        thread.start()
+
+# -------------------------------------------------------------------
+
+class _NonceManager( multiprocessing.managers.BaseManager ):
+    pass
+
+_NonceManager.register( 'NonceCache', _NonceCache )
+
+def _ignore_interrupt():
+    # the manager must outlive the workers, which stop on the same ctrl-c
+    signal.signal( signal.SIGINT, signal.SIG_IGN )
+
+def _get_fork_context():
+    # the workers inherit the listening socket, so they must be forked
+    try:
+        return multiprocessing.get_context( 'fork' )
+    except AttributeError : # python 2
+        return multiprocessing
+
+def _on_signals( fn ):
+    for signum in ( signal.SIGTERM, signal.SIGINT ):
+        signal.signal( signum, lambda signum, frame : fn() )
+
+# -------------------------------------------------------------------
+
+def make_server( config, address ):
+    "returns a PooledWSGIServer bound to address, configured by the DIRBSERVER settings"
+    defaults = conf.get_default_server_config()
+    setting = lambda key : config.get( key, defaults[key] )
+    return PooledWSGIServer( address, setting( 'DIRBSERVER_THREADS' ), setting( 'DIRBSERVER_KEEPALIVE_TIMEOUT' ))
+
+def make_application( app, config ):
+    "returns the wsgi application serving app"
+    defaults = conf.get_default_server_config()
+    max_request_size = config.get( 'DIRBSERVER_MAX_REQUEST_SIZE', defaults['DIRBSERVER_MAX_REQUEST_SIZE'] )
+    return wsgi_xmlrpc.WSGIXMLRPCApplication( app, max_request_size=max_request_size if max_request_size > 0 else None )
+
+def _run_worker( httpd, app ):
+    # in a forked worker: a shutdown_server call stops the runner, which stops every worker
+    app.set_shutdown_callable( lambda : os.kill( os.getppid(), signal.SIGTERM ))
+    _on_signals( httpd.stop )
+    httpd.run()
+
+def serve( config, address, logginglevel=logging.INFO ):
+    "serves ServerApp on address (host, port) until it is shut down; call from the main thread"
+    defaults = conf.get_default_server_config()
+    workers = config.get( 'DIRBSERVER_WORKERS', defaults['DIRBSERVER_WORKERS'] )
+    httpd = make_server( config, address )
+    url = 'http://%s:%d/' % ( address[0] or socket.getfqdn(), httpd.server_address[1] )
+
+    if workers < 1 :
+        app = ServerApp( url, config, logginglevel )
+        httpd.set_app( make_application( app, config ))
+        app.set_shutdown_callable( httpd.stop )
+        _on_signals( httpd.stop )
+        httpd.run()
+        return
+
+    context = _get_fork_context()
+    try:
+        manager = _NonceManager( ctx=context )
+    except TypeError : # python 2
+        manager = _NonceManager()
+    manager.start( _ignore_interrupt )
+    try:
+        app = ServerApp( url, config, logginglevel, manager.NonceCache() )
+        httpd.set_app( make_application( app, config ))
+        httpd.multiprocess = True
+        httpd.socket.setblocking( False ) # a worker must not block in accept when another worker wins the connection
+
+        logger = logging.getLogger( 'dirbserver' )
+        stopping = []
+        _on_signals( lambda : stopping.append( True ))
+        processes = []
+        while not stopping :
+            processes = [ x for x in processes if x.is_alive() ]
+            if len( processes ) < workers :
+                if processes :
+                    logger.warning( "Restarting a worker process" )
+                while len( processes ) < workers :
+                    process = context.Process( target=_run_worker, args=( httpd, app ))
+                    process.start()
+                    processes.append( process )
+            time.sleep( 0.2 )
+
+        logger.info( "Stopping %d worker processes" % len( processes ))
+        for process in processes :
+            process.terminate() # SIGTERM, each worker finishes its requests in progress
+        for process in processes :
+            process.join()
+    finally:
+        httpd.server_close()
+        manager.shutdown()
+
+# -------------------------------------------------------------------
+
+def main( argv=None ):
+    parser = argparse.ArgumentParser( description="Serves the dirb server application" )
+    parser.add_argument( '--host', default='', help="interface to listen on, all by default" )
+    parser.add_argument( '--port', type=int, default=8000 )
+    parser.add_argument( '--threads', type=int, help="threads serving connections, in each worker process (DIRBSERVER_THREADS)" )
+    parser.add_argument( '--workers', type=int, help="pre-forked worker processes, 0 for none (DIRBSERVER_WORKERS)" )
+    parser.add_argument( '--verbose', action='store_true' )
+    args = parser.parse_args( argv )
+
+    config = conf.get_default_server_config()
+    if args.threads is not None :
+        config['DIRBSERVER_THREADS'] = args.threads
+    if args.workers is not None :
+        config['DIRBSERVER_WORKERS'] = args.workers
+    serve( config, ( args.host, args.port ), logging.DEBUG if args.verbose else logging.INFO )
+
+if __name__ == '__main__':
+    main()
@@ -22,9 +22,49 @@ import dirb.ds as ds
 import dirb.localclient as localclient
 import dirb.sexpr as sexpr
 import dirb.pathexpr as pathexpr
+import dirb.auth as auth
+import dirb.conf as conf
+import dirb.server as server
+import dirb.server.runner as runner
+
+import wsgi_xmlrpc
 
 import unittest
+import base64
+import contextlib
+import gc
+import grp
+import io
+import pwd
+import json
 import os
+import logging
+import multiprocessing.pool
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import threading
+import wsgiref.simple_server
+import zlib
+
+try: # version-proof
+  import socketserver
+except ImportError :
+  import SocketServer as socketserver
+
+try: # version-proof
+  import http.client as http_client
+except ImportError :
+  import httplib as http_client
+
+try:
+  import asyncio
+  import dirb.server.asyncclient as asyncclient
+except ( ImportError, SyntaxError ): # python 2
+  asyncclient = None
 
 # ==========================================
 class SimpleSexprTest(unittest.TestCase):
@@ -153,6 +193,26 @@ class SimpleLocalClientTest(unittest.TestCase):
     expected = sorted( [ sorted( x.items() ) for x in expected ] )
     self.assertEqual(found, expected)
     
+  # ----------------------------------------
+  def test_resolve_bookmark(self):
+    parameters = {'show':'show', 'sequence':'bb', 'shot':'xx', 'dept':'lighting'}
+    found = self.d.resolve_bookmark( 'workarea', parameters )
+    self.assertEqual( [x.path for x in found], ['/tmp/dirbtest1/projects/show/sequence/bb/xx/lighting'] )
+    self.assertEqual( found[0].parameters, parameters )
+    self.assertEqual( found[0].bookmarks, ['workarea'] )
+    # the same answer as the traversal:
+    expected = self.d.depict_paths( '(and (bookmark workarea) (parameters (show show)(sequence bb)(shot xx)(dept lighting)))' )
+    self.assertEqual( found, expected )
+    
+  # ----------------------------------------
+  def test_resolve_bookmark_existing(self):
+    parameters = {'show':'show', 'sequence':'bb', 'shot':'yy', 'dept':'lighting', 'assettype':'vehicle', 'asset':'car1'}
+    found = self.d.resolve_bookmark( 'workarea', parameters )
+    self.assertEqual( len(found), 2 )
+    found = self.d.resolve_bookmark( 'workarea', parameters, existing=True )
+    self.assertEqual( [x.path for x in found], ['/tmp/dirbtest1/projects/show/asset/vehicle/car1/lighting'] )
+    self.assertRaises( KeyError, self.d.resolve_bookmark, 'workarea', {'show':'show', 'assettype':'vehicle', 'asset':'car1', 'dept':'DEPT'} )
+    
   # ----------------------------------------
   def test_search_paths_and(self):
     searchexpr = '(and (bookmark shotroot) (parameters (show show)(shot xx)(sequence bb)))'
@@ -324,6 +384,62 @@ class SimpleLocalClientTest(unittest.TestCase):
     found = self.d.get_path_context( targetpath )
     self.assertEqual( found, None )
   
+  # ----------------------------------------
+  def test_match_path( self ):
+    # the path index gives the same answers as the traversal:
+    targetpaths = (
+      '/tmp/dirbtest1/projects',
+      '/tmp/dirbtest1/projects/show/asset/vehicle/car1/lighting',
+      '/tmp/dirbtest1/projects/show/sequence/bb',
+      '/tmp/dirbtest1/projects/newshow/asset/character/bigguy/animation',
+      '/tmp/dirbtest1/projects/SHOW/sequence/SEQUENCE/SHOT/animation/application/scenes/filename.scene',
+      '/tmp/dirbtest1/projects/SHOW/editorial/workarea',
+      '/tmp/dirbtest1/thing/SHOW' )
+    for targetpath in targetpaths:
+      self.assertEqual( self.d.match_path( targetpath ), self.d.get_path_context( targetpath ) )
+    
+  # ----------------------------------------
+  def test_match_path_badcollection( self ):
+    targetpath = '/tmp/dirbtest1/projects/falseshow/asset/set/castle/infantry'
+    # department value is not a member of the department collection, so the deepest valid context is returned
+    found = self.d.match_path( targetpath )
+    self.assertEqual( found.path, '/tmp/dirbtest1/projects/falseshow/asset/set/castle' )
+    self.assertEqual( found.bookmarks, ['assetroot'] )
+  
+  # ----------------------------------------
+  def test_depict_paths_batch( self ):
+    # each expression gets the same answer as it would alone, even when the expressions overlap:
+    createexprs = (
+      '(parameters (show S)(sequence Q)(shot T1)(dept lighting))',
+      '(parameters (show S)(sequence Q)(shot T2)(dept animation))',
+      '(parameters (show S)(sequence Q))',
+      '(and (bookmark shotroot) (parameters (show S)(sequence Q)(shot T3)))',
+      '(bookmark workarea)' )
+    found = self.d.depict_paths_batch( createexprs )
+    self.assertEqual( len( found ), len( createexprs ))
+    for createexpr, foundlist in zip( createexprs, found ):
+      self.assertEqual( foundlist, self.d.depict_paths( createexpr ))
+    
+  # ----------------------------------------
+  def test_estimate_depict_paths( self ):
+    createexpr = '(parameters (show S)(sequence Q)(shot T1)(dept lighting))'
+    self.assertEqual( self.d.estimate_depict_paths( createexpr ), len( self.d.depict_paths( createexpr )))
+    # the estimate is an upper bound, when the expression prunes paths:
+    createexpr = '(and (bookmark shotroot) (parameters (show S)(sequence Q)(shot T3)))'
+    self.assertTrue( self.d.estimate_depict_paths( createexpr ) >= len( self.d.depict_paths( createexpr )))
+    # and grows with the product of the values:
+    createexpr = '(or %s)' % ' '.join( '(parameters (show S)(sequence Q)(shot T%d)(dept %s))' % (x, y) for x in range(10) for y in ('lighting','animation'))
+    self.assertEqual( self.d.estimate_depict_paths( createexpr ), 4 + 10 + 10 * 2 ) # show, asset, sequence, sequence value, then shots and departments
+    
+  # ----------------------------------------
+  def test_compiled_digest( self ):
+    # the digest identifies the content, and survives marshaling of tuples into lists:
+    digest = ds.get_compiled_digest( self.d._doc )
+    marshaled = json.loads( json.dumps( self.d._doc ) )
+    self.assertEqual( ds.get_compiled_digest( marshaled ), digest )
+    marshaled['collections']['department'].append( 'compositing' )
+    self.assertNotEqual( ds.get_compiled_digest( marshaled ), digest )
+    
   # ----------------------------------------
   def test_get_frontier_contexts_root( self ):
     targetpath = '/tmp/dirbtest1/projects'
@@ -745,6 +861,32 @@ class SimpleGlobTest1(unittest.TestCase):
     
   # ----------------------------------------
   
+  def test_bookmark_parameters(self):
+    found = self.d.get_bookmark_parameters('assetroot')
+    expected = [{'show': None, 'assettype': 'assettype', 'assetname': None}]
+    self.assertEqual( found, expected )
+    found = self.d.get_bookmark_parameters('workarea')
+    found = sorted( [ sorted(x.items()) for x in found ] )
+    expected = [{'show': None, 'sequence': None, 'shot': None, 'dept': 'department'}, {'show': None, 'assettype': 'assettype', 'assetname': None, 'dept': 'department'}]
+    expected = sorted( [ sorted( x.items() ) for x in expected ] )
+    self.assertEqual( found, expected )
+    self.assertEqual( self.d.get_bookmark_parameters('nosuchbookmark'), [] )
+    
+  # ----------------------------------------
+  
+  def test_match_path(self):
+    found = self.d.match_path( '/tmp/dirbtest4/projects/show/veh_car1/lighting' )
+    self.assertEqual( found.parameters, {'show': 'show', 'assettype': 'veh', 'assetname': 'car1', 'dept': 'lighting'} )
+    self.assertEqual( found.attributes, {'areatype': 'assets'} )
+    self.assertEqual( found.bookmarks, ['workarea'] )
+    found = self.d.match_path( '/tmp/dirbtest4/projects/show/100x140/animation/scenes' )
+    self.assertEqual( found.path, '/tmp/dirbtest4/projects/show/100x140/animation' )
+    self.assertEqual( found.parameters, {'show': 'show', 'sequence': '100', 'shot': '140', 'dept': 'animation'} )
+    found = self.d.match_path( '/tmp/dirbtest4/projects/show/dontfind_blank/lighting' )
+    self.assertEqual( found.path, '/tmp/dirbtest4/projects/show' )
+    
+  # ----------------------------------------
+  
   def test_simple_depict1(self):
     createexpr = '(parameters (show diehard)(sequence 999)(shot 888)(dept lighting))'
     foundlist = self.d.depict_paths( createexpr )
@@ -806,6 +948,1079 @@ class SimpleGlobTest1(unittest.TestCase):
   def tearDown(self):
     pass
 
+#####################################################################
+class SimpleIdentityCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache = auth.IdentityCache( 60 )
+    self.username = auth.get_username()
+    
+  # ----------------------------------------
+  def test_getpwnam( self ):
+    first = self.cache.getpwnam( self.username )
+    second = self.cache.getpwnam( self.username )
+    self.assertEqual( first, second )
+    stats = self.cache.stats()
+    self.assertEqual( ( stats['hits'], stats['misses'] ), ( 1, 1 ))
+    
+  # ----------------------------------------
+  def test_unknown( self ):
+    # unknown names are cached, and still raise:
+    self.assertRaises( KeyError, self.cache.getgrnam, 'dirb_no_such_group' )
+    self.assertRaises( KeyError, self.cache.getgrnam, 'dirb_no_such_group' )
+    stats = self.cache.stats()
+    self.assertEqual( ( stats['hits'], stats['misses'] ), ( 1, 1 ))
+    
+  # ----------------------------------------
+  def test_expiry( self ):
+    cache = auth.IdentityCache( 0 )
+    cache.getpwnam( self.username )
+    cache.getpwnam( self.username )
+    self.assertEqual( cache.stats()['misses'], 2 )
+  
+#####################################################################
+class SimpleMethodPermissionsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.conf = conf.get_default_server_config()
+    self.conf['DIRB_AUTHPATH'] = tempfile.mkdtemp()
+    self.username = auth.get_username()
+    self.logger = logging.getLogger( 'test' )
+    self.logger.setLevel( logging.CRITICAL )
+    
+  # ----------------------------------------
+  def test_getgroups( self ):
+    perms = auth.MethodPermissions( self.conf, self.logger )
+    expected = set( x.gr_name for x in grp.getgrall() if self.username in x.gr_mem )
+    expected.add( grp.getgrgid( pwd.getpwnam( self.username ).pw_gid ).gr_name )
+    self.assertEqual( perms._getgroups( self.username ), expected )
+    self.assertTrue( perms._get_group_index() is perms._get_group_index() ) # built once per expiry
+    
+  # ----------------------------------------
+  def test_verify( self ):
+    primary = grp.getgrgid( pwd.getpwnam( self.username ).pw_gid ).gr_name
+    with open( os.path.join( self.conf['DIRB_AUTHPATH'], '_dirb_methods.json' ), 'w' ) as f :
+      json.dump( { 'mine' : { 'groups' : [ primary ] }, 'theirs' : { 'groups' : [ 'dirb_no_such_group' ] }, 'named' : { 'users' : [ self.username ] } }, f )
+    perms = auth.MethodPermissions( self.conf, self.logger )
+    self.assertTrue( perms.verify( self.username, 'mine' ))
+    self.assertFalse( perms.verify( self.username, 'theirs' ))
+    self.assertTrue( perms.verify( self.username, 'named' ))
+    self.assertTrue( perms.verify( self.username, 'unlisted' ))
+    
+  # ----------------------------------------
+  def test_decisions( self ):
+    primary = grp.getgrgid( pwd.getpwnam( self.username ).pw_gid ).gr_name
+    with open( os.path.join( self.conf['DIRB_AUTHPATH'], '_dirb_methods.json' ), 'w' ) as f :
+      json.dump( { 'mine' : { 'groups' : [ primary ] } }, f )
+    perms = auth.MethodPermissions( self.conf, self.logger )
+    for i in range( 3 ):
+      self.assertTrue( perms.verify( self.username, 'mine' ))
+    stats = perms.get_decision_stats()
+    # the first decision is retired by the group index built to make it:
+    self.assertEqual( ( stats['hits'], stats['misses'], stats['size'] ), ( 1, 2, 1 ))
+    # a new group index retires the decisions:
+    perms._grdate -= perms._deltatime * 2
+    perms._getgroups( self.username )
+    self.assertTrue( perms.verify( self.username, 'mine' ))
+    self.assertEqual( perms.get_decision_stats()['misses'], 3 )
+    
+  # ----------------------------------------
+  def test_refresh( self ):
+    filename = os.path.join( self.conf['DIRB_AUTHPATH'], '_dirb_methods.json' )
+    with open( filename, 'w' ) as f :
+      json.dump( { 'method' : { 'users' : [ 'dirb_nobody' ] } }, f )
+    self.conf['DIRBSERVER_PERMISSIONS_EXPIRY'] = 0
+    perms = auth.MethodPermissions( self.conf, self.logger )
+    self.assertFalse( perms.verify( self.username, 'method' ))
+    snapshot = perms._get_permissions()
+    self.assertTrue( perms._get_permissions() is snapshot ) # unchanged file, not read again
+    with open( filename, 'w' ) as f :
+      json.dump( { 'method' : { 'users' : [ 'dirb_nobody', self.username ] } }, f )
+    self.assertTrue( perms.verify( self.username, 'method' ))
+    with open( filename, 'w' ) as f :
+      f.write( '{ "method" : ' ) # half written, the last good permissions stand
+    self.assertTrue( perms.verify( self.username, 'method' ))
+    os.remove( filename )
+    self.assertTrue( perms.verify( self.username, 'other' ))
+    
+#####################################################################
+class SimpleSecretCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.conf = { 'DIRB_AUTHPATH' : tempfile.mkdtemp(), 'DIRB_AUTH_RECHECK' : 60 }
+    self.username = auth.get_username()
+    
+  # ----------------------------------------
+  def test_credentials( self ):
+    nonce = base64.b64encode( auth.get_nonce() ).decode( 'utf-8' )
+    cred = auth.get_user_credentials( self.username, self.conf, nonce ) # creates the secret file
+    self.assertTrue( auth.verify_user_credentials( cred, self.conf ))
+    self.assertFalse( auth.verify_user_credentials( cred._replace( pwhash='0' ), self.conf ))
+    
+  # ----------------------------------------
+  def test_recheck( self ):
+    cache = auth.SecretCache()
+    filename = os.path.join( self.conf['DIRB_AUTHPATH'], 'secret.bin' )
+    with open( filename, 'wb' ) as f :
+      f.write( b'first' )
+    self.assertEqual( cache.get( filename, 60 ), b'first' )
+    with open( filename, 'wb' ) as f :
+      f.write( b'second' )
+    self.assertEqual( cache.get( filename, 60 ), b'first' ) # trusted until the recheck
+    self.assertEqual( cache.get( filename, 0 ), b'second' ) # changed size
+    self.assertEqual( cache.get( filename, 0 ), b'second' )
+    stats = cache.stats()
+    self.assertEqual( ( stats['hits'], stats['stats'], stats['reads'] ), ( 1, 3, 2 ))
+    os.remove( filename )
+    self.assertRaises( OSError, cache.get, filename, 0 )
+    self.assertEqual( cache.stats()['size'], 0 )
+    
+#####################################################################
+class SimpleSessionTokenTest(unittest.TestCase):
+
+  def setUp(self):
+    self.secret = b'secret'
+    
+  # ----------------------------------------
+  def test_token( self ):
+    token = auth.make_session_token( 'someone', time.time() + 60, self.secret )
+    self.assertTrue( auth.verify_session_token( token, 'someone', self.secret ))
+    self.assertFalse( auth.verify_session_token( token, 'other', self.secret ))
+    self.assertFalse( auth.verify_session_token( token, 'someone', b'other secret' ))
+    
+  # ----------------------------------------
+  def test_expired( self ):
+    token = auth.make_session_token( 'someone', time.time() - 1, self.secret )
+    self.assertFalse( auth.verify_session_token( token, 'someone', self.secret ))
+    
+  # ----------------------------------------
+  def test_tampered( self ):
+    token = auth.make_session_token( 'someone', time.time() + 60, self.secret )
+    payload, signature = token.split( '.' )
+    forged = base64.urlsafe_b64encode( ( 'someone:%d' % ( time.time() + 6000 )).encode( 'utf-8' )).decode( 'utf-8' )
+    self.assertFalse( auth.verify_session_token( '%s.%s' % ( forged, signature ), 'someone', self.secret ))
+    for bad in ( '', 'x', 'x.y', payload, '%s.%s' % ( payload, u'\u00e9' * 64 ) ):
+      self.assertFalse( auth.verify_session_token( bad, 'someone', self.secret ))
+    
+#####################################################################
+class SimpleNonceCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache = server._NonceCache()
+    
+  # ----------------------------------------
+  def test_consume_once( self ):
+    self.cache.add( [ 'a', 'b' ] )
+    self.assertTrue( self.cache.consume( 'a' ))
+    self.assertFalse( self.cache.consume( 'a' ))
+    self.assertFalse( self.cache.consume( 'unknown' ))
+    self.assertEqual( self.cache.size(), 1 )
+    
+  # ----------------------------------------
+  def test_expiry( self ):
+    self.cache.add( [ 'a', 'b' ], 1000.0 )
+    self.assertTrue( self.cache.consume( 'a', 1000.0 + server.NONCE_EXPIRY - 1 ))
+    self.assertFalse( self.cache.consume( 'b', 1000.0 + server.NONCE_EXPIRY ))
+    
+  # ----------------------------------------
+  def test_drop_buckets( self ):
+    self.cache.add( [ 'n%d' % x for x in range( 1000 ) ], 1000.0 )
+    self.cache.add( [ 'later%d' % x for x in range( 1000 ) ], 1000.0 + server.NONCE_EXPIRY + server.NONCE_BUCKET )
+    # every shard has had an addition since the first batch expired:
+    self.assertEqual( self.cache.size(), 1000 )
+  
+#####################################################################
+class SimpleServerSelectorTest(unittest.TestCase):
+
+  def setUp(self):
+    self.selector = server._ServerSelector( [ 'a', 'b', 'c' ], 0 )
+    
+  # ----------------------------------------
+  def test_prefers_faster( self ):
+    for x in range( 5 ):
+      self.selector.success( 'a', 0.5 )
+      self.selector.success( 'b', 0.01 )
+      self.selector.success( 'c', 1.0 )
+    picks = [ self.selector.pick() for x in range( 200 ) ]
+    # the slowest server never wins a comparison, the fastest wins every one it is in:
+    self.assertEqual( picks.count( 'c' ), 0 )
+    self.assertTrue( picks.count( 'b' ) > picks.count( 'a' ))
+    
+  # ----------------------------------------
+  def test_failure( self ):
+    self.selector = server._ServerSelector( [ 'a', 'b', 'c' ], 60 )
+    self.assertTrue( self.selector.failure( 'a' ))
+    self.assertFalse( self.selector.failure( 'a' )) # only reported once
+    self.assertTrue( 'a' not in [ self.selector.pick() for x in range( 50 ) ] )
+    self.assertEqual( self.selector.available(), [ 'b', 'c' ] )
+    self.assertEqual( self.selector.pick( [ 'b', 'c' ] ), 'a' ) # down, but the only choice
+    self.assertEqual( self.selector.pick( [ 'a', 'b', 'c' ] ), None )
+    stats = self.selector.stats()
+    self.assertTrue( stats['a']['down'] )
+    self.assertEqual( ( stats['a']['calls'], stats['a']['failures'], stats['a']['backoff'] ), ( 2, 2, 120 ))
+    
+  # ----------------------------------------
+  def test_probe( self ):
+    # with no backoff the failed server is probed on the next pick, and re-admitted when it answers:
+    self.selector.failure( 'a' )
+    self.assertEqual( self.selector.pick(), 'a' )
+    self.selector.success( 'a', 0.1 )
+    self.assertFalse( self.selector.stats()['a']['down'] )
+    self.assertEqual( self.selector.available(), [ 'a', 'b', 'c' ] )
+  
+#####################################################################
+class SimpleProxyPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.url = 'http://127.0.0.1:1/' # never called
+    self.pool = server._ProxyPool( 60 )
+    
+  # ----------------------------------------
+  def test_reuse( self ):
+    proxy = self.pool.acquire( self.url )
+    self.assertFalse( self.pool.acquire( self.url ) is proxy ) # in use
+    self.pool.release( self.url, proxy )
+    self.assertTrue( self.pool.acquire( self.url ) is proxy )
+    self.assertFalse( self.pool.acquire( 'http://127.0.0.1:2/' ) is proxy ) # per server
+    # the timeout is set for each use:
+    proxy = self.pool.acquire( self.url, 5 )
+    self.assertEqual( proxy( 'transport' ).timeout, 5 )
+    self.pool.release( self.url, proxy )
+    self.assertEqual( self.pool.acquire( self.url )( 'transport' ).timeout, None )
+    
+  # ----------------------------------------
+  def test_idle_expiry( self ):
+    proxy = self.pool.acquire( self.url )
+    self.pool.release( self.url, proxy )
+    self.pool._idle[ self.url ][0] = ( time.time() - 61, proxy )
+    self.assertFalse( self.pool.acquire( self.url ) is proxy )
+    self.assertEqual( self.pool._idle[ self.url ], [] )
+    # and on release:
+    self.pool.release( self.url, proxy )
+    self.pool._idle[ self.url ][0] = ( time.time() - 61, proxy )
+    other = self.pool.acquire( 'http://127.0.0.1:2/' )
+    self.pool.release( self.url, other )
+    self.assertEqual( [ x[1] for x in self.pool._idle[ self.url ] ], [ other ] )
+    
+  # ----------------------------------------
+  def test_errors( self ):
+    # a fault is a complete response, and the proxy is reused:
+    try:
+      with self.pool.connection( self.url ) as proxy :
+        raise server.xmlrpc_lib.Fault( 1, 'fault' )
+    except server.xmlrpc_lib.Fault :
+      pass
+    self.assertTrue( self.pool.acquire( self.url ) is proxy )
+    # any other error leaves the connection in an unknown state, and the proxy is discarded:
+    try:
+      with self.pool.connection( self.url ) as proxy :
+        raise socket.error( 'failed' )
+    except socket.error :
+      pass
+    self.assertEqual( self.pool._idle[ self.url ], [] )
+    self.assertFalse( self.pool.acquire( self.url ) is proxy )
+    
+#####################################################################
+class NonceProxy( object ):
+  "stands in for a server proxy, and for the proxy pool giving it out"
+  def __init__( self, batched=True ):
+    self.batched = batched
+    self.calls = []
+    self.issued = 0
+  def get_nonce( self ):
+    self.calls.append( 'get_nonce' )
+    self.issued += 1
+    return str( self.issued )
+  def get_nonces( self, count ):
+    self.calls.append( 'get_nonces' )
+    if not self.batched :
+      raise server.xmlrpc_lib.Fault( 1, 'no such method' )
+    self.issued += count
+    return [ str( x ) for x in range( self.issued - count + 1, self.issued + 1 ) ]
+  @contextlib.contextmanager
+  def connection( self, url ):
+    yield self
+
+class SimpleNoncePoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.url = 'http://127.0.0.1:1/'
+    self.proxy = NonceProxy()
+    self.pool = server._NoncePool( self.proxy, 4 )
+    
+  def wait_refill( self ):
+    for i in range( 100 ):
+      if not self.pool._refilling :
+        return
+      time.sleep( 0.01 )
+    self.fail( 'refill did not finish' )
+    
+  # ----------------------------------------
+  def test_batch( self ):
+    self.assertEqual( self.pool.get( self.url, self.proxy ), '1' )
+    self.assertEqual( self.pool.get( self.url, self.proxy ), '2' )
+    self.assertEqual( self.proxy.calls, [ 'get_nonces' ] )
+    # fresh drops the batch:
+    self.assertEqual( self.pool.get( self.url, self.proxy, True ), '5' )
+    self.assertEqual( self.proxy.calls, [ 'get_nonces' ] * 2 )
+    
+  # ----------------------------------------
+  def test_refill( self ):
+    # below half a batch, a thread fetches the next batch while the last ones are used:
+    nonces = [ self.pool.get( self.url, self.proxy ) for x in range( 3 ) ]
+    self.wait_refill()
+    self.assertEqual( self.proxy.calls, [ 'get_nonces' ] * 2 )
+    nonces += [ self.pool.get( self.url, self.proxy ) for x in range( 5 ) ]
+    self.assertEqual( nonces, [ str( x ) for x in range( 1, 9 ) ] )
+    self.wait_refill()
+    
+  # ----------------------------------------
+  def test_unbatched( self ):
+    # servers without get_nonces are asked for one nonce at a time:
+    proxy = NonceProxy( False )
+    pool = server._NoncePool( proxy, 4 )
+    self.assertEqual( [ pool.get( self.url, proxy ) for x in range( 3 ) ], [ '1', '2', '3' ] )
+    self.assertEqual( proxy.calls, [ 'get_nonces', 'get_nonce', 'get_nonce', 'get_nonce' ] )
+    
+  # ----------------------------------------
+  def test_expiry( self ):
+    # nonces too close to expiring on the server are dropped:
+    self.pool._store( self.url, [ 'old', 'new' ] )
+    self.pool._nonces[ self.url ][0] = ( time.time() - ( server.NONCE_EXPIRY - server.NONCE_MARGIN ) - 1, 'old' )
+    self.assertEqual( self.pool.get( self.url, self.proxy ), 'new' )
+    self.wait_refill()
+    self.assertEqual( self.pool.get( self.url, self.proxy ), '1' )
+    
+#####################################################################
+class SimpleBroadcastTest(unittest.TestCase):
+
+  def setUp(self):
+    self.client = server.RemoteClient( { 'DIRB_SERVERS' : 'http://a/,http://b/,http://c/' }, {}, '/tmp' )
+    
+  def tearDown(self):
+    self.client.close()
+    
+  # ----------------------------------------
+  def test_exceptions( self ):
+    # each server's exception is its result:
+    def invoke( url, method, args, kwargs, timeout=None ):
+      if url == 'http://a/' :
+        return 'a'
+      if url == 'http://b/' :
+        raise ValueError( 'b' )
+      raise socket.error( 'c' )
+    self.client._timed_invoke = invoke
+    found = self.client._call_all( server.ServerApp.get_server_stats, None )
+    self.assertEqual( found['http://a/'], 'a' )
+    self.assertTrue( isinstance( found['http://b/'], ValueError ))
+    self.assertTrue( isinstance( found['http://c/'], socket.error ))
+    # unless every server is unreachable:
+    def unreachable( url, method, args, kwargs, timeout=None ):
+      raise socket.error( url )
+    self.client._timed_invoke = unreachable
+    self.assertRaises( socket.error, self.client._call_all, server.ServerApp.get_server_stats, None )
+    
+  # ----------------------------------------
+  def test_fanout( self ):
+    # one pool, however many threads ask for it at once:
+    pools = []
+    threads = [ threading.Thread( target=lambda : pools.append( self.client._get_fanout() )) for x in range( 8 ) ]
+    for thread in threads :
+      thread.start()
+    for thread in threads :
+      thread.join()
+    self.assertEqual( len( set( id( x ) for x in pools )), 1 )
+    pool = pools[0]
+    del pools[:]
+    self.client.close()
+    self.assertEqual( self.client._fanout, None )
+    self.assertNotEqual( pool._state, multiprocessing.pool.RUN )
+    pool.join()
+    # and when the client is collected:
+    client = server.RemoteClient( { 'DIRB_SERVERS' : 'http://a/' }, {}, '/tmp' )
+    pool = client._get_fanout()
+    del client
+    gc.collect()
+    self.assertNotEqual( pool._state, multiprocessing.pool.RUN )
+    pool.join()
+    
+#####################################################################
+class SimpleServerCreateTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.conf = { 'DIRB_AUTHPATH' : tempfile.mkdtemp() }
+    self.username = pwd.getpwuid( os.getuid() ).pw_name
+    self.groupname = grp.getgrgid( os.getgid() ).gr_name
+    self.doc = ds.compile_dir_structure( { 
+      'rules' : {
+        'ROOT' : [
+                ['ParameterizedLevel', { "key":'show', 'bookmarks':['show'], 'user':self.username, 'group':self.groupname, 'permissions':'rwxrwxrwx' }],
+                ['ParameterizedLevel', { "key":'shot', 'bookmarks':['shot'], 'permissions':'rwxr-x---' }]
+                ]
+        }
+    } )
+    self.app = server.ServerApp( 'test', self.conf, logging.CRITICAL )
+    
+  def user( self ):
+    return tuple( auth.get_user_credentials( self.username, self.conf, self.app.get_nonce() ))
+    
+  def mode( self, path ):
+    return stat.S_IMODE( os.stat( os.path.join( self.root, path )).st_mode )
+    
+  # ----------------------------------------
+  def test_mode( self ):
+    # the umask does not apply:
+    old = os.umask( 0o022 )
+    try:
+      created = self.app.create_paths( '(and (bookmark show) (parameters (show s1)))', self.user(), self.doc, self.root )
+    finally:
+      os.umask( old )
+    self.assertEqual( [ x[3] for x in created ], [ os.path.join( self.root, 's1' ) ] )
+    self.assertEqual( self.mode( 's1' ), 0o777 )
+    info = os.stat( os.path.join( self.root, 's1' ))
+    self.assertEqual( ( info.st_uid, info.st_gid ), ( os.getuid(), os.getgid() ))
+    
+  # ----------------------------------------
+  def test_depth_order( self ):
+    # parents are created before their children, whatever the order they are depicted in:
+    show = '(and (bookmark show) (parameters (show s1)))'
+    shot = '(and (bookmark shot) (parameters (show s1)(shot t1)))'
+    created = self.app.create_paths( '(or %s %s)' % ( shot, show ), self.user(), self.doc, self.root )
+    self.assertEqual( [ x[3] for x in created ], [ os.path.join( self.root, 's1' ), os.path.join( self.root, 's1', 't1' ) ] )
+    self.assertEqual( self.mode( 's1' ), 0o777 )
+    self.assertEqual( self.mode( 's1/t1' ), 0o750 )
+    info = os.stat( os.path.join( self.root, 's1', 't1' )) # owner inherited from the parent level
+    self.assertEqual( ( info.st_uid, info.st_gid ), ( os.getuid(), os.getgid() ))
+    
+    shot2 = '(and (bookmark shot) (parameters (show s2)(shot t1)))'
+    show2 = '(and (bookmark show) (parameters (show s2)))'
+    created = self.app.create_paths_batch( [ shot2, show2 ], self.user(), self.doc, self.root )
+    self.assertEqual( [ [ x[3] for x in l ] for l in created ], [ [ os.path.join( self.root, 's2', 't1' ) ], [ os.path.join( self.root, 's2' ) ] ] )
+    
+  # ----------------------------------------
+  def test_existing( self ):
+    # existing directories are skipped, and keep their permissions:
+    show = '(and (bookmark show) (parameters (show s1)))'
+    self.assertEqual( len( self.app.create_paths( show, self.user(), self.doc, self.root )), 1 )
+    os.chmod( os.path.join( self.root, 's1' ), 0o700 )
+    self.assertEqual( self.app.create_paths( show, self.user(), self.doc, self.root ), [] )
+    self.assertEqual( self.app.create_paths_batch( [ show ], self.user(), self.doc, self.root ), [ [] ] )
+    self.assertEqual( self.mode( 's1' ), 0o700 )
+    # but not files in their place:
+    open( os.path.join( self.root, 's2' ), 'w' ).close()
+    self.assertRaises( OSError, self.app.create_paths, '(and (bookmark show) (parameters (show s2)))', self.user(), self.doc, self.root )
+    
+  # ----------------------------------------
+  def test_batch( self ):
+    self.app.create_paths( '(and (bookmark show) (parameters (show s1)))', self.user(), self.doc, self.root )
+    t1 = '(and (bookmark shot) (parameters (show s1)(shot t1)))'
+    t2 = '(and (bookmark shot) (parameters (show s1)(shot t2)))'
+    t3 = '(and (bookmark shot) (parameters (show s1)(shot t3)))'
+    path = lambda x : os.path.join( self.root, 's1', x )
+    # a path in several expressions is created once, and reported for each;
+    # each expression's results are in creation order:
+    created = self.app.create_paths_batch( [ '(or %s %s)' % ( t2, t1 ), t1, t3 ], self.user(), self.doc, self.root )
+    self.assertEqual( [ [ x[3] for x in l ] for l in created ], [ [ path( 't1' ), path( 't2' ) ], [ path( 't1' ) ], [ path( 't3' ) ] ] )
+    self.assertEqual( server.lists_to_ptclists( created )[2][0].permissions, 0o750 )
+    self.assertEqual( sorted( os.listdir( os.path.join( self.root, 's1' ))), [ 't1', 't2', 't3' ] )
+    
+  # ----------------------------------------
+  def test_client_cache( self ):
+    # one client per ( digest, starting path ), least recently used evicted first:
+    app = server.ServerApp( 'test', dict( self.conf, DIRBSERVER_CLIENT_CACHE_SIZE=2 ), logging.CRITICAL )
+    digest = ds.get_compiled_digest( self.doc )
+    a = app._get_client( self.doc, '/a' )
+    self.assertTrue( app._get_client( self.doc, '/a' ) is a )
+    b = app._get_client( self.doc, '/b' )
+    self.assertFalse( b is a )
+    self.assertTrue( app._get_client( digest, '/a' ) is a ) # by digest, once the document is known
+    app._get_client( self.doc, '/c' ) # evicts /b
+    self.assertTrue( app._get_client( digest, '/a' ) is a )
+    self.assertFalse( app._get_client( digest, '/b' ) is b )
+    stats = app.get_server_stats( tuple( auth.get_user_credentials( self.username, self.conf, app.get_nonce() )))
+    self.assertEqual( ( stats['clientcache_size'], stats['clientcache_hits'], stats['clientcache_misses'] ), ( 2, 3, 4 ))
+    self.assertRaises( LookupError, app._get_client, 'unknown', '/a' )
+    
+  # ----------------------------------------
+  def test_shutdown( self ):
+    # shutdown_server keeps the app lock, which creation does not need:
+    self.app.set_shutdown_callable( lambda : None )
+    self.app.shutdown_server( self.user() )
+    thread = threading.Thread( target=self.app._get_create_pool )
+    thread.daemon = True
+    thread.start()
+    thread.join( 5 )
+    self.assertFalse( thread.is_alive() )
+    
+  def tearDown(self):
+    if self.app._createpool is not None :
+      self.app._createpool.terminate()
+  
+#####################################################################
+class SimpleColumnarTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tuples = [
+      ( [ 'b1', 'b2' ], { 'a' : 'x', 'n' : None }, { 'p' : 'x' }, '/tmp/a', { 'c' : 'x' }, 'user', 'group', 0o755 ),
+      ( [], {}, {}, '/tmp/b', {}, None, None, None ),
+      ( [ 'b1' ], { 'a' : 'y' }, {}, '/tmp/a/b', {}, 'user', None, 0 ),
+      ( [], { 'list' : [ 'x', 'y' ] }, {}, '/tmp/c', { 'list' : [ 'x', 'y' ] }, None, 'group', None ) ]
+    
+  def roundtrip( self, compress ):
+    # as it goes over XML-RPC:
+    encoded = server.encode_ptclist( [ ds.PathTraversalContext( *x ) for x in self.tuples ], compress )
+    encoded = server.xmlrpc_lib.loads( server.xmlrpc_lib.dumps( ( encoded, )))[0][0]
+    return server.columnar_to_ptclist( encoded )
+    
+  # ----------------------------------------
+  def test_json( self ):
+    expected = server.tuples_to_ptclist( self.tuples )
+    found = self.roundtrip( False )
+    self.assertEqual( len( found ), len( expected ))
+    self.assertEqual( list( found ), expected )
+    self.assertEqual( found[1:3], expected[1:3] )
+    self.assertEqual( found[::-2], expected[::-2] )
+    self.assertEqual( found[-1], expected[-1] )
+    
+  # ----------------------------------------
+  def test_zlib( self ):
+    self.assertEqual( list( self.roundtrip( True )), server.tuples_to_ptclist( self.tuples ))
+    
+  # ----------------------------------------
+  def test_unhashable( self ):
+    # equal lists are stored once, and decoded as separate copies:
+    encoded = server.encode_ptclist( self.tuples )
+    self.assertEqual( json.loads( encoded['data'] )['strings'].count( [ 'x', 'y' ] ), 1 )
+    found = server.columnar_to_ptclist( encoded )[3]
+    found.attributes['list'].append( 'z' )
+    self.assertEqual( found.collections['list'], [ 'x', 'y' ] )
+    self.assertEqual( server.columnar_to_ptclist( encoded )[3].attributes['list'], [ 'x', 'y' ] )
+  
+#####################################################################
+class EchoApp( object ):
+  "served by the wsgi application in tests"
+  def echo( self, value ):
+    return value
+  def fail( self ):
+    raise server.xmlrpc_lib.Fault( 42, 'failed on purpose' )
+  def crash( self ):
+    raise ValueError( 'crashed' )
+
+class SimpleWSGIApplicationTest(unittest.TestCase):
+
+  def setUp(self):
+    self.app = wsgi_xmlrpc.WSGIXMLRPCApplication( EchoApp(), max_request_size=1024 * 1024 )
+    
+  def post( self, body, **headers ):
+    "returns the status, the headers and the body of the response to the request"
+    environ = { 'REQUEST_METHOD' : 'POST', 'CONTENT_LENGTH' : str( len( body )), 'wsgi.input' : io.BytesIO( body ), 'REMOTE_ADDR' : 'test' }
+    environ.update( headers )
+    response = []
+    ret = self.app( environ, lambda status, headers : response.extend( [ status, dict( headers ) ] ))
+    return response[0], response[1], b''.join( ret )
+    
+  # ----------------------------------------
+  def test_gzip_bomb( self ):
+    # a small body that would inflate to 100MB is refused, without inflating it:
+    compressor = zlib.compressobj( 6, zlib.DEFLATED, 16 + zlib.MAX_WBITS )
+    block = b' ' * ( 1024 * 1024 )
+    body = b''.join( compressor.compress( block ) for x in range( 100 )) + compressor.flush()
+    self.assertTrue( len( body ) < 1024 * 1024 )
+    chunks = wsgi_xmlrpc.gzip_decode_chunks( [ body ], 1024 * 1024, 64 * 1024 )
+    size = 0
+    try:
+      for chunk in chunks :
+        self.assertTrue( len( chunk ) <= 64 * 1024 )
+        size += len( chunk )
+    except wsgi_xmlrpc.RequestTooLarge :
+      pass
+    else:
+      self.fail( 'RequestTooLarge not raised' )
+    self.assertTrue( size <= 1024 * 1024 )
+    status, headers, data = self.post( body, HTTP_CONTENT_ENCODING='gzip' )
+    self.assertTrue( status.startswith( '413' ))
+    
+  # ----------------------------------------
+  def test_too_large( self ):
+    body = server.xmlrpc_lib.dumps( ( 'x' * ( 2 * 1024 * 1024 ), ), 'echo' ).encode( 'utf-8' )
+    stream = io.BytesIO( body )
+    environ = { 'REQUEST_METHOD' : 'POST', 'CONTENT_LENGTH' : str( len( body )), 'wsgi.input' : stream, 'REMOTE_ADDR' : 'test' }
+    response = []
+    self.app( environ, lambda status, headers : response.append( status ))
+    self.assertTrue( response[0].startswith( '413' ))
+    self.assertEqual( stream.tell(), 0 ) # refused before reading
+    # decoded size over the limit:
+    status, headers, data = self.post( wsgi_xmlrpc.gzip_encode( body ), HTTP_CONTENT_ENCODING='gzip' )
+    self.assertTrue( status.startswith( '413' ))
+    
+  # ----------------------------------------
+  def test_bad_encoding( self ):
+    body = server.xmlrpc_lib.dumps( ( 'x', ), 'echo' ).encode( 'utf-8' )
+    status, headers, data = self.post( b'not gzip at all', HTTP_CONTENT_ENCODING='gzip' )
+    self.assertTrue( status.startswith( '400' ))
+    status, headers, data = self.post( body, HTTP_CONTENT_ENCODING='br' )
+    self.assertTrue( status.startswith( '501' ))
+    
+  # ----------------------------------------
+  def test_chunks( self ):
+    # the body is fed to the parser in many chunks:
+    self.app.max_chunk_size = 7
+    value = [ 'value%d' % x for x in range( 100 ) ]
+    for headers, body in ( ( {}, server.xmlrpc_lib.dumps( ( value, ), 'echo' ).encode( 'utf-8' ) ), 
+        ( { 'HTTP_CONTENT_ENCODING' : 'gzip' }, wsgi_xmlrpc.gzip_encode( server.xmlrpc_lib.dumps( ( value, ), 'echo' ).encode( 'utf-8' )))):
+      status, responseheaders, data = self.post( body, **headers )
+      self.assertTrue( status.startswith( '200' ))
+      self.assertEqual( server.xmlrpc_lib.loads( data )[0][0], value )
+    
+  # ----------------------------------------
+  def test_gzip_response( self ):
+    small = server.xmlrpc_lib.dumps( ( 'x', ), 'echo' ).encode( 'utf-8' )
+    large = server.xmlrpc_lib.dumps( ( 'x' * 100000, ), 'echo' ).encode( 'utf-8' )
+    for body, accept, encoded in ( ( large, 'gzip', True ), ( large, 'deflate, gzip;q=0.5', True ), ( large, 'gzip;q=0', False ), 
+        ( large, 'identity', False ), ( large, None, False ), ( small, 'gzip', False ) ):
+      headers = { 'HTTP_ACCEPT_ENCODING' : accept } if accept is not None else {}
+      status, responseheaders, data = self.post( body, **headers )
+      self.assertEqual( responseheaders.get( 'Content-Encoding' ) == 'gzip', encoded )
+      self.assertEqual( int( responseheaders['Content-Length'] ), len( data ))
+      if encoded :
+        data = zlib.decompress( data, 16 + zlib.MAX_WBITS )
+      self.assertEqual( server.xmlrpc_lib.loads( data )[0][0], server.xmlrpc_lib.loads( body )[0][0] )
+    
+  # ----------------------------------------
+  def test_gzip_transport( self ):
+    # requests over the threshold are gzip encoded by the client transport, and responses decoded:
+    seen = []
+    def recorder( environ, start_response ):
+      seen.append( environ.get( 'HTTP_CONTENT_ENCODING' ))
+      return self.app( environ, start_response )
+    httpd = wsgiref.simple_server.make_server( '127.0.0.1', 0, recorder, server_class=ThreadedWSGIServer, handler_class=QuietWSGIHandler )
+    thread = threading.Thread( target=httpd.serve_forever, args=( 0.05, ))
+    thread.daemon = True
+    thread.start()
+    try:
+      url = 'http://127.0.0.1:%d/' % httpd.server_address[1]
+      value = 'x' * 100000
+      self.assertEqual( server._make_proxy( url, 10, 1024 ).echo( value ), value )
+      self.assertEqual( server._make_proxy( url, 10, 1024 ).echo( 'x' ), 'x' )
+      self.assertEqual( server._make_proxy( url, 10, None ).echo( value ), value )
+      self.assertEqual( seen, [ 'gzip', None, None ] )
+    finally:
+      httpd.shutdown()
+      httpd.server_close()
+    
+  # ----------------------------------------
+  def test_faults( self ):
+    self.app.max_chunk_size = 16
+    status, headers, data = self.post( server.xmlrpc_lib.dumps( (), 'fail' ).encode( 'utf-8' ))
+    self.assertTrue( status.startswith( '200' ))
+    try:
+      server.xmlrpc_lib.loads( data )
+      self.fail( 'Fault not raised' )
+    except server.xmlrpc_lib.Fault as e :
+      self.assertEqual( ( e.faultCode, e.faultString ), ( 42, 'failed on purpose' ))
+    for body in ( server.xmlrpc_lib.dumps( (), 'crash' ).encode( 'utf-8' ), b'<methodCall><bad' ):
+      status, headers, data = self.post( body )
+      self.assertTrue( status.startswith( '200' ))
+      self.assertRaises( server.xmlrpc_lib.Fault, server.xmlrpc_lib.loads, data )
+  
+#####################################################################
+class QuietWSGIHandler( wsgiref.simple_server.WSGIRequestHandler ):
+  def log_message( self, format, *args ):
+    pass
+
+class ThreadedWSGIServer( socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer ):
+  daemon_threads = True
+  request_queue_size = 64 # concurrent clients connect at once
+
+@unittest.skipIf( asyncclient is None, "the asyncio client needs python 3" )
+class SimpleAsyncClientTest(unittest.TestCase):
+
+  def setUp(self):
+    authdir = tempfile.mkdtemp()
+    self.app = server.ServerApp( 'test', { 'DIRB_AUTHPATH' : authdir }, logging.CRITICAL )
+    self.httpd = wsgiref.simple_server.make_server( '127.0.0.1', 0, wsgi_xmlrpc.WSGIXMLRPCApplication( self.app ), 
+      server_class=ThreadedWSGIServer, handler_class=QuietWSGIHandler )
+    thread = threading.Thread( target=self.httpd.serve_forever, args=( 0.05, ))
+    thread.daemon = True
+    thread.start()
+    self.url = 'http://127.0.0.1:%d/' % self.httpd.server_address[1]
+    self.conf = { 'DIRB_SERVERS' : self.url, 'DIRB_AUTHPATH' : authdir }
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop( self.loop )
+    
+  def run_client( self, conf, fn ):
+    client = asyncclient.AsyncRemoteClient( conf, {}, '/tmp' )
+    try:
+      return self.loop.run_until_complete( fn( client ))
+    finally:
+      self.loop.run_until_complete( client.close() )
+    
+  # ----------------------------------------
+  def test_concurrent_calls( self ):
+    def calls( client ):
+      return asyncio.gather( *[ client.get_server_stats( None ) for x in range( 8 ) ] )
+    found = self.run_client( self.conf, calls )
+    self.assertEqual( len( found ), 8 )
+    self.assertTrue( all( set( x.keys() ) == set([ self.url ]) for x in found ))
+    
+  # ----------------------------------------
+  def test_cancel( self ):
+    def calls( client ):
+      task = self.loop.create_task( client.get_server_stats( None ))
+      self.loop.call_soon( task.cancel )
+      self.assertRaises( asyncio.CancelledError, self.loop.run_until_complete, task )
+      # the client is still good for the next call:
+      return client.get_server_stats( None )
+    found = self.run_client( self.conf, calls )
+    self.assertEqual( list( found.keys() ), [ self.url ] )
+    
+  # ----------------------------------------
+  def test_stale_connection( self ):
+    transport = asyncclient._AsyncTransport( 30 )
+    connects = []
+    async def stale( *args ):
+      # a connection the server has closed:
+      mine, theirs = socket.socketpair()
+      theirs.close()
+      connects.append( mine )
+      reader, writer = await asyncio.open_connection( sock=mine )
+      return asyncclient._Connection( reader, writer )
+    async def connect( url ):
+      connects.append( url )
+      return await asyncclient._AsyncTransport._connect( transport, url )
+    async def calls():
+      # a reused connection is retried once on a new connection:
+      transport._release( self.url, await stale() )
+      transport._connect = connect
+      self.assertTrue( 'get_nonces' in await transport.request( self.url, 'system.listMethods', [] ))
+      self.assertEqual( len( connects ), 2 )
+      # a new connection is not:
+      transport.close()
+      del connects[:]
+      transport._connect = stale
+      try:
+        await transport.request( self.url, 'system.listMethods', [] )
+        self.fail( 'a closed connection was not reported' )
+      except ConnectionError :
+        pass
+      self.assertEqual( len( connects ), 1 )
+      transport.close()
+    self.loop.run_until_complete( calls() )
+    
+  # ----------------------------------------
+  def test_nonce_refill( self ):
+    transport = asyncclient._AsyncTransport( 30 )
+    pool = asyncclient._AsyncNoncePool( transport, 4 )
+    async def calls():
+      nonces = [ await pool.get( self.url ) for x in range( 3 ) ] # the third leaves one, and starts a refill
+      self.assertEqual( len( pool._tasks ), 1 )
+      await asyncio.gather( *pool._tasks )
+      self.assertEqual( len( pool._tasks ), 0 )
+      self.assertEqual( len( pool._nonces[ self.url ] ), 5 )
+      nonces.append( await pool.get( self.url ))
+      self.assertEqual( len( set( nonces )), 4 )
+      transport.close()
+    self.loop.run_until_complete( calls() )
+    
+  # ----------------------------------------
+  def test_digest( self ):
+    # documents are sent by digest, and in full only to a server that does not know them:
+    doc = ds.compile_dir_structure( { 'rules' : { 'ROOT' : [ ['ParameterizedLevel', { "key":'show', 'bookmarks':['show'] }] ] } } )
+    root = tempfile.mkdtemp()
+    seen = []
+    get_schema = self.app._get_schema
+    def recorder( compileddoc ):
+      seen.append( 'full' if isinstance( compileddoc, dict ) else 'digest' )
+      return get_schema( compileddoc )
+    self.app._get_schema = recorder
+    client = server.RemoteClient( self.conf, doc, root )
+    self.assertEqual( len( client.create_paths( '(and (bookmark show) (parameters (show s1)))', None, None, None )), 1 )
+    self.assertEqual( seen, [ 'digest', 'full' ] )
+    del seen[:]
+    self.assertEqual( len( client.create_paths( '(and (bookmark show) (parameters (show s2)))', None, None, None )), 1 )
+    self.assertEqual( seen, [ 'digest' ] )
+    # an unknown digest is a fault, and the client resends the document once:
+    self.app._schemas.clear()
+    with self.assertRaises( server.xmlrpc_lib.Fault ) as raised :
+      with client._proxies.connection( self.url ) as proxy :
+        proxy.create_paths( *client._build_args( server.ServerApp.create_paths, ( '(bookmark show)', None, None, None ), {}, self.app.get_nonce() )[0] )
+    self.assertTrue( server.UNKNOWN_SCHEMA in raised.exception.faultString )
+    # once, even when the server never knows it:
+    del seen[:]
+    def forgetful( compileddoc ):
+      seen.append( 'full' if isinstance( compileddoc, dict ) else 'digest' )
+      raise LookupError( server.UNKNOWN_SCHEMA )
+    self.app._get_schema = forgetful
+    self.assertRaises( server.xmlrpc_lib.Fault, client.create_paths, '(bookmark show)', None, None, None )
+    self.assertEqual( seen, [ 'digest', 'full' ] )
+    client.close()
+    self.app._get_schema = recorder
+    del seen[:]
+    def calls( client ):
+      return client.create_paths( '(and (bookmark show) (parameters (show s3)))', None, None, None )
+    client = asyncclient.AsyncRemoteClient( self.conf, doc, root )
+    try:
+      self.assertEqual( len( self.loop.run_until_complete( calls( client ))), 1 )
+    finally:
+      self.loop.run_until_complete( client.close() )
+    self.assertEqual( seen, [ 'digest', 'full' ] )
+    
+  # ----------------------------------------
+  def test_columnar( self ):
+    doc = ds.compile_dir_structure( { 'rules' : { 'ROOT' : [ ['ParameterizedLevel', { "key":'show', 'bookmarks':['show'] }] ] } } )
+    root = tempfile.mkdtemp()
+    client = server.RemoteClient( self.conf, doc, root )
+    found = client.create_paths_columnar( '(and (bookmark show) (parameters (show s1)))' )
+    self.assertTrue( isinstance( found, server.ColumnarPtcList ))
+    self.assertEqual( [ x.path for x in found ], [ os.path.join( root, 's1' ) ] )
+    self.assertEqual( found[0].parameters, { 'show' : 's1' } )
+    found = client.create_paths_columnar( '(and (bookmark show) (parameters (show s2)))', None, None, None, True ) # compressed
+    self.assertEqual( [ x.path for x in found ], [ os.path.join( root, 's2' ) ] )
+    client.close()
+    def calls( client ):
+      return client.create_paths_columnar( '(and (bookmark show) (parameters (show s3)))' )
+    client = asyncclient.AsyncRemoteClient( self.conf, doc, root )
+    try:
+      found = self.loop.run_until_complete( calls( client ))
+    finally:
+      self.loop.run_until_complete( client.close() )
+    self.assertEqual( [ x.path for x in found ], [ os.path.join( root, 's3' ) ] )
+    
+  # ----------------------------------------
+  def test_timeout( self ):
+    # only calls to all servers are bounded by DIRB_RPC_TIMEOUT:
+    get_server_stats = self.app.get_server_stats
+    def slow( user ):
+      time.sleep( 0.5 )
+      return get_server_stats( user )
+    self.app.get_server_stats = slow
+    conf = dict( self.conf, DIRB_RPC_TIMEOUT=0.2 )
+    client = server.RemoteClient( conf, {}, '/tmp' )
+    self.assertTrue( 'clientcache_size' in client._call_one( server.ServerApp.get_server_stats, None ))
+    self.assertRaises( socket.error, client.get_server_stats, None )
+    self.assertTrue( client.get_balancer_stats()[ self.url ]['down'] )
+    client._selector.success( self.url, 0.0 ) # back in rotation
+    self.assertTrue( 'clientcache_size' in client._call_one( server.ServerApp.get_server_stats, None ))
+    client.close()
+    def one( client ):
+      return client._call_one( server.ServerApp.get_server_stats, None )
+    self.assertTrue( 'clientcache_size' in self.run_client( conf, one ))
+    def calls( client ):
+      return client.get_server_stats( None )
+    self.assertRaises( socket.error, self.run_client, conf, calls )
+    
+  # ----------------------------------------
+  def test_failed_server( self ):
+    # a port with nothing listening:
+    sock = socket.socket()
+    sock.bind( ( '127.0.0.1', 0 ))
+    deadurl = 'http://127.0.0.1:%d/' % sock.getsockname()[1]
+    sock.close()
+    conf = dict( self.conf )
+    conf['DIRB_SERVERS'] = ','.join( ( deadurl, self.url ))
+    failed = []
+    def calls( client ):
+      client._notifier = failed.append
+      return client.get_server_stats( None )
+    found = self.run_client( conf, calls )
+    self.assertTrue( isinstance( found[ deadurl ], socket.error ))
+    self.assertTrue( isinstance( found[ self.url ], dict ))
+    self.assertEqual( failed, [ deadurl ] )
+    
+  # ----------------------------------------
+  def test_failover( self ):
+    sock = socket.socket()
+    sock.bind( ( '127.0.0.1', 0 ))
+    deadurl = 'http://127.0.0.1:%d/' % sock.getsockname()[1]
+    sock.close()
+    conf = dict( self.conf )
+    conf['DIRB_SERVERS'] = ','.join( ( deadurl, self.url ))
+    failed = []
+    def calls( client ):
+      client._notifier = failed.append
+      client._selector.success( self.url, 1.0 ) # unmeasured servers are preferred, so the dead one is picked first
+      return client._call_one( server.ServerApp.get_server_stats, None )
+    # the call fails over to the working server, and the dead one is out of rotation:
+    found = self.run_client( conf, calls )
+    self.assertTrue( 'clientcache_size' in found )
+    self.assertEqual( failed, [ deadurl ] )
+    # likewise for the blocking client:
+    client = server.RemoteClient( conf, {}, '/tmp' )
+    client._selector.success( self.url, 1.0 )
+    self.assertTrue( 'clientcache_size' in client._call_one( server.ServerApp.get_server_stats, None ))
+    stats = client.get_balancer_stats()
+    self.assertTrue( stats[ deadurl ]['down'] )
+    self.assertEqual( stats[ self.url ]['calls'], 2 )
+    client.close()
+      
+  # ----------------------------------------
+  def test_sessions( self ):
+    conf = dict( self.conf, DIRB_SESSIONS=1 )
+    client = server.RemoteClient( conf, {}, '/tmp' )
+    for i in range( 3 ):
+      self.assertTrue( 'clientcache_size' in client.get_server_stats( None )[ self.url ] )
+    self.assertEqual( len( client._sessions ), 1 )
+    # a restarted server has a new secret, so the client opens a new session:
+    token = client._cached_session( self.url, auth.get_username() )
+    self.app._session_secret = os.urandom( 32 )
+    self.assertTrue( 'clientcache_size' in client.get_server_stats( None )[ self.url ] )
+    newtoken = client._cached_session( self.url, auth.get_username() )
+    self.assertNotEqual( newtoken, token )
+    # a session token cannot open another session:
+    with client._proxies.connection( self.url ) as proxy :
+      self.assertRaises( server.xmlrpc_lib.Fault, proxy.open_session, tuple( auth.make_session_credentials( auth.get_username(), newtoken )))
+    client.close()
+    # and the same from the asyncio client:
+    def calls( client ):
+      return client.get_server_stats( None )
+    self.assertTrue( 'clientcache_size' in self.run_client( conf, calls )[ self.url ] )
+    
+  # ----------------------------------------
+  def test_sessions_disabled( self ):
+    self.app._config['DIRBSERVER_SESSION_EXPIRY'] = 0
+    client = server.RemoteClient( dict( self.conf, DIRB_SESSIONS=1 ), {}, '/tmp' )
+    self.assertTrue( 'clientcache_size' in client.get_server_stats( None )[ self.url ] )
+    self.assertEqual( client._unsessioned, set( [ self.url ] ))
+    client.close()
+    
+  def tearDown(self):
+    self.loop.close()
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+#####################################################################
+class CountingWSGIServer( runner.PooledWSGIServer ):
+  "counts the connections it accepts"
+  accepted = 0
+  def get_request( self ):
+    request = runner.PooledWSGIServer.get_request( self )
+    self.accepted += 1
+    return request
+
+class SimpleRunnerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.authdir = tempfile.mkdtemp()
+    self.config = { 'DIRB_AUTHPATH' : self.authdir, 'DIRBSERVER_THREADS' : 4 }
+    
+  def make_client( self, url, **kwargs ):
+    conf = { 'DIRB_SERVERS' : url, 'DIRB_AUTHPATH' : self.authdir }
+    conf.update( kwargs )
+    return server.RemoteClient( conf, {}, '/tmp' )
+    
+  # ----------------------------------------
+  def test_threads( self ):
+    httpd = runner.make_server( self.config, ( '127.0.0.1', 0 ))
+    app = server.ServerApp( 'test', self.config, logging.CRITICAL )
+    httpd.set_app( runner.make_application( app, self.config ))
+    app.set_shutdown_callable( httpd.stop )
+    thread = threading.Thread( target=httpd.run, args=( 0.05, ))
+    thread.start()
+    url = 'http://127.0.0.1:%d/' % httpd.server_address[1]
+    client = self.make_client( url )
+    for i in range( 3 ): # over one kept-alive connection
+      self.assertTrue( 'clientcache_size' in client.get_server_stats( None )[ url ] )
+    client.shutdown_server( None )
+    thread.join( 10 )
+    self.assertFalse( thread.is_alive() )
+    client.close()
+    
+  # ----------------------------------------
+  def start_echo( self, threads ):
+    httpd = CountingWSGIServer( ( '127.0.0.1', 0 ), threads, 30 )
+    httpd.set_app( runner.make_application( EchoApp(), self.config ))
+    thread = threading.Thread( target=httpd.run, args=( 0.05, ))
+    thread.start()
+    self.addCleanup( thread.join, 10 )
+    self.addCleanup( httpd.stop )
+    return httpd
+    
+  def echo( self, connection, value ):
+    connection.request( 'POST', '/', server.xmlrpc_lib.dumps( ( value, ), 'echo' ), { 'Content-Type' : 'text/xml' } )
+    response = connection.getresponse()
+    self.assertEqual( response.status, 200 )
+    self.assertEqual( server.xmlrpc_lib.loads( response.read() )[0], ( value, ))
+    return response
+    
+  # ----------------------------------------
+  def test_keepalive( self ):
+    httpd = self.start_echo( 4 )
+    connection = http_client.HTTPConnection( '127.0.0.1', httpd.server_address[1], timeout=10 )
+    for i in range( 5 ):
+      response = self.echo( connection, i )
+      self.assertEqual( response.getheader( 'Connection' ), None )
+    self.assertEqual( httpd.accepted, 1 )
+    connection.request( 'GET', '/' ) # an error closes the connection
+    response = connection.getresponse()
+    response.read()
+    self.assertEqual( response.status, 400 )
+    self.assertEqual( response.getheader( 'Connection' ), 'close' )
+    connection.close()
+    
+    url = 'http://127.0.0.1:%d/' % httpd.server_address[1]
+    client = self.make_client( url )
+    for i in range( 5 ):
+      with client._proxies.connection( url ) as proxy :
+        self.assertEqual( proxy.echo( i ), i )
+    self.assertEqual( httpd.accepted, 2 )
+    client.close()
+    
+  # ----------------------------------------
+  def test_idle_reclaimed( self ):
+    # an idle connection gives its thread up to a new connection:
+    httpd = self.start_echo( 1 )
+    idle = http_client.HTTPConnection( '127.0.0.1', httpd.server_address[1], timeout=10 )
+    self.echo( idle, 1 )
+    connection = http_client.HTTPConnection( '127.0.0.1', httpd.server_address[1], timeout=10 )
+    start = time.time()
+    self.echo( connection, 2 )
+    self.assertTrue( time.time() - start < 5 )
+    self.assertEqual( httpd.accepted, 2 )
+    idle.close()
+    connection.close()
+    
+  # ----------------------------------------
+  def test_max_request_size( self ):
+    application = runner.make_application( None, { 'DIRBSERVER_MAX_REQUEST_SIZE' : 0 } )
+    self.assertEqual( application.max_request_size, None )
+    application = runner.make_application( None, { 'DIRBSERVER_MAX_REQUEST_SIZE' : 1024 } )
+    self.assertEqual( application.max_request_size, 1024 )
+    
+  # ----------------------------------------
+  def test_workers( self ):
+    # a nonce issued by one worker is accepted by another:
+    sock = socket.socket()
+    sock.bind( ( '127.0.0.1', 0 ))
+    port = sock.getsockname()[1]
+    sock.close()
+    env = dict( os.environ, DIRB_AUTHPATH=self.authdir )
+    devnull = open( os.devnull, 'w' )
+    process = subprocess.Popen( [ sys.executable, '-m', 'dirb.server.runner', '--host', '127.0.0.1', '--port', str( port ), '--workers', '3', '--threads', '2' ], 
+      env=env, stderr=devnull, cwd=os.path.dirname( os.path.abspath( __file__ )))
+    try:
+      url = 'http://127.0.0.1:%d/' % port
+      client = self.make_client( url, DIRB_CONNECTION_IDLE_TIMEOUT=0, DIRB_NONCE_BATCH=1 )
+      for i in range( 100 ):
+        try:
+          client.get_server_stats( None )
+          break
+        except socket.error : # still starting
+          client._selector.success( url, 0.0 )
+          time.sleep( 0.05 )
+      for i in range( 20 ):
+        self.assertTrue( 'clientcache_size' in client.get_server_stats( None )[ url ] )
+      client.shutdown_server( None )
+      for i in range( 100 ):
+        if process.poll() is not None :
+          break
+        time.sleep( 0.05 )
+      self.assertEqual( process.poll(), 0 )
+    finally:
+      if process.poll() is None :
+        process.kill()
+      devnull.close()
+
 #####################################################################
 if __name__ == '__main__':
     unittest.main()
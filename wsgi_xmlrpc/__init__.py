@@ -16,6 +16,7 @@
 
 try: # python 3.2 compatibility, Mayur Patel, mpatel@spinpro.com Aug 14
     import xmlrpc.server as xmlrpc_server
+    import xmlrpc.client as xmlrpc_client
     def b(val):
         """ Convert string/unicode/bytes literals into bytes.  This allows for
         the same code to run on Python 2.x and 3.x. """
@@ -33,6 +34,7 @@ try: # python 3.2 compatibility, Mayur Patel, mpatel@spinpro.com Aug 14
             return val
 except:
     import SimpleXMLRPCServer as xmlrpc_server
+    import xmlrpclib as xmlrpc_client
     def b(val):
         """ Convert string/unicode/bytes literals into bytes.  This allows for
         the same code to run on Python 2.x and 3.x. """
@@ -51,14 +53,80 @@ except:
 
 import logging
 import traceback
+import sys
+import zlib
 
 logger = logging.getLogger(__name__)
 
+def accepts_gzip(environ):
+    """ Returns True if the client accepts gzip encoded responses,
+    according to its Accept-Encoding header. """
+    for part in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        fields = [x.strip() for x in part.split(';')]
+        if fields[0].lower() in ('gzip', 'x-gzip'):
+            for param in fields[1:]:
+                if param.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                    return False
+            return True
+    return False
+
+def gzip_encode(data):
+    """ Returns the data compressed in the gzip format """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class RequestTooLarge(Exception):
+    """ The request body is larger than allowed """
+
+class BadContentEncoding(Exception):
+    """ The request body cannot be decoded """
+
+def gzip_decode_chunks(chunks, max_size=None, max_chunk_size=1024*1024):
+    """ Decodes chunks of gzip format data, yielding chunks of at most max_chunk_size
+    bytes of decoded data.  Raises RequestTooLarge as soon as the decoded data 
+    is larger than max_size, without inflating more than one byte past it. """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    size = 0
+    try:
+        for chunk in chunks:
+            while True:
+                # bound the output of each step, so a small body cannot inflate to a huge one in memory:
+                step = max_chunk_size if max_size is None else min(max_chunk_size, max_size - size + 1)
+                data = decompressor.decompress(chunk, step)
+                chunk = decompressor.unconsumed_tail
+                size += len(data)
+                if max_size is not None and size > max_size:
+                    raise RequestTooLarge('decoded request larger than %d bytes' % max_size)
+                if data:
+                    yield data
+                if not chunk and len(data) < step:
+                    break # this chunk is used up
+        data = decompressor.flush()
+        size += len(data)
+        if max_size is not None and size > max_size:
+            raise RequestTooLarge('decoded request larger than %d bytes' % max_size)
+        if not getattr(decompressor, 'eof', True): # python 2 cannot tell
+            raise BadContentEncoding('truncated gzip content')
+        yield data
+    except zlib.error:
+        raise BadContentEncoding('error decoding gzip content')
+
 class WSGIXMLRPCApplication(object):
     """Application to handle requests to the XMLRPC service"""
 
-    def __init__(self, instance=None, methods=[], do_log=True):
-        """Create windmill xmlrpc dispatcher"""
+    # responses larger than this are gzip encoded, for clients that accept it.
+    # None disables compression of responses.
+    encode_threshold = 1400
+
+    # request bodies are read in chunks of at most this many bytes
+    max_chunk_size = 10*1024*1024
+
+    def __init__(self, instance=None, methods=[], do_log=True, max_request_size=None):
+        """Create windmill xmlrpc dispatcher
+        
+        Requests larger than max_request_size bytes (before or after decoding) 
+        are refused with 413, None for no limit."""
+        self.max_request_size = max_request_size
         try:
             self.dispatcher = xmlrpc_server.SimpleXMLRPCDispatcher(allow_none=True, encoding=None)
         except TypeError:
@@ -77,7 +145,7 @@ class WSGIXMLRPCApplication(object):
             return self.handle_POST(environ, start_response)
         else:
             start_response("400 Bad request", [('Content-Type','text/plain')])
-            return ['']
+            return [b('')]
         
     def handle_POST(self, environ, start_response):
         """Handles the HTTP POST request.
@@ -93,21 +161,32 @@ class WSGIXMLRPCApplication(object):
             # We read this in chunks to avoid straining
             # socket.read(); around the 10 or 15Mb mark, some platforms
             # begin to have problems (bug #792570).
+            # The chunks are fed to the XML parser as they arrive,
+            # so the whole body is never held in memory.
 
             length = int(environ['CONTENT_LENGTH'])
-            data = environ['wsgi.input'].read(length)
+            if self.max_request_size is not None and length > self.max_request_size:
+                # fail before reading anything
+                start_response("413 Request Entity Too Large", [('Content-Type', 'text/plain')])
+                return [b('request larger than %d bytes' % self.max_request_size)]
             
-            max_chunk_size = 10*1024*1024
-            size_remaining = length
+            chunks = self.read_chunks(environ['wsgi.input'], length)
 
-            # In previous versions of SimpleXMLRPCServer, _dispatch
-            # could be overridden in this class, instead of in
-            # SimpleXMLRPCDispatcher. To maintain backwards compatibility,
-            # check to see if a subclass implements _dispatch and 
-            # using that method if present.
-            response = self.dispatcher._marshaled_dispatch(
-                    data, getattr(self.dispatcher, '_dispatch', None)
-                )
+            encoding = environ.get('HTTP_CONTENT_ENCODING', 'identity').strip().lower()
+            if encoding in ('gzip', 'x-gzip'):
+                chunks = gzip_decode_chunks(chunks, self.max_request_size, self.max_chunk_size)
+            elif encoding != 'identity':
+                start_response("501 Not Implemented", [('Content-Type', 'text/plain')])
+                return [b('encoding %r not supported' % encoding)]
+
+            try:
+                response = self.dispatch_chunks(chunks)
+            except RequestTooLarge as e:
+                start_response("413 Request Entity Too Large", [('Content-Type', 'text/plain')])
+                return [b(str(e))]
+            except BadContentEncoding as e:
+                start_response("400 Bad request", [('Content-Type', 'text/plain')])
+                return [b(str(e))]
             response += b('\n')
         except: # This should only happen if the module is buggy
             # internal error, report as HTTP server error
@@ -116,10 +195,70 @@ class WSGIXMLRPCApplication(object):
             return []
         else:
             # got a valid XML RPC response
-            start_response("200 OK", [('Content-Type','text/xml'), ('Content-Length', str(len(response)),)])
+            headers = [('Content-Type','text/xml')]
+            if self.encode_threshold is not None and len(response) > self.encode_threshold and accepts_gzip(environ):
+                response = gzip_encode(response)
+                headers.append(('Content-Encoding', 'gzip'))
+            headers.append(('Content-Length', str(len(response))))
+            start_response("200 OK", headers)
             logger.info('200 %s' % environ['REMOTE_ADDR'])
             return [response]
             
 
+    def read_chunks(self, stream, length):
+        """Yields the request body in chunks of at most max_chunk_size bytes"""
+        size_remaining = length
+        while size_remaining > 0:
+            chunk = stream.read(min(size_remaining, self.max_chunk_size))
+            if not chunk:
+                break # client went away
+            size_remaining -= len(chunk)
+            yield chunk
+
+    def dispatch_chunks(self, chunks):
+        """Dispatches an XML-RPC method from marshalled (XML) data,
+        which is fed to the parser chunk by chunk.  Returns the marshalled response.
+        
+        Follows SimpleXMLRPCDispatcher._marshaled_dispatch, which needs the whole request at once.
+        RequestTooLarge and BadContentEncoding from the chunks are passed on to the caller.
+        """
+        dispatcher = self.dispatcher
+        try:
+            try:
+                parser, unmarshaller = xmlrpc_client.getparser(use_builtin_types=getattr(dispatcher, 'use_builtin_types', False))
+            except TypeError:
+                # python 2
+                parser, unmarshaller = xmlrpc_client.getparser()
+            for chunk in chunks:
+                parser.feed(chunk)
+            parser.close()
+            params, method = unmarshaller.close(), unmarshaller.getmethodname()
+
+            # In previous versions of SimpleXMLRPCServer, _dispatch
+            # could be overridden in this class, instead of in
+            # SimpleXMLRPCDispatcher. To maintain backwards compatibility,
+            # check to see if a subclass implements _dispatch and 
+            # using that method if present.
+            response = dispatcher._dispatch(method, params)
+            # wrap response in a singleton tuple
+            response = (response,)
+            response = xmlrpc_client.dumps(response, methodresponse=1,
+                                           allow_none=dispatcher.allow_none, encoding=dispatcher.encoding)
+        except (RequestTooLarge, BadContentEncoding):
+            raise
+        except xmlrpc_client.Fault as fault:
+            response = xmlrpc_client.dumps(fault, allow_none=dispatcher.allow_none,
+                                           encoding=dispatcher.encoding)
+        except:
+            exc_type, exc_value = sys.exc_info()[:2]
+            response = xmlrpc_client.dumps(
+                xmlrpc_client.Fault(1, "%s:%s" % (exc_type, exc_value)),
+                encoding=dispatcher.encoding, allow_none=dispatcher.allow_none,
+                )
+
+        if not isinstance(response, bytes):
+            response = response.encode(dispatcher.encoding, 'xmlcharrefreplace')
+        return response
+
     def __call__(self, environ, start_response):
         return self.handler(environ, start_response)